@@ -12,8 +12,12 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import pbr.version
 
+def __getattr__(name):
+    # Looking up the version is slow, only do it when it is needed.
+    if name == "__version__":
+        import pbr.version
 
-__version__ = pbr.version.VersionInfo(
-    'ruck').version_string()
+        return pbr.version.VersionInfo(
+            'ruck').version_string()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
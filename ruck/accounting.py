@@ -0,0 +1,108 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import json
+import threading
+
+# getrusage(2) reports block I/O in 512 byte units.
+BLOCK_SIZE = 512
+
+_lock = threading.Lock()
+_records = []
+
+
+def reset():
+    """Forget the commands recorded so far."""
+    with _lock:
+        del _records[:]
+
+
+def record(phase, argv, returncode, wall, rusage):
+    """Record the resources used by a child process."""
+    entry = {
+        "phase": phase,
+        "argv": argv,
+        "returncode": returncode,
+        "wall": wall,
+        "user": None,
+        "sys": None,
+        "maxrss": None,
+        "inblock": None,
+        "oublock": None,
+    }
+    if rusage is not None:
+        entry.update({
+            "user": rusage.ru_utime,
+            "sys": rusage.ru_stime,
+            # Linux reports the maximum resident set size in KiB.
+            "maxrss": rusage.ru_maxrss * 1024,
+            "inblock": rusage.ru_inblock,
+            "oublock": rusage.ru_oublock,
+        })
+    with _lock:
+        _records.append(entry)
+
+
+def summary():
+    """Aggregate the recorded commands per phase."""
+    phases = {}
+    with _lock:
+        records = list(_records)
+    for entry in records:
+        phase = phases.setdefault(entry["phase"] or "-", {
+            "commands": 0,
+            "wall": 0.0,
+            "user": 0.0,
+            "sys": 0.0,
+            "maxrss": 0,
+            "read": 0,
+            "written": 0,
+        })
+        phase["commands"] += 1
+        phase["wall"] += entry["wall"]
+        if entry["user"] is not None:
+            phase["user"] += entry["user"]
+            phase["sys"] += entry["sys"]
+            phase["maxrss"] = max(phase["maxrss"], entry["maxrss"])
+            phase["read"] += entry["inblock"] * BLOCK_SIZE
+            phase["written"] += entry["oublock"] * BLOCK_SIZE
+    return phases
+
+
+def report():
+    """Print the resources used by each phase."""
+    from rich import console
+    from rich.table import Table
+
+    table = Table(title="Resource usage")
+    for column in ["Phase", "Commands", "Wall (s)", "User (s)", "Sys (s)",
+                   "CPU %", "Max RSS (MiB)", "Read (MiB)", "Written (MiB)"]:
+        table.add_column(column)
+
+    mib = 1024 * 1024
+    for name, phase in summary().items():
+        cpu = 0
+        if phase["wall"]:
+            cpu = (phase["user"] + phase["sys"]) / phase["wall"] * 100
+        table.add_row(
+            name,
+            str(phase["commands"]),
+            f"{phase['wall']:.1f}",
+            f"{phase['user']:.1f}",
+            f"{phase['sys']:.1f}",
+            f"{cpu:.0f}",
+            f"{phase['maxrss'] / mib:.0f}",
+            f"{phase['read'] / mib:.0f}",
+            f"{phase['written'] / mib:.0f}")
+    console.Console().print(table)
+
+
+def save(path):
+    """Dump the recorded commands and the per phase totals as JSON."""
+    with _lock:
+        records = list(_records)
+    with open(path, "w") as f:
+        json.dump({"phases": summary(), "commands": records}, f, indent=2)
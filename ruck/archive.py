@@ -5,17 +5,509 @@ SPDX-License-Identifier: Apache-2.0
 
 """
 
+from concurrent import futures
+import contextlib
+import hashlib
+import io
+import json
 import logging
+import os
+import shlex
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+import zlib
 
+from ruck import exceptions
+from ruck import stream
 from ruck import utils
 
 log = logging.getLogger(__name__)
 
+# Compression formats of root filesystem tarballs: the leading bytes
+# of the compressed stream, the file extensions, and the programs
+# compressing them, the fastest first.
+FORMATS = {
+    "zstd": {
+        "magic": b"\x28\xb5\x2f\xfd",
+        "extensions": [".tar.zst", ".tzst"],
+        "programs": ["zstd"],
+    },
+    "xz": {
+        "magic": b"\xfd7zXZ\x00",
+        "extensions": [".tar.xz", ".txz"],
+        "programs": ["xz"],
+    },
+    "lz4": {
+        "magic": b"\x04\x22\x4d\x18",
+        "extensions": [".tar.lz4"],
+        "programs": ["lz4"],
+    },
+    "gzip": {
+        "magic": b"\x1f\x8b",
+        "extensions": [".tar.gz", ".tgz"],
+        "programs": ["pigz", "gzip"],
+    },
+    "tar": {
+        "magic": None,
+        "extensions": [".tar"],
+        "programs": [],
+    },
+}
+
+# Offset of the magic of an uncompressed tar header.
+TAR_MAGIC_OFFSET = 257
+TAR_MAGIC = b"ustar"
+
+# Sidecar index listing the members of an archive.
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 1
+
+# Uncompressed bytes per gzip member of seekable archives.
+SEEKABLE_CHUNK_SIZE = 16 * 1024 * 1024
+
+READ_SIZE = 1024 * 1024
+
+TYPES = {
+    tarfile.REGTYPE: "file",
+    tarfile.AREGTYPE: "file",
+    tarfile.CONTTYPE: "file",
+    tarfile.DIRTYPE: "dir",
+    tarfile.SYMTYPE: "symlink",
+    tarfile.LNKTYPE: "hardlink",
+    tarfile.CHRTYPE: "char",
+    tarfile.BLKTYPE: "block",
+    tarfile.FIFOTYPE: "fifo",
+}
+
+
+def detect(archive):
+    """Return the format of an archive from its leading bytes."""
+    with open(archive, "rb") as f:
+        header = f.read(TAR_MAGIC_OFFSET + len(TAR_MAGIC))
+    for name, fmt in FORMATS.items():
+        if fmt["magic"] and header.startswith(fmt["magic"]):
+            return name
+    if header[TAR_MAGIC_OFFSET:] == TAR_MAGIC:
+        return "tar"
+    raise exceptions.ConfigError(f"{archive} is not a supported archive.")
+
+
+def format_from_name(archive):
+    """Return the format of an archive from its file name."""
+    name = os.path.basename(str(archive))
+    for fmt_name, fmt in FORMATS.items():
+        if any(name.endswith(ext) for ext in fmt["extensions"]):
+            return fmt_name
+    raise exceptions.ConfigError(
+        f"Unable to tell the compression of {archive} from its name.")
+
+
+def compressor(fmt, level=None, threads=None, decompress=False):
+    """Return the command compressing, or decompressing, to stdout."""
+    for program in FORMATS[fmt]["programs"]:
+        if shutil.which(program):
+            break
+    else:
+        if not FORMATS[fmt]["programs"]:
+            return None
+        raise exceptions.CommandNotFoundError(
+            f"{' or '.join(FORMATS[fmt]['programs'])} is not found.")
+
+    cmd = [program]
+    if decompress:
+        cmd.append("-d")
+    elif level is not None:
+        cmd.append(f"-{level}")
+    if threads is not None:
+        if program in ["zstd", "xz"]:
+            cmd.append(f"-T{threads}")
+        elif program == "pigz" and threads:
+            cmd.extend(["-p", str(threads)])
+    cmd.append("-c")
+    return cmd
+
+
+def environment(fmt, level=None, threads=None):
+    """Return the environment setting the level and threads of the
+    compressor that tools such as mmdebstrap run themselves.
+    """
+    env = {}
+    if fmt == "zstd":
+        if level is not None:
+            env["ZSTD_CLEVEL"] = str(level)
+        if threads is not None:
+            env["ZSTD_NBTHREADS"] = str(threads)
+    elif fmt == "xz":
+        opts = []
+        if level is not None:
+            opts.append(f"-{level}")
+        if threads is not None:
+            opts.append(f"-T{threads}")
+        if opts:
+            env["XZ_OPT"] = " ".join(opts)
+    return env
+
+
+def unpack(archive, rootfs, threads=0):
+    producer = stream.take(archive)
+    if producer is not None:
+        log.info(f"Unpacking {archive} as it is created.")
+        producer(["tar", "-C", rootfs,
+                  "--exclude=./dev/*",
+                  "-xf", "-", "--numeric-owner"])
+        return
 
-def unpack(archive, rootfs):
     log.info(f"Unpakcing {archive}.")
+    cmd = ["tar", "-C", rootfs,
+           "--exclude=./dev/*",
+           "-xf", archive, "--numeric-owner"]
+    # tar adds -d to the program when extracting.
+    program = compressor(detect(archive), threads=threads)
+    if program:
+        cmd.extend(["-I", " ".join(program)])
+    utils.run_command(cmd)
+
+
+def pack(rootfs, archive, fmt=None, level=None, threads=None):
+    """Create an archive of a root filesystem directory."""
+    fmt = fmt or format_from_name(archive)
+    cmd = ["tar", "-C", rootfs, "--numeric-owner", "-cf", archive]
+    program = compressor(fmt, level=level, threads=threads)
+    if program:
+        cmd.extend(["-I", " ".join(program)])
+    utils.run_command(cmd + ["."])
+
+
+def compress(source, archive, fmt=None, level=None, threads=None,
+             seekable=False):
+    """Compress an uncompressed tarball.
+
+    Seekable gzip archives are made of independent gzip members so
+    that members can be extracted without decompressing from the
+    start.
+    """
+    fmt = fmt or format_from_name(archive)
+    if seekable:
+        if fmt != "gzip":
+            raise exceptions.ConfigError(
+                f"Seekable {fmt} archives are not supported.")
+        return _compress_seekable(source, archive, level, threads)
+    program = compressor(fmt, level=level, threads=threads)
+    if program is None:
+        os.replace(source, archive)
+        return
+    _filter(program, source, archive)
+
+
+def _filter(program, source, dest):
+    """Run a compression program from a file to another."""
+    cmd = " ".join(shlex.quote(str(a)) for a in program)
     utils.run_command(
-        ["tar", "-C", rootfs,
-         "--exclude=./dev/*",
-         "-zxf", archive, "--numeric-owner"]
-    )
+        f"{cmd} < {shlex.quote(str(source))} > {shlex.quote(str(dest))}",
+        shell=True)
+
+
+def benchmark(path, formats=None, level=None, threads=None):
+    """Measure the ratio and throughput of compression formats.
+
+    path is a root filesystem directory or archive. Return a list of
+    (format, ratio, compress bytes/s, decompress bytes/s).
+    """
+    formats = formats or [name for name in FORMATS if name != "tar"]
+    results = []
+    with tempfile.TemporaryDirectory(prefix="ruck-benchmark-") as tmp:
+        tar = os.path.join(tmp, "rootfs.tar")
+        if os.path.isdir(path):
+            utils.run_command(
+                ["tar", "-C", path, "--numeric-owner", "-cf", tar, "."])
+        else:
+            program = compressor(detect(path), decompress=True)
+            if program:
+                _filter(program, path, tar)
+            else:
+                shutil.copyfile(path, tar)
+        size = os.path.getsize(tar)
+
+        for fmt in formats:
+            extension = FORMATS[fmt]["extensions"][0]
+            archive = os.path.join(tmp, f"rootfs{extension}")
+            program = compressor(fmt, level=level, threads=threads)
+            start = time.monotonic()
+            _filter(program, tar, archive)
+            compress_time = time.monotonic() - start
+
+            program = compressor(fmt, threads=threads, decompress=True)
+            start = time.monotonic()
+            _filter(program, archive, os.devnull)
+            decompress_time = time.monotonic() - start
+
+            results.append((
+                fmt,
+                size / max(os.path.getsize(archive), 1),
+                size / max(compress_time, 1e-9),
+                size / max(decompress_time, 1e-9)))
+            os.unlink(archive)
+    return results
+
+
+def _compress_seekable(source, archive, level=None, threads=None):
+    """Compress a file into independent gzip members."""
+    level = 6 if level is None else level
+
+    def deflate(chunk):
+        # zlib releases the GIL, chunks are compressed in parallel.
+        c = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return c.compress(chunk) + c.flush()
+
+    workers = threads or os.cpu_count() or 1
+    with open(source, "rb") as fsrc, open(archive, "wb") as fdst, \
+            futures.ThreadPoolExecutor(workers) as pool:
+        while True:
+            chunks = [fsrc.read(SEEKABLE_CHUNK_SIZE) for i in range(workers)]
+            chunks = [chunk for chunk in chunks if chunk]
+            if not chunks:
+                break
+            for data in pool.map(deflate, chunks):
+                fdst.write(data)
+
+
+class _GzipReader(io.RawIOBase):
+    """Decompress a gzip file, recording where its members start."""
+
+    def __init__(self, f):
+        self.f = f
+        self.compressed = f.tell()
+        self.uncompressed = 0
+        # (uncompressed offset, compressed offset) of the members.
+        self.members = [[0, self.compressed]]
+        self._d = zlib.decompressobj(31)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            if self._d.eof:
+                unused = self._d.unused_data
+                self.f.seek(self.compressed - len(unused))
+                self.compressed -= len(unused)
+                if not self.f.read(1):
+                    return 0
+                self.f.seek(self.compressed)
+                self.members.append([self.uncompressed, self.compressed])
+                self._d = zlib.decompressobj(31)
+            data = self.f.read(READ_SIZE)
+            if not data:
+                return 0
+            self.compressed += len(data)
+            self._buffer = self._d.decompress(data)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        self.uncompressed += n
+        return n
+
+
+@contextlib.contextmanager
+def _uncompressed(archive, fmt, offset=0, members=None):
+    """Yield a file object reading the uncompressed tar stream.
+
+    The stream starts at offset, or before it when the archive cannot
+    seek there: the actual start offset is yielded too.
+    """
+    if fmt == "tar":
+        with open(archive, "rb") as f:
+            f.seek(offset)
+            yield (f, offset)
+    elif fmt == "gzip":
+        start = [0, 0]
+        for member in members or []:
+            if member[0] <= offset:
+                start = member
+        with open(archive, "rb") as f:
+            f.seek(start[1])
+            reader = _GzipReader(f)
+            yield (io.BufferedReader(reader, READ_SIZE), start[0])
+    else:
+        program = compressor(fmt, decompress=True)
+        sp = subprocess.Popen(program + [str(archive)],
+                              stdout=subprocess.PIPE)
+        try:
+            yield (sp.stdout, 0)
+        finally:
+            sp.stdout.close()
+            sp.kill()
+            sp.wait()
+
+
+@contextlib.contextmanager
+def uncompressed(archive):
+    """Yield a file object reading the tar stream of an archive."""
+    with _uncompressed(archive, detect(archive)) as (f, start):
+        yield f
+
+
+def _name(name):
+    """Return the path of a member without its leading ./ or /."""
+    name = name.lstrip("/")
+    while name.startswith("./"):
+        name = name[2:]
+    return name.rstrip("/") or "."
+
+
+def index_path(archive):
+    return f"{archive}{INDEX_SUFFIX}"
+
+
+def _entries(f):
+    """Return the entries of the members of an uncompressed tar stream."""
+    entries = []
+    with tarfile.open(fileobj=f, mode="r|") as tar:
+        for member in tar:
+            entry = {
+                "path": _name(member.name),
+                "type": TYPES.get(member.type, "other"),
+                "mode": member.mode,
+                "uid": member.uid,
+                "gid": member.gid,
+                "size": member.size,
+                "offset": member.offset_data,
+            }
+            if member.issym() or member.islnk():
+                entry["linkname"] = member.linkname
+            if member.isfile():
+                m = hashlib.sha256()
+                data = tar.extractfile(member)
+                for chunk in iter(lambda: data.read(READ_SIZE), b""):
+                    m.update(chunk)
+                entry["sha256"] = m.hexdigest()
+            entries.append(entry)
+    return entries
+
+
+def write_index(archive):
+    """Write the sidecar index of an archive and return it.
+
+    Each member has its path, type, mode, size, the offset of its data
+    in the uncompressed tar stream and, for files, its sha256.
+    """
+    fmt = detect(archive)
+    st = os.stat(archive)
+    with _uncompressed(archive, fmt) as (f, start):
+        try:
+            entries = _entries(f)
+        except (tarfile.TarError, zlib.error) as e:
+            raise exceptions.ConfigError(f"Unable to index {archive}: {e}")
+        members = None
+        if fmt == "gzip":
+            members = f.raw.members
+    index = {
+        "version": INDEX_VERSION,
+        "format": fmt,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "members": members,
+        "entries": entries,
+    }
+    _save_index(archive, index)
+    return index
+
+
+def _read_index(archive):
+    """Return the index of an archive if it is up to date."""
+    st = os.stat(archive)
+    try:
+        with open(index_path(archive), "r") as f:
+            index = json.load(f)
+        if index["version"] == INDEX_VERSION and \
+                index["size"] == st.st_size and \
+                index["mtime_ns"] == st.st_mtime_ns:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def _save_index(archive, index):
+    tmp = f"{index_path(archive)}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, index_path(archive))
+
+
+def load_index(archive):
+    """Return the index of an archive, updating it if it is stale."""
+    index = _read_index(archive)
+    if index is None:
+        log.debug(f"Indexing {archive}.")
+        index = write_index(archive)
+    return index
+
+
+def copy_index(archive, copy):
+    """Give a copy of an archive the index of the archive, if any."""
+    index = _read_index(archive)
+    if index is None:
+        return
+    st = os.stat(copy)
+    index.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+    _save_index(copy, index)
+
+
+def members(archive):
+    """Return the entries of the members of an archive."""
+    return load_index(archive)["entries"]
+
+
+def extract(archive, member):
+    """Return the content of a file of an archive.
+
+    Only the part of the archive up to the file is decompressed, and
+    for plain tar and seekable gzip archives only the part containing
+    the file.
+    """
+    index = load_index(archive)
+    entries = {entry["path"]: entry for entry in index["entries"]}
+    entry = entries.get(_name(member))
+    if entry is not None and entry["type"] == "hardlink":
+        entry = entries.get(_name(entry["linkname"]))
+    if entry is None or entry["type"] != "file":
+        raise exceptions.ConfigError(f"{member} is not a file of {archive}.")
+
+    with _uncompressed(archive, index["format"], entry["offset"],
+                       index["members"]) as (f, start):
+        skip = entry["offset"] - start
+        while skip > 0:
+            skipped = len(f.read(min(skip, READ_SIZE)))
+            if not skipped:
+                break
+            skip -= skipped
+        data = f.read(entry["size"])
+    if hashlib.sha256(data).hexdigest() != entry["sha256"]:
+        raise exceptions.ConfigError(
+            f"{member} does not match the index of {archive}.")
+    return data
+
+
+def diff(old, new):
+    """Compare the members of two archives.
+
+    Return the paths added, removed and changed.
+    """
+    def attributes(archive):
+        return {
+            entry["path"]: tuple(entry.get(key) for key in [
+                "type", "mode", "uid", "gid", "size", "sha256", "linkname"])
+            for entry in members(archive)}
+
+    old = attributes(old)
+    new = attributes(new)
+    added = sorted(set(new) - set(old))
+    removed = sorted(set(old) - set(new))
+    changed = sorted(path for path in set(old) & set(new)
+                     if old[path] != new[path])
+    return (added, removed, changed)
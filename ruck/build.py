@@ -3,84 +3,325 @@ Copyright (c) 2024 Wind River Systems, Inc.
 
 SPDX-License-Identifier: Apache-2.0
 """
+import collections
+import contextlib
+import functools
 import logging
+import os
 import shutil
 
+from omegaconf import OmegaConf
+from omegaconf.errors import OmegaConfBaseException
 from stevedore import driver
+from stevedore.exception import NoMatches
 
+from ruck import accounting
+from ruck.cache import PhaseCache
 from ruck.config import Config
 from ruck import exceptions
+from ruck.journal import Journal
+from ruck.log import phase_context
+from ruck.mount import MountManager
+from ruck.scheduler import Scheduler
+from ruck import schema
+from ruck import sync
+from ruck import trace
+from ruck import utils
+
+
+ARCHITECTURES = ["amd64", "arm64"]
+
+
+@contextlib.contextmanager
+def session(state):
+    """Collect the trace and the resource usage of a ruck invocation."""
+    log = logging.getLogger(__name__)
+    accounting.reset()
+    if state.trace is not None:
+        trace.enable()
+    try:
+        with trace.span("build", config=str(state.config)):
+            yield
+        accounting.report()
+    finally:
+        if state.trace is not None:
+            log.info(f"Writing trace to {state.trace}.")
+            trace.save(state.trace)
+        if state.stats is not None:
+            log.info(f"Writing resource usage to {state.stats}.")
+            accounting.save(state.stats)
+
+
+@functools.lru_cache(maxsize=None)
+def stage_plugin(name):
+    """Return the stage plugin class registered under a name.
+
+    Looking up the entry points is done once per stage rather than
+    once per phase.
+    """
+    mgr = driver.DriverManager(
+        namespace="ruck.stages",
+        name=name,
+        invoke_on_load=False)
+    return mgr.driver
 
 
 class Build(object):
-    def __init__(self, state):
+    def __init__(self, state, overrides=None, label=None, slots=None,
+                 shared=None):
         self.state = state
         self.logging = logging.getLogger(__name__)
         self.config = Config(self.state)
 
-        self.arch = ["amd64", "arm64"]
+        self.arch = ARCHITECTURES
+
+        # Set when the build is a variant of a matrix build.
+        self.overrides = overrides
+        self.label = label
+        self.slots = slots
+        self.shared = shared
 
     def build(self):
         """Build an artifact from a given configuration file."""
+        with session(self.state):
+            self.run()
+
+    def run(self):
+        """Run the phases of the manifest."""
         self.logging.info("Running ruck.")
 
         self.logging.info(
             f"Loading configuration file: {self.state.config}")
         if not self.state.config.exists():
-            exceptions.ConfigError(
-                f"Failed to load configuration: {self.state.config}")
-        config = self.config.load_config()
-
-        if config.name is None:
-            raise exceptions.ConfigError("Manifest name is not specified.")
-        if config.architecture is None:
-            raise exceptions.ConfigError(
-                "Manifest archtitecture is not specified.")
-        if config.architecture not in self.arch:
             raise exceptions.ConfigError(
-                f"{config.architecture} is not supported.")
+                f"Failed to load configuration: {self.state.config}")
+        with trace.span("load config"):
+            config = self.config.load_config()
+        if self.overrides:
+            config = OmegaConf.merge(config, self.overrides)
 
-        if config.version is None:
-            raise exceptions.ConfigError("Version si not specified..")
-        if config.schemaVersion is None:
-            raise exceptions.ConfigError("Schema version is not specified.")
-        if config.schemaVersion != 1:
-            raise exceptions.ConfigError(
-                f"{config.schemaVersion} is not supported.")
+        errors = self._validate_manifest(config)
+        if config.get("name") is None:
+            raise exceptions.SchemaError(
+                "Invalid manifest:\n" + "\n".join(errors))
 
         self.workspace = self.state.workspace.joinpath(config.name)
         self.logging.info(f"Setting up workspace: {self.workspace}")
         self.workspace.mkdir(parents=True, exist_ok=True)
 
-        self.logging.info("Copying configuration to workspace.")
-        shutil.copytree(
-            self.state.config.parent,
-            self.workspace,
-            dirs_exist_ok=True)
+        self.logging.info("Syncing configuration to workspace.")
+        with trace.span("sync config"):
+            (files, size) = sync.sync_tree(
+                self.state.config.parent,
+                self.workspace,
+                self.workspace.joinpath(".ruck", "sync.json"),
+                checksums=self.state.sync_checksum)
+        self.logging.info(
+            f"Copied {files} file(s), {size / 1024 / 1024:.1f} MiB.")
+
+        if not config.get("phases"):
+            raise exceptions.ConfigError(
+                "No phases found please check the manifest.")
+
+        # (manifest index, phase, stage) of the phases with a stage.
+        loaded = []
+        for index, p in enumerate(config.phases):
+            if p.get("stage") is None:
+                errors.append(f"phase {index + 1}: stage: required field")
+                continue
+            try:
+                loaded.append((index, p, self._load_stage(p)))
+            except NoMatches:
+                errors.append(
+                    f"phase {index + 1}: unknown stage {p.stage}.")
+        errors.extend(self._validate_phases(loaded))
+        if errors:
+            raise exceptions.SchemaError(
+                "Invalid manifest:\n" + "\n".join(errors))
+        stages = [(p, stage) for index, p, stage in loaded]
+
+        cache = PhaseCache(self.workspace, enabled=not self.state.no_cache)
+        rebuild_from = None
+        if self.state.rebuild_from is not None:
+            rebuild_from = self._find_phase(
+                config.phases, self.state.rebuild_from)
+        run = cache.plan(stages, rebuild_from=rebuild_from)
+
+        journal = Journal(self.workspace)
+        start = 0
+        end = len(stages)
+        if self.state.resume:
+            start = journal.first_incomplete(cache.keys)
+        if self.state.from_phase is not None:
+            start = self._find_phase(config.phases, self.state.from_phase)
+        if self.state.until_phase is not None:
+            end = self._find_phase(config.phases, self.state.until_phase) + 1
+        if start >= end:
+            self.logging.info("No phases left to run.")
+            return
+        if start > 0:
+            self.logging.info(f"Starting from {stages[start][0].name}.")
+        journal.verify(stages, cache.keys, start, end)
+
+        def released(image):
+            # The image was modified after its phase was recorded.
+            cache.refresh(image)
+            journal.refresh(image)
+
+        # Mounts shared by the phases, see ruck.mount.
+        self.mounts = MountManager(
+            self.workspace.joinpath(".ruck", "mounts.json"),
+            on_release=released)
+        self.mounts.recover()
+        for p, stage in stages:
+            stage.mount_manager = self.mounts
 
-        if config.phases:
-            self.logging.info("Running phases...")
-            for p in config.phases:
+        self.logging.info("Running phases...")
+
+        # Artifacts modified in place are not shared between variants.
+        writes = collections.Counter(
+            path for p, stage in stages for path in map(str, stage.outputs()))
+        modified = set(path for path, count in writes.items() if count > 1)
+
+        def run_phase(index):
+            if index < start or index >= end:
+                return
+            p, stage = stages[index]
+            name = p.name
+            prefix = None
+            if self.state.jobs > 1:
+                prefix = f"{index + 1}/{len(stages)} {p.stage}"
+            if self.label is not None:
+                name = f"{self.label}: {p.name}"
+                prefix = f"{self.label} {index + 1}/{len(stages)} {p.stage}"
+            with phase_context(name, prefix), \
+                    trace.span(p.name, cat="phase", stage=p.stage):
+                trace.thread_name(prefix or "ruck")
                 self.logging.info(p.name)
+                journal.start(index)
+                outputs = set(map(str, stage.outputs()))
+                if not run[index]:
+                    self.logging.info("Phase is up to date, skipping.")
+                elif self.shared is not None and outputs and \
+                        not outputs & modified:
+                    self.mounts.settle(stage)
+                    self._run_shared(stage, cache, cache.keys[index])
+                else:
+                    self.mounts.settle(stage)
+                    self._run_stage(stage, cache)
+                cache.record(index, p, stage)
+                journal.complete(index, p, stage, cache.keys[index])
+
+        try:
+            Scheduler(stages, jobs=self.state.jobs).run(run_phase)
+        finally:
+            self.mounts.close()
+
+        cache.report()
 
-                self.logging.info(f"Loading {p.stage} step.")
-                mgr = driver.DriverManager(
-                    namespace="ruck.stages",
-                    name=p.stage,
-                    invoke_on_load=True,
-                    invoke_args=(self.state, p,
-                                 self.workspace)
-                    )
+    def _load_stage(self, phase):
+        """Load the stage plugin of a phase."""
+        self.logging.info(f"Loading {phase.stage} step.")
+        with trace.span(f"load {phase.stage}", cat="plugin"):
+            plugin = stage_plugin(phase.stage)
+            return plugin(self.state, phase, self.workspace)
 
+    def _run_stage(self, stage, cache):
+        """Run the steps of a stage plugin."""
+        slots = self.slots or contextlib.nullcontext()
+        try:
+            with slots:
                 self.logging.info("Running preflight check.")
-                mgr.driver.preflight_check()
+                with trace.span("preflight_check", cat="stage"):
+                    stage.preflight_check()
 
                 self.logging.info("Running step.")
-                mgr.driver.run()
+                with trace.span("run", cat="stage"):
+                    stage.run()
 
                 self.logging.info("Running post install.")
-                mgr.driver.post_install()
+                with trace.span("post_install", cat="stage"):
+                    stage.post_install()
+        except Exception:
+            cache.invalidate(stage)
+            raise
 
-        else:
-            raise exceptions.ConfigException(
-                "No phases found please check the manifest.")
+    def _run_shared(self, stage, cache, key):
+        """Run a phase once for all the variants of a matrix build."""
+        with self.shared.claim(key) as workspace:
+            if workspace is None:
+                self._run_stage(stage, cache)
+                self.shared.register(key, self.workspace)
+                return
+
+            sources = [workspace.joinpath(path.relative_to(self.workspace))
+                       for path in stage.outputs()
+                       if self.workspace in path.parents]
+            if not all(source.exists() for source in sources):
+                # Streamed outputs are not written to disk.
+                self._run_stage(stage, cache)
+                return
+
+            self.logging.info(f"Phase already ran in {workspace}.")
+            for path in stage.outputs():
+                try:
+                    source = workspace.joinpath(
+                        path.relative_to(self.workspace))
+                except ValueError:
+                    # Outputs outside of the workspace are shared.
+                    continue
+                self.logging.info(f"Copying {source} to {path}.")
+                if path.is_dir():
+                    shutil.rmtree(path)
+                if source.is_dir():
+                    shutil.copytree(source, path, symlinks=True,
+                                    copy_function=utils.clone_file)
+                else:
+                    utils.clone_file(source, path)
+
+    def _validate_manifest(self, config):
+        """Validate the top level of the manifest."""
+        errors = schema.manifest_errors(OmegaConf.to_container(config))
+        architecture = config.get("architecture")
+        if architecture is not None and architecture not in self.arch:
+            errors.append(f"architecture: {architecture} is not supported.")
+        return errors
+
+    def _validate_phases(self, loaded):
+        """Validate every phase before any of them runs.
+
+        loaded holds the phases with their index in the manifest.
+        """
+        errors = []
+        produced = set()
+        for index, p, stage in loaded:
+            prefix = f"phase {index + 1} ({p.get('name')})"
+            try:
+                phase = OmegaConf.to_container(p, resolve=True)
+            except OmegaConfBaseException as e:
+                errors.append(f"{prefix}: {e}")
+                continue
+
+            phase_errors = []
+            if stage.SCHEMA is not None:
+                phase_errors = schema.errors(
+                    phase, stage.SCHEMA, key=type(stage))
+                errors.extend(f"{prefix}: {e}" for e in phase_errors)
+            for tool in stage.TOOLS:
+                if shutil.which(tool) is None:
+                    errors.append(f"{prefix}: {tool} is not found.")
+            if phase_errors:
+                continue
+
+            for path in map(str, stage.inputs()):
+                if path not in produced and not os.path.exists(path):
+                    errors.append(f"{prefix}: {path} is not found.")
+            produced.update(map(str, stage.outputs()))
+        return errors
+
+    def _find_phase(self, phases, ref):
+        """Find a phase by its position, name or stage."""
+        for index, p in enumerate(phases):
+            if ref in (str(index + 1), p.name, p.stage):
+                return index
+        raise exceptions.ConfigError(f"Phase {ref} is not found.")
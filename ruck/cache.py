@@ -0,0 +1,218 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import threading
+
+from omegaconf import OmegaConf
+
+from ruck import __version__
+from ruck import checksum
+
+
+def artifact_state(path):
+    """Return the on-disk state of an artifact."""
+    if not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        return "dir"
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class PhaseCache(object):
+    """Content addressed cache of the phases run in a workspace."""
+
+    def __init__(self, workspace, enabled=True):
+        self.workspace = workspace
+        self.path = workspace.joinpath(".ruck", "cache.json")
+        self.enabled = enabled
+        self.logging = logging.getLogger(__name__)
+
+        self.previous = self._load()
+        self.hashes = self.previous.get("hashes", {})
+        self.artifacts = dict(self.previous.get("artifacts", {}))
+        self.phases = {}
+        self.keys = []
+        self.run = []
+
+        self.hits = []
+        self.misses = []
+
+        self._lock = threading.Lock()
+
+    def plan(self, stages, rebuild_from=None):
+        """Return for every phase whether it has to be run."""
+        producers = {}
+        writers = {}
+        for index, (phase, stage) in enumerate(stages):
+            inputs = {}
+            for path in map(str, stage.inputs()):
+                inputs[self._relative(path)] = \
+                    producers.get(path) or self._fingerprint(path)
+            key = self._key(phase, stage, inputs)
+            for path in map(str, stage.outputs()):
+                producers[path] = key
+                writers.setdefault(path, []).append(index)
+            self.keys.append(key)
+
+        # Phases left out of this build keep their previous record.
+        self.phases = {p["key"]: p for p in self.previous.get("phases", [])
+                       if p["key"] in self.keys}
+
+        # An artifact is only usable if it is still in the state the
+        # last phase writing it left it in. Artifacts not on disk, such
+        # as streamed tarballs, are produced again.
+        invalid = set()
+        previous = self.previous.get("artifacts", {})
+        for path, indexes in writers.items():
+            last = previous.get(path)
+            state = artifact_state(path)
+            if state is None or last is None or \
+                    last["writer"] != self.keys[indexes[-1]] or \
+                    last["state"] != state:
+                invalid.add(path)
+
+        keys = set(p["key"] for p in self.previous.get("phases", []))
+        run = []
+        for index, (phase, stage) in enumerate(stages):
+            outputs = set(map(str, stage.outputs()))
+            run.append(not self.enabled
+                       or self.keys[index] not in keys
+                       or bool(outputs & invalid))
+        if rebuild_from is not None:
+            for index in range(rebuild_from, len(run)):
+                run[index] = True
+
+        # Artifacts are modified in place by later phases (an image
+        # is created, then deployed to, then made bootable), so
+        # re-running a phase means replaying every writer after it, and
+        # re-reading an artifact means rewinding to its previous writer.
+        changed = True
+        while changed:
+            changed = False
+            for index, (phase, stage) in enumerate(stages):
+                if not run[index]:
+                    continue
+                for path in map(str, stage.outputs()):
+                    for w in writers[path]:
+                        if w > index and not run[w]:
+                            run[w] = changed = True
+                for path in map(str, stage.inputs()):
+                    earlier = [w for w in writers.get(path, []) if w < index]
+                    if earlier and earlier[-1] != writers[path][-1] and \
+                            not run[earlier[-1]]:
+                        run[earlier[-1]] = changed = True
+
+        self.run = run
+        return run
+
+    def record(self, index, phase, stage):
+        """Record a completed phase and the state of its outputs."""
+        key = self.keys[index]
+        with self._lock:
+            if self.run[index]:
+                self.misses.append(phase.name)
+            else:
+                self.hits.append(phase.name)
+            self.phases[key] = {
+                "key": key,
+                "name": phase.name,
+                "stage": phase.stage,
+            }
+            for path in map(str, stage.outputs()):
+                self.artifacts[path] = {
+                    "writer": key,
+                    "state": artifact_state(path),
+                }
+            self.save()
+
+    def refresh(self, path):
+        """Record the state of an artifact changed after its last writer
+        completed, such as an image unmounted after the phase.
+        """
+        path = str(path)
+        with self._lock:
+            if path in self.artifacts:
+                self.artifacts[path]["state"] = artifact_state(path)
+                self.save()
+
+    def invalidate(self, stage):
+        """Forget the outputs of a phase that did not complete."""
+        with self._lock:
+            for path in map(str, stage.outputs()):
+                self.artifacts.pop(path, None)
+            self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump({
+                "phases": list(self.phases.values()),
+                "artifacts": self.artifacts,
+                "hashes": self.hashes,
+            }, f, indent=2)
+
+    def report(self):
+        """Report the cache hits and misses of the build."""
+        self.logging.info(
+            f"Phase cache: {len(self.hits)} hit(s), "
+            f"{len(self.misses)} miss(es).")
+        for name in self.hits:
+            self.logging.info(f"  hit:  {name}")
+        for name in self.misses:
+            self.logging.info(f"  miss: {name}")
+
+    def _key(self, phase, stage, inputs):
+        """Compute the cache key of a phase."""
+        phase = OmegaConf.to_container(phase, resolve=True)
+        phase.pop("name", None)
+        data = json.dumps({
+            "phase": phase,
+            "plugin": f"{type(stage).__module__}.{type(stage).__name__}",
+            "version": __version__,
+            "inputs": inputs,
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _relative(self, path):
+        """Return the path of an input relative to the workspace, so
+        that the variants of a matrix build share the keys of their
+        identical phases.
+        """
+        path = pathlib.Path(path)
+        if pathlib.Path(self.workspace) in path.parents:
+            return str(path.relative_to(self.workspace))
+        return str(path)
+
+    def _fingerprint(self, path):
+        """Hash an artifact that is not produced by the build."""
+        if not os.path.exists(path):
+            return None
+        if os.path.isdir(path):
+            # Directories are only read again when one of their entries
+            # changed.
+            stat = checksum.tree_stat_key(path)
+            digest = checksum.tree_digest
+        else:
+            stat = checksum.stat_key(path)
+            digest = checksum.file_digest
+        memo = self.hashes.get(path)
+        if memo is not None and memo["stat"] == stat:
+            return memo["digest"]
+        self.hashes[path] = {"stat": stat, "digest": digest(path)}
+        return self.hashes[path]["digest"]
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
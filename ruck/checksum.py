@@ -0,0 +1,86 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import errno
+import hashlib
+import os
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def data_extents(fd, size):
+    """Yield the (offset, length) of the data regions of a sparse file."""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # No data after offset.
+                return
+            # SEEK_DATA is not supported, treat the file as dense.
+            yield (offset, size - offset)
+            return
+        yield (start, end - start)
+        offset = end
+
+
+def file_digest(path):
+    """Return the sha256 of a file, skipping holes in sparse files."""
+    m = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        for offset, length in data_extents(f.fileno(), size):
+            m.update(f"{offset}:{length}".encode())
+            f.seek(offset)
+            while length > 0:
+                chunk = f.read(min(CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                m.update(chunk)
+                length -= len(chunk)
+        m.update(f"{size}".encode())
+    return m.hexdigest()
+
+
+def tree_digest(path):
+    """Return the sha256 of a directory tree."""
+    m = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            entry = os.path.join(root, name)
+            st = os.lstat(entry)
+            m.update(os.path.relpath(entry, path).encode())
+            m.update(f"{st.st_mode:o}".encode())
+            if os.path.islink(entry):
+                m.update(os.readlink(entry).encode())
+            elif os.path.isfile(entry):
+                m.update(file_digest(entry).encode())
+    return m.hexdigest()
+
+
+def stat_key(path):
+    """Return a cheap fingerprint of a file from its metadata."""
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def tree_stat_key(path):
+    """Return a cheap fingerprint of a directory tree from the metadata
+    of its entries.
+    """
+    m = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            entry = os.path.join(root, name)
+            st = os.lstat(entry)
+            m.update(f"{os.path.relpath(entry, path)}:{st.st_mode:o}:"
+                     f"{st.st_size}:{st.st_mtime_ns}:{st.st_ino}\n"
+                     .encode())
+    return m.hexdigest()
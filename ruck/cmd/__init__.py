@@ -10,8 +10,21 @@ import click
 class State:
     def __init__(self):
         self.config = None
+        self.configs = []
         self.workspace = None
 
+        # build options
+        self.no_cache = False
+        self.rebuild_from = None
+        self.jobs = 1
+        self.resume = False
+        self.from_phase = None
+        self.until_phase = None
+        self.trace = None
+        self.stats = None
+        self.architectures = None
+        self.sync_checksum = False
+
         # vm options
         self.name = None
         self.disk = None
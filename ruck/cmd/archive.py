@@ -0,0 +1,111 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+
+import click
+
+from ruck.cmd.options import format_option
+from ruck.cmd.options import level_option
+from ruck.cmd.options import threads_option
+from ruck.cmd import pass_state_context
+
+
+@click.group(
+    help="Work with root filesystem archives.")
+@pass_state_context
+def archive(state):
+    pass
+
+
+@click.command(
+    help="Measure the compression ratio and throughput of a root "
+         "filesystem directory or archive."
+)
+@pass_state_context
+@click.argument("path", type=click.Path(exists=True))
+@format_option
+@level_option
+@threads_option
+def benchmark(state, path, formats, level, threads):
+    from rich import console
+    from rich.table import Table
+
+    from ruck.archive import benchmark
+
+    table = Table(title=f"Compression of {path}")
+    for column in ["Format", "Ratio", "Compress (MiB/s)",
+                   "Decompress (MiB/s)"]:
+        table.add_column(column)
+    mib = 1024 * 1024
+    for (fmt, ratio, compress, decompress) in benchmark(
+            path, formats=list(formats) or None, level=level,
+            threads=threads):
+        table.add_row(fmt, f"{ratio:.2f}", f"{compress / mib:.0f}",
+                      f"{decompress / mib:.0f}")
+    console.Console().print(table)
+
+
+@click.command(
+    name="list",
+    help="List the members of a root filesystem archive."
+)
+@pass_state_context
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def list_members(state, path):
+    from rich import console
+    from rich.table import Table
+
+    from ruck.archive import members
+
+    table = Table(title=f"Members of {path}")
+    for column in ["Mode", "Owner", "Size", "Path"]:
+        table.add_column(column)
+    for entry in members(path):
+        path = entry["path"]
+        if entry.get("linkname"):
+            path = f"{path} -> {entry['linkname']}"
+        table.add_row(f"{entry['mode']:04o}",
+                      f"{entry['uid']}:{entry['gid']}",
+                      str(entry["size"]), path)
+    console.Console().print(table)
+
+
+@click.command(
+    help="Extract a file from a root filesystem archive without "
+         "unpacking the archive."
+)
+@pass_state_context
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.argument("member")
+@click.option(
+    "-o", "--output",
+    type=click.File("wb"),
+    default="-",
+    help="File to write the member to, stdout by default.")
+def extract(state, path, member, output):
+    from ruck.archive import extract
+
+    output.write(extract(path, member))
+
+
+@click.command(
+    help="Compare the members of two root filesystem archives."
+)
+@pass_state_context
+@click.argument("old", type=click.Path(exists=True, dir_okay=False))
+@click.argument("new", type=click.Path(exists=True, dir_okay=False))
+def diff(state, old, new):
+    from ruck.archive import diff
+
+    (added, removed, changed) = diff(old, new)
+    for (sign, paths) in [("+", added), ("-", removed), ("~", changed)]:
+        for path in paths:
+            click.echo(f"{sign} {path}")
+
+
+archive.add_command(benchmark)
+archive.add_command(list_members)
+archive.add_command(extract)
+archive.add_command(diff)
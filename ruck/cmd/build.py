@@ -6,13 +6,35 @@ SPDX-License-Identifier: Apache-2.0
 
 import click
 
-from ruck.build import Build
+from ruck.cmd.options import arch_option
+from ruck.cmd.options import checksum_option
 from ruck.cmd.options import config_option
+from ruck.cmd.options import from_phase_option
+from ruck.cmd.options import jobs_option
+from ruck.cmd.options import no_cache_option
+from ruck.cmd.options import rebuild_from_option
+from ruck.cmd.options import resume_option
+from ruck.cmd.options import stats_option
+from ruck.cmd.options import trace_option
+from ruck.cmd.options import until_phase_option
 from ruck.cmd import pass_state_context
 
 @click.command(
     help="Build Debian artifact from manifest.")
 @pass_state_context
 @config_option
-def build(state, config):
-    Build(state).build()
+@arch_option
+@no_cache_option
+@rebuild_from_option
+@jobs_option
+@resume_option
+@from_phase_option
+@until_phase_option
+@trace_option
+@stats_option
+@checksum_option
+def build(state, config, arch, no_cache, rebuild_from, jobs, resume,
+          from_phase, until_phase, trace, stats, checksum):
+    from ruck.matrix import Matrix
+
+    Matrix(state).build()
@@ -0,0 +1,51 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import time
+
+import click
+
+from ruck.cmd.options import max_size_option
+from ruck.cmd import pass_state_context
+
+
+@click.group(
+    help="Manage the package cache shared by bootstrap phases.")
+@pass_state_context
+def cache(state):
+    pass
+
+
+@click.command(
+    help="Show the size of the package cache."
+)
+@pass_state_context
+def stats(state):
+    from ruck.packages import PackageCache
+
+    s = PackageCache.from_state(state).stats()
+    mib = 1024 * 1024
+    click.echo(f"Packages: {s['packages']}")
+    click.echo(f"Size: {s['size'] / mib:.0f} MiB "
+               f"(limit {s['max_size'] / mib:.0f} MiB)")
+    for key in ["oldest", "newest"]:
+        if s[key] is not None:
+            click.echo(f"{key.capitalize()} use: {time.ctime(s[key])}")
+
+
+@click.command(
+    help="Evict the least recently used packages."
+)
+@pass_state_context
+@max_size_option
+def prune(state, max_size):
+    from ruck.packages import PackageCache
+
+    evicted = PackageCache.from_state(state).prune(max_size=max_size)
+    click.echo(f"Evicted {len(evicted)} package(s).")
+
+
+cache.add_command(stats)
+cache.add_command(prune)
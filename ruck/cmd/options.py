@@ -13,13 +13,29 @@ from ruck.cmd import State
 def config_option(f):
     def callback(ctxt, param, value):
         state = ctxt.ensure_object(State)
-        state.config = pathlib.Path(value)
+        state.configs = [pathlib.Path(v) for v in value]
+        if state.configs:
+            state.config = state.configs[0]
 
         return value
     return click.option(
         "-C", "--config",
-        help="Path to configuration file.",
-        nargs=1,
+        help="Path to configuration file, may be given several times.",
+        multiple=True,
+        required=True,
+        callback=callback
+    )(f)
+
+
+def arch_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.architectures = list(value) or None
+        return value
+    return click.option(
+        "-a", "--arch",
+        help="Architecture to build, may be given several times.",
+        multiple=True,
         callback=callback
     )(f)
 
@@ -39,6 +55,129 @@ def workspace_option(f):
     )(f)
 
 
+def no_cache_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.no_cache = value
+        return value
+    return click.option(
+        "--no-cache",
+        help="Run every phase regardless of the phase cache.",
+        is_flag=True,
+        default=False,
+        callback=callback
+    )(f)
+
+
+def rebuild_from_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.rebuild_from = value
+        return value
+    return click.option(
+        "--rebuild-from",
+        help="Re-run the given phase (number, name or stage) and "
+             "every phase after it.",
+        nargs=1,
+        callback=callback
+    )(f)
+
+
+def jobs_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.jobs = value
+        return value
+    return click.option(
+        "-j", "--jobs",
+        help="Number of independent phases to run concurrently.",
+        type=click.IntRange(min=1),
+        default=1,
+        callback=callback
+    )(f)
+
+
+def resume_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.resume = value
+        return value
+    return click.option(
+        "--resume",
+        help="Continue from the first phase that did not complete.",
+        is_flag=True,
+        default=False,
+        callback=callback
+    )(f)
+
+
+def from_phase_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.from_phase = value
+        return value
+    return click.option(
+        "--from-phase",
+        help="First phase (number, name or stage) to run.",
+        nargs=1,
+        callback=callback
+    )(f)
+
+
+def until_phase_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.until_phase = value
+        return value
+    return click.option(
+        "--until-phase",
+        help="Last phase (number, name or stage) to run.",
+        nargs=1,
+        callback=callback
+    )(f)
+
+
+def trace_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.trace = value
+        return value
+    return click.option(
+        "--trace",
+        help="Write a Chrome trace event timeline of the build to a file.",
+        nargs=1,
+        callback=callback
+    )(f)
+
+
+def stats_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.stats = value
+        return value
+    return click.option(
+        "--stats",
+        help="Write the resource usage of every command to a JSON file.",
+        nargs=1,
+        callback=callback
+    )(f)
+
+
+def checksum_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.sync_checksum = value
+        return value
+    return click.option(
+        "--checksum",
+        help="Compare configuration files by content when syncing them "
+             "to the workspace.",
+        is_flag=True,
+        default=False,
+        callback=callback
+    )(f)
+
+
 """ Virtual machine options. """
 
 
@@ -68,3 +207,42 @@ def disk_option(f):
         required=True,
         callback=callback
     )(f)
+
+
+def max_size_option(f):
+    def callback(ctxt, param, value):
+        # The size is given in MiB.
+        if value is not None:
+            value = value * 1024 * 1024
+        return value
+    return click.option(
+        "--max-size",
+        help="Size in MiB to shrink the package cache to.",
+        type=click.IntRange(min=0),
+        callback=callback
+    )(f)
+
+
+def format_option(f):
+    return click.option(
+        "--format", "formats",
+        help="Compression format to measure, may be given several times.",
+        multiple=True,
+        type=click.Choice(["zstd", "xz", "lz4", "gzip"])
+    )(f)
+
+
+def level_option(f):
+    return click.option(
+        "--level",
+        help="Compression level.",
+        type=click.IntRange(min=0)
+    )(f)
+
+
+def threads_option(f):
+    return click.option(
+        "--threads",
+        help="Compression threads, 0 for one per CPU.",
+        type=click.IntRange(min=0)
+    )(f)
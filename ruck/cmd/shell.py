@@ -4,18 +4,51 @@ Copyright (c) 2024 Wind River Systems, Inc.
 SPDX-License-Identifier: Apache-2.0
 
 """
+import importlib
 
 import click
 
-from ruck.cmd.build import build
-from ruck.cmd.init import init
 from ruck.cmd.options import workspace_option
 from ruck.cmd import pass_state_context
-from ruck.cmd.vm import vm
 from ruck.log import setup_log
 
 
+class LazyGroup(click.Group):
+    """Group that imports its sub-commands only when they are invoked."""
+
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Map of command name to "module:attribute".
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        commands = super().list_commands(ctx)
+        return sorted(set(commands) | set(self.lazy_subcommands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_subcommands:
+            return self._load(cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def _load(self, cmd_name):
+        module, attribute = self.lazy_subcommands[cmd_name].split(":")
+        command = getattr(importlib.import_module(module), attribute)
+        if not isinstance(command, click.Command):
+            raise ValueError(
+                f"{self.lazy_subcommands[cmd_name]} is not a click command.")
+        return command
+
+
+# ruck sub-commands
 @click.group(
+    cls=LazyGroup,
+    lazy_subcommands={
+        "archive": "ruck.cmd.archive:archive",
+        "build": "ruck.cmd.build:build",
+        "cache": "ruck.cmd.cache:cache",
+        "init": "ruck.cmd.init:init",
+        "vm": "ruck.cmd.vm:vm",
+    },
     help="Debian build system."
 )
 @pass_state_context
@@ -26,9 +59,3 @@ def cli(state, workspace):
 
 def main():
     cli(prog_name="ruck")
-
-
-# ruck sub-commands
-cli.add_command(build)
-cli.add_command(init)
-cli.add_command(vm)
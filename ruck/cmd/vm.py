@@ -9,7 +9,6 @@ import click
 from ruck.cmd.options import disk_option
 from ruck.cmd.options import name_option
 from ruck.cmd import pass_state_context
-from ruck.vm import VM
 
 
 @click.group(
@@ -24,6 +23,8 @@ def vm(state):
 )
 @pass_state_context
 def show(state):
+    from ruck.vm import VM
+
     VM(state).list()
 
 
@@ -34,6 +35,8 @@ def show(state):
 @name_option
 @disk_option
 def create(state, name, disk):
+    from ruck.vm import VM
+
     VM(state).create()
 
 
@@ -43,6 +46,8 @@ def create(state, name, disk):
 @pass_state_context
 @name_option
 def shutdown(state, name):
+    from ruck.vm import VM
+
     VM(state).shutdown()
 
 
@@ -3,30 +3,68 @@ Copyright (c) 2024 Wind River Systems, Inc.
 
 SPDX-License-Identifier: Apache-2.0
 """
+import hashlib
+import json
+import logging
 import os
+import threading
 
 from omegaconf import OmegaConf
 import yaml
 
 from ruck import exceptions
 
+# Bump when the way manifests are loaded changes.
+CACHE_VERSION = 1
+
 
 def get_config(config, subkey):
     return OmegaConf.select(
         config, subkey, throw_on_missing=False)
 
 
-def include_constructor(loader, node):
-    filename = node.value
-    if not os.path.isfile(filename) or filename.split(".")[-1] != "yaml":
-        # (FIXME) chuck - better error message here
-        raise exceptions.ConfigError("Not valid yaml.")
+class ManifestLoader(yaml.SafeLoader):
+    """Load a manifest, keeping track of the files it includes."""
+
+    def __init__(self, stream, path=None, dependencies=None, stack=()):
+        super().__init__(stream)
+        self.path = path
+        self.dependencies = dependencies if dependencies is not None \
+            else {}
+        # Files being loaded, to detect recursive includes.
+        self.stack = stack + (path,)
+
+
+def load_yaml(path, dependencies, stack=()):
+    """Load a yaml file.
+
+    The sha256 of the file and of the files it includes are added to
+    the dependencies dictionary.
+    """
+    path = os.path.abspath(path)
+    if path in stack:
+        raise exceptions.ConfigError(f"{path} includes itself.")
+    with open(path, "rb") as f:
+        content = f.read()
+    dependencies[path] = hashlib.sha256(content).hexdigest()
+    loader = ManifestLoader(content.decode("utf-8"), path, dependencies, stack)
+    try:
+        return loader.get_single_data()
+    finally:
+        loader.dispose()
 
-    with open(filename, "r") as f:
-        return yaml.load(f, Loader=yaml.SafeLoader)
+
+def include_constructor(loader, node):
+    """Load a file relative to the file that includes it."""
+    filename = loader.construct_scalar(node)
+    path = os.path.join(os.path.dirname(loader.path), filename)
+    if not os.path.isfile(path) or filename.split(".")[-1] != "yaml":
+        raise exceptions.ConfigError(
+            f"{filename} included from {loader.path} is not a yaml file.")
+    return load_yaml(path, loader.dependencies, loader.stack)
 
 
-yaml.add_constructor("!include", include_constructor, Loader=yaml.SafeLoader)
+yaml.add_constructor("!include", include_constructor, Loader=ManifestLoader)
 
 
 class Config(object):
@@ -34,16 +72,80 @@ class Config(object):
 
     def __init__(self, state):
         self.state = state
+        self.logging = logging.getLogger(__name__)
+        # Files the manifest was loaded from, and their sha256.
+        self.dependencies = {}
 
     def load_config(self):
         """Load the manifest.yaml"""
+        path = os.path.abspath(self.state.config)
+        data = self._load_cached(path)
+        if data is None:
+            self.dependencies = {}
+            try:
+                data = load_yaml(path, self.dependencies)
+            except (yaml.YAMLError, UnicodeDecodeError) as error:
+                raise exceptions.ConfigError(
+                    f"{self.state.config} failed validateion: {error}.")
+            except OSError:
+                raise exceptions.ConfigError(
+                    f"Configuration not found: {self.state.config}")
+            self._save_cached(path, data)
+        return OmegaConf.create(data)
+
+    def _cache_path(self, path):
+        """Return the cache of the compiled manifest, if enabled."""
+        if self.state.workspace is None or \
+                getattr(self.state, "no_cache", False):
+            return None
+        name = hashlib.sha256(path.encode("utf-8")).hexdigest()
+        return os.path.join(
+            self.state.workspace, ".ruck", "manifests", f"{name}.json")
+
+    def _load_cached(self, path):
+        """Return the compiled manifest if none of its files changed."""
+        cache = self._cache_path(path)
+        if cache is None:
+            return None
+        try:
+            with open(cache, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("version") != CACHE_VERSION or \
+                entry.get("path") != path:
+            return None
+        for dependency, digest in entry["files"].items():
+            try:
+                with open(dependency, "rb") as f:
+                    if hashlib.sha256(f.read()).hexdigest() != digest:
+                        return None
+            except OSError:
+                return None
+        self.logging.debug(f"Using the compiled manifest of {path}.")
+        self.dependencies = dict(entry["files"])
+        return entry["config"]
+
+    def _save_cached(self, path, data):
+        """Store the compiled manifest along with the hashes of its files."""
+        cache = self._cache_path(path)
+        if cache is None:
+            return
         try:
-            with open(self.state.config, "r") as f:
-                try:
-                    return OmegaConf.create(yaml.safe_load(f))
-                except yaml.YAMLError as error:
-                    raise exceptions.ConfigError(
-                        f"{self.state.config} failed validateion: {error}.")
-        except OSError:
-            raise exceptions.ConfigError(
-                f"Configuration not found: {self.state.config}")
+            config = json.loads(json.dumps(data))
+        except (TypeError, ValueError):
+            config = None
+        if config != data:
+            # Values such as dates do not survive a round trip to json.
+            self.logging.debug(f"Not caching {path}.")
+            return
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmp = f"{cache}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "w") as f:
+            json.dump({
+                "version": CACHE_VERSION,
+                "path": path,
+                "files": self.dependencies,
+                "config": data,
+            }, f)
+        os.replace(tmp, cache)
@@ -27,6 +27,16 @@ class CommandNotFoundError(RuckError):
     pass
 
 
+class CommandError(RuckError):
+    """Command failed error."""
+    pass
+
+
 class SchemaError(RuckError):
     """Schema configuration error."""
     pass
+
+
+class JournalError(RuckError):
+    """Build state journal error."""
+    pass
@@ -0,0 +1,412 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import collections
+from concurrent import futures
+import hashlib
+import logging
+import os
+import struct
+import subprocess
+import threading
+import time
+import zlib
+
+from ruck import accounting
+from ruck import archive
+from ruck import checksum
+from ruck import exceptions
+from ruck.log import current_phase
+from ruck import trace
+from ruck import utils
+
+log = logging.getLogger(__name__)
+
+# Export formats and the compression format of their raw streams.
+FORMATS = {
+    "qcow2": None,
+    "raw.zst": "zstd",
+    "raw.xz": "xz",
+}
+
+READ_SIZE = checksum.CHUNK_SIZE
+ZEROS = bytes(READ_SIZE)
+
+CHECKSUM_SUFFIX = ".sha256"
+
+# qcow2 version 3 with 64 KiB clusters and 16-bit refcounts, see
+# docs/interop/qcow2.txt in qemu.
+QCOW2_MAGIC = b"QFI\xfb"
+QCOW2_VERSION = 3
+QCOW2_HEADER_LENGTH = 104
+CLUSTER_BITS = 16
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+REFCOUNT_ORDER = 4
+L2_ENTRIES = CLUSTER_SIZE // 8
+REFCOUNT_ENTRIES = CLUSTER_SIZE * 8 >> REFCOUNT_ORDER
+OFLAG_COPIED = 1 << 63
+OFLAG_COMPRESSED = 1 << 62
+# First bit of the sector count of compressed cluster descriptors.
+CSIZE_SHIFT = 62 - (CLUSTER_BITS - 8)
+SECTOR_SIZE = 512
+ZERO_CLUSTER = bytes(CLUSTER_SIZE)
+
+
+def _align(offset, alignment=CLUSTER_SIZE):
+    return -(-offset // alignment) * alignment
+
+
+def _deflate(data):
+    """Compress a cluster the way qemu-img does, raw deflate with a
+    4 KiB window.
+    """
+    z = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -12)
+    return z.compress(data) + z.flush()
+
+
+class Writer(object):
+    """Output of an export, fed with the content of the source image in
+    order.
+    """
+
+    def __init__(self, path, checksums=True):
+        self.path = str(path)
+        self.sha256 = hashlib.sha256() if checksums else None
+        self.digest = None
+
+    def write(self, offset, data):
+        raise NotImplementedError
+
+    def hole(self, offset, length):
+        """Skip a region of the source reading as zeros."""
+        raise NotImplementedError
+
+    def close(self):
+        """Finish the output and return its sha256, or None without
+        checksums.
+        """
+        raise NotImplementedError
+
+    def abort(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class RawWriter(Writer):
+    """Raw image compressed by an external program.
+
+    The compressed stream is checksummed as it is written.
+    """
+
+    def __init__(self, path, fmt, level=None, threads=None, checksums=True):
+        super().__init__(path, checksums=checksums)
+        self.argv = archive.compressor(fmt, level=level, threads=threads)
+        self.out = open(self.path, "wb")
+        self.start = time.monotonic()
+        try:
+            self.sp = utils.Popen(
+                self.argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError:
+            self.out.close()
+            raise exceptions.CommandError(
+                f"failed to run cmd: {self.argv[0]}")
+        self.error = None
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def _drain(self):
+        try:
+            for chunk in iter(lambda: self.sp.stdout.read(READ_SIZE), b""):
+                if self.sha256 is not None:
+                    self.sha256.update(chunk)
+                self.out.write(chunk)
+        except BaseException as e:
+            self.error = e
+
+    def write(self, offset, data):
+        try:
+            self.sp.stdin.write(data)
+        except BrokenPipeError:
+            # The compressor exited early, its exit status tells why.
+            pass
+
+    def hole(self, offset, length):
+        while length > 0:
+            n = min(length, READ_SIZE)
+            self.write(offset, ZEROS[:n])
+            offset += n
+            length -= n
+
+    def close(self):
+        try:
+            self.sp.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.sp.wait()
+        self.thread.join()
+        self.out.close()
+        accounting.record(current_phase(), self.argv, self.sp.returncode,
+                          time.monotonic() - self.start, self.sp.rusage)
+        if self.sp.returncode != 0:
+            raise exceptions.CommandError(
+                f"{' '.join(self.argv)} failed with exit status "
+                f"{self.sp.returncode}.")
+        if self.error is not None:
+            raise self.error
+        if self.sha256 is not None:
+            self.digest = self.sha256.hexdigest()
+        return self.digest
+
+    def abort(self):
+        if self.sp.poll() is None:
+            self.sp.kill()
+        self.sp.wait()
+        self.thread.join()
+        self.out.close()
+        super().abort()
+
+
+class Qcow2Writer(Writer):
+    """qcow2 image holding the clusters of the source that are not
+    zeros, optionally compressed.
+
+    The data clusters are written as they come, after the header and
+    the L1 table. The L2 tables and the refcounts follow them once all
+    the clusters are known.
+    """
+
+    def __init__(self, path, size, compress=False, threads=None,
+                 checksums=True):
+        super().__init__(path, checksums=checksums)
+        self.size = size
+        self.compress = compress
+        self.f = open(self.path, "wb")
+
+        self.l1_size = -(-size // (CLUSTER_SIZE * L2_ENTRIES))
+        self.l1_offset = CLUSTER_SIZE
+        self.end = self.l1_offset + _align(max(self.l1_size * 8, 1))
+        # L1 index -> L2 table.
+        self.l2 = {}
+        # Host cluster -> refcount.
+        self.refcounts = collections.Counter()
+        for index in range(self.end // CLUSTER_SIZE):
+            self.refcounts[index] = 1
+
+        # Cluster of the source being filled.
+        self.cluster = None
+        self.buffer = None
+
+        self.workers = threads or os.cpu_count() or 1
+        self.pool = None
+        if compress:
+            self.pool = futures.ThreadPoolExecutor(self.workers)
+        self.pending = collections.deque()
+
+    def write(self, offset, data):
+        view = memoryview(data)
+        while view:
+            (cluster, start) = divmod(offset, CLUSTER_SIZE)
+            if cluster != self.cluster:
+                self._flush()
+                self.cluster = cluster
+                self.buffer = bytearray(CLUSTER_SIZE)
+            n = min(len(view), CLUSTER_SIZE - start)
+            self.buffer[start:start + n] = view[:n]
+            offset += n
+            view = view[n:]
+
+    def hole(self, offset, length):
+        # Clusters not written read as zeros.
+        pass
+
+    def _flush(self):
+        """Queue the current cluster for writing, unless it is zeros."""
+        if self.cluster is None:
+            return
+        (cluster, data) = (self.cluster, bytes(self.buffer))
+        (self.cluster, self.buffer) = (None, None)
+        if data == ZERO_CLUSTER:
+            return
+        if self.pool is None:
+            self._store(cluster, data, None)
+            return
+        self.pending.append(
+            (cluster, data, self.pool.submit(_deflate, data)))
+        # Bound the clusters in flight, and write them in order.
+        while len(self.pending) > self.workers * 4:
+            self._store(*self.pending.popleft())
+
+    def _store(self, cluster, data, compressed):
+        if compressed is not None:
+            compressed = compressed.result()
+        if compressed is not None and len(compressed) < CLUSTER_SIZE:
+            offset = self.end
+            self.f.seek(offset)
+            self.f.write(compressed)
+            self.end += len(compressed)
+            last = self.end - 1
+            for host in range(offset // CLUSTER_SIZE,
+                              last // CLUSTER_SIZE + 1):
+                self.refcounts[host] += 1
+            sectors = last // SECTOR_SIZE - offset // SECTOR_SIZE
+            entry = OFLAG_COMPRESSED | (sectors << CSIZE_SHIFT) | offset
+        else:
+            offset = self.end = _align(self.end)
+            self.f.seek(offset)
+            self.f.write(data)
+            self.end += CLUSTER_SIZE
+            self.refcounts[offset // CLUSTER_SIZE] += 1
+            entry = OFLAG_COPIED | offset
+        (index, slot) = divmod(cluster, L2_ENTRIES)
+        table = self.l2.setdefault(index, [0] * L2_ENTRIES)
+        table[slot] = entry
+
+    def close(self):
+        self._flush()
+        while self.pending:
+            self._store(*self.pending.popleft())
+        if self.pool is not None:
+            self.pool.shutdown()
+
+        # L2 tables.
+        self.end = _align(self.end)
+        l1 = [0] * self.l1_size
+        for index in sorted(self.l2):
+            offset = self.end
+            self.f.seek(offset)
+            self.f.write(struct.pack(f">{L2_ENTRIES}Q", *self.l2[index]))
+            self.refcounts[offset // CLUSTER_SIZE] += 1
+            l1[index] = OFLAG_COPIED | offset
+            self.end += CLUSTER_SIZE
+        self.f.seek(self.l1_offset)
+        self.f.write(struct.pack(f">{self.l1_size}Q", *l1))
+
+        # Refcount table and blocks, which hold their own refcounts.
+        clusters = self.end // CLUSTER_SIZE
+        (blocks, table) = (0, 0)
+        while True:
+            total = clusters + table + blocks
+            needed = -(-total // REFCOUNT_ENTRIES)
+            needed_table = -(-needed * 8 // CLUSTER_SIZE)
+            if (needed, needed_table) == (blocks, table):
+                break
+            (blocks, table) = (needed, needed_table)
+        table_offset = self.end
+        for index in range(clusters, total):
+            self.refcounts[index] = 1
+        entries = []
+        self.f.seek(table_offset + table * CLUSTER_SIZE)
+        for block in range(blocks):
+            entries.append(table_offset + (table + block) * CLUSTER_SIZE)
+            first = block * REFCOUNT_ENTRIES
+            self.f.write(struct.pack(
+                f">{REFCOUNT_ENTRIES}H",
+                *[self.refcounts.get(first + i, 0)
+                  for i in range(REFCOUNT_ENTRIES)]))
+        self.f.seek(table_offset)
+        self.f.write(struct.pack(f">{len(entries)}Q", *entries))
+        self.end = table_offset + (table + blocks) * CLUSTER_SIZE
+
+        self.f.seek(0)
+        self.f.write(self._header(table_offset, table))
+        self.f.write(struct.pack(">II", 0, 0))
+        self.f.truncate(self.end)
+        self.f.close()
+
+        if self.sha256 is None:
+            return None
+        # The header and the L1 table precede the data clusters but are
+        # only known once they are all written, so the image can only be
+        # checksummed once complete.
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(READ_SIZE), b""):
+                self.sha256.update(chunk)
+        self.digest = self.sha256.hexdigest()
+        return self.digest
+
+    def _header(self, refcount_table_offset, refcount_table_clusters):
+        return struct.pack(
+            ">4sIQIIQIIQQIIQQQQII",
+            QCOW2_MAGIC, QCOW2_VERSION,
+            0, 0,  # backing file
+            CLUSTER_BITS, self.size,
+            0,  # encryption
+            self.l1_size, self.l1_offset,
+            refcount_table_offset, refcount_table_clusters,
+            0, 0,  # snapshots
+            0, 0, 0,  # incompatible, compatible and autoclear features
+            REFCOUNT_ORDER, QCOW2_HEADER_LENGTH)
+
+    def abort(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        self.f.close()
+        super().abort()
+
+
+def writer(fmt, path, size, compress=False, level=None, threads=None,
+           checksums=True):
+    """Return the writer of an export format."""
+    if fmt not in FORMATS:
+        raise exceptions.ConfigError(f"{fmt} is not a valid export format.")
+    if fmt == "qcow2":
+        return Qcow2Writer(path, size, compress=compress, threads=threads,
+                           checksums=checksums)
+    return RawWriter(path, FORMATS[fmt], level=level, threads=threads,
+                     checksums=checksums)
+
+
+def export(image, outputs, compress=False, level=None, threads=None,
+           checksums=True):
+    """Convert a raw image into several formats at once.
+
+    outputs maps export formats to their paths. The image is read once,
+    skipping its holes, and fed to a writer per format. Return the
+    sha256 of the outputs by format, or None without checksums.
+    """
+    with open(image, "rb") as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        writers = {}
+        try:
+            for fmt, path in outputs.items():
+                writers[fmt] = writer(fmt, path, size, compress=compress,
+                                      level=level, threads=threads,
+                                      checksums=checksums)
+            with trace.span(f"export {os.path.basename(str(image))}",
+                            formats=list(outputs)):
+                offset = 0
+                for start, length in checksum.data_extents(fd, size):
+                    if start > offset:
+                        for w in writers.values():
+                            w.hole(offset, start - offset)
+                    end = start + length
+                    while start < end:
+                        chunk = os.pread(fd, min(READ_SIZE, end - start),
+                                         start)
+                        if not chunk:
+                            break
+                        for w in writers.values():
+                            w.write(start, chunk)
+                        start += len(chunk)
+                    offset = end
+                if size > offset:
+                    for w in writers.values():
+                        w.hole(offset, size - offset)
+                return {fmt: w.close() for fmt, w in writers.items()}
+        except BaseException:
+            for w in writers.values():
+                try:
+                    w.abort()
+                except Exception:
+                    log.exception(f"Unable to clean up {w.path}.")
+            raise
+
+
+def write_checksum(path, digest):
+    """Write the sha256 of a file in the format of sha256sum."""
+    with open(f"{path}{CHECKSUM_SUFFIX}", "w") as f:
+        f.write(f"{digest}  {os.path.basename(str(path))}\n")
@@ -0,0 +1,326 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import collections
+import re
+import struct
+import uuid
+import zlib
+
+from ruck import exceptions
+
+SECTOR_SIZE = 512
+SIGNATURE = b"EFI PART"
+REVISION = 0x00010000
+HEADER_SIZE = 92
+
+# Partition entries of the table and their size, the table takes 32
+# sectors after the header.
+ENTRIES = 128
+ENTRY_SIZE = 128
+TABLE_SECTORS = ENTRIES * ENTRY_SIZE // SECTOR_SIZE
+
+# Partitions are aligned on 1 MiB like parted does.
+ALIGNMENT = 1024 * 1024
+
+# Namespace of the GUIDs derived from the name of the image.
+NAMESPACE = uuid.UUID("a3c1bb8e-5ec0-4f6e-9a3a-3fbb6c4e2d1a")
+
+# Partition type GUIDs, see the UAPI Discoverable Partitions
+# Specification.
+ESP = uuid.UUID("c12a7328-f81f-11d2-ba4b-00a0c93ec93b")
+XBOOTLDR = uuid.UUID("bc13c2ff-59e6-4262-a352-b275fd6f7172")
+LINUX_DATA = uuid.UUID("0fc63daf-8483-4772-8e79-3d69d8477de4")
+ROOT = {
+    "amd64": uuid.UUID("4f68bce3-e8cd-4db1-96e7-fbcaf984b709"),
+    "arm64": uuid.UUID("b921b045-1df0-41c3-af44-4c6f280d3fae"),
+}
+HOME = uuid.UUID("933ac7e1-2eb4-4f13-b844-0e14e2aef915")
+SRV = uuid.UUID("3b8f8425-20e0-4f3b-907f-1a25a76f98e8")
+VAR = uuid.UUID("4d21b016-b534-45c2-a9fb-5c16e091fd2d")
+SWAP = uuid.UUID("0657fd6d-a4ab-43c4-84e5-0933c84b4f4f")
+BIOS_BOOT = uuid.UUID("21686148-6449-6e6f-744e-656564454649")
+LVM = uuid.UUID("e6d6d379-f507-44c2-a23c-238f2a3df928")
+RAID = uuid.UUID("a19d880f-05fc-4d3b-a006-743f0f84911e")
+MICROSOFT_DATA = uuid.UUID("ebd0a0a2-b9e5-4433-87c0-68b6b72699c7")
+
+# parted flags setting the type of a partition.
+FLAGS = {
+    "boot": ESP,
+    "esp": ESP,
+    "bls_boot": XBOOTLDR,
+    "bios_grub": BIOS_BOOT,
+    "swap": SWAP,
+    "lvm": LVM,
+    "raid": RAID,
+    "msftdata": MICROSOFT_DATA,
+}
+
+# parted flags setting an attribute of a partition.
+ATTRIBUTES = {
+    "legacy_boot": 1 << 2,
+}
+
+# Units of the partition boundaries, as understood by parted.
+UNITS = {
+    "s": SECTOR_SIZE,
+    "B": 1,
+    "kB": 1000,
+    "MB": 1000 ** 2,
+    "GB": 1000 ** 3,
+    "TB": 1000 ** 4,
+    "KiB": 1024,
+    "MiB": 1024 ** 2,
+    "GiB": 1024 ** 3,
+    "TiB": 1024 ** 4,
+}
+
+# Units of the image size, as understood by truncate.
+SIZE_UNITS = {
+    "": 1,
+    "K": 1024, "KiB": 1024, "KB": 1000,
+    "M": 1024 ** 2, "MiB": 1024 ** 2, "MB": 1000 ** 2,
+    "G": 1024 ** 3, "GiB": 1024 ** 3, "GB": 1000 ** 3,
+    "T": 1024 ** 4, "TiB": 1024 ** 4, "TB": 1000 ** 4,
+}
+
+Partition = collections.namedtuple(
+    "Partition",
+    ["number", "type", "uuid", "start", "size", "name", "attributes"],
+    defaults=[0])
+
+
+def read_partitions(image):
+    """Return the partitions of a GPT disk image.
+
+    The start and size of the partitions are in bytes.
+    """
+    with open(image, "rb") as f:
+        f.seek(SECTOR_SIZE)
+        header = f.read(92)
+        if header[:8] != SIGNATURE:
+            raise exceptions.ConfigError(f"{image} has no GPT label.")
+        (entries_lba, count, entry_size) = struct.unpack_from(
+            "<QII", header, 72)
+        f.seek(entries_lba * SECTOR_SIZE)
+        table = f.read(count * entry_size)
+
+    partitions = []
+    for index in range(count):
+        entry = table[index * entry_size:(index + 1) * entry_size]
+        type_guid = uuid.UUID(bytes_le=entry[0:16])
+        if type_guid.int == 0:
+            continue
+        (first, last, attributes) = struct.unpack_from("<QQQ", entry, 32)
+        name = entry[56:128].decode("utf-16-le").rstrip("\0")
+        partitions.append(Partition(
+            number=index + 1,
+            type=type_guid,
+            uuid=uuid.UUID(bytes_le=entry[16:32]),
+            start=first * SECTOR_SIZE,
+            size=(last - first + 1) * SECTOR_SIZE,
+            name=name,
+            attributes=attributes))
+    return partitions
+
+
+def parse_size(value):
+    """Return the size in bytes of an image size such as 10G."""
+    match = re.fullmatch(r"\s*(\d+)\s*([A-Za-z]*)\s*", str(value))
+    if match is None or match.group(2) not in SIZE_UNITS:
+        raise exceptions.ConfigError(f"Invalid image size: {value}.")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def parse_offset(value, size):
+    """Return the offset in bytes of a partition boundary.
+
+    Boundaries are given like to parted: a percentage of the disk, or
+    a number and a unit, MB by default.
+    """
+    match = re.fullmatch(r"\s*(-?[\d.]+)\s*(%|[A-Za-z]*)\s*", str(value))
+    if match is None or match.group(2) not in list(UNITS) + ["%", ""]:
+        raise exceptions.ConfigError(
+            f"Invalid partition boundary: {value}.")
+    number = float(match.group(1))
+    if match.group(2) == "%":
+        offset = int(size * number / 100)
+    else:
+        offset = int(number * UNITS.get(match.group(2), UNITS["MB"]))
+    if offset < 0:
+        # Negative offsets are relative to the end of the disk.
+        offset += size
+    return offset
+
+
+def _align_up(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _align_down(offset, alignment):
+    return offset // alignment * alignment
+
+
+def partition_type(spec):
+    """Return the type GUID and attributes of a partition spec."""
+    attributes = 0
+    type_guid = LINUX_DATA
+    for flag in spec.get("flags") or []:
+        if flag in FLAGS:
+            type_guid = FLAGS[flag]
+        elif flag in ATTRIBUTES:
+            attributes |= ATTRIBUTES[flag]
+        else:
+            raise exceptions.ConfigError(
+                f"Unsupported flag {flag} on partition {spec['name']}.")
+    if spec.get("type"):
+        try:
+            type_guid = uuid.UUID(spec["type"])
+        except ValueError:
+            raise exceptions.ConfigError(
+                f"Invalid type {spec['type']} on partition "
+                f"{spec['name']}.")
+    return (type_guid, attributes)
+
+
+def layout(specs, size, seed="", alignment=ALIGNMENT):
+    """Return the partitions of a disk of size bytes.
+
+    specs are dictionaries with the name, start, end, type and flags of
+    the partitions, like the parted stage. The partitions are aligned
+    and their GUIDs are derived from seed and their name so that the
+    layout is reproducible.
+    """
+    first = (2 + TABLE_SECTORS) * SECTOR_SIZE
+    last = size - (1 + TABLE_SECTORS) * SECTOR_SIZE
+    if len(specs) > ENTRIES:
+        raise exceptions.ConfigError(
+            f"At most {ENTRIES} partitions are supported.")
+    partitions = []
+    for index, spec in enumerate(specs):
+        name = spec["name"]
+        if len(name) > 36:
+            raise exceptions.ConfigError(
+                f"Partition name {name} is longer than 36 characters.")
+        start = _align_up(
+            max(parse_offset(spec["start"], size), first), alignment)
+        end = min(_align_down(parse_offset(spec["end"], size), alignment),
+                  last)
+        if start >= end:
+            raise exceptions.ConfigError(
+                f"Partition {name} does not fit between {spec['start']} "
+                f"and {spec['end']}.")
+        if partitions and start < partitions[-1].start + \
+                partitions[-1].size:
+            raise exceptions.ConfigError(
+                f"Partition {name} overlaps {partitions[-1].name}.")
+        (type_guid, attributes) = partition_type(spec)
+        partitions.append(Partition(
+            number=index + 1,
+            type=type_guid,
+            uuid=uuid.uuid5(NAMESPACE, f"{seed}/{index}/{name}"),
+            start=start,
+            size=(end - start) // SECTOR_SIZE * SECTOR_SIZE,
+            name=name,
+            attributes=attributes))
+    return partitions
+
+
+def _entries(partitions):
+    """Return the partition entries array."""
+    table = bytearray(ENTRIES * ENTRY_SIZE)
+    for p in partitions:
+        offset = (p.number - 1) * ENTRY_SIZE
+        table[offset:offset + 16] = p.type.bytes_le
+        table[offset + 16:offset + 32] = p.uuid.bytes_le
+        struct.pack_into(
+            "<QQQ", table, offset + 32, p.start // SECTOR_SIZE,
+            (p.start + p.size) // SECTOR_SIZE - 1, p.attributes)
+        name = p.name.encode("utf-16-le")
+        table[offset + 56:offset + 56 + len(name)] = name
+    return bytes(table)
+
+
+def _header(current, backup, entries_lba, sectors, disk_guid, table_crc):
+    """Return a GPT header."""
+    header = bytearray(struct.pack(
+        "<8sIIIIQQQQ16sQIII",
+        SIGNATURE, REVISION, HEADER_SIZE, 0, 0,
+        current, backup,
+        2 + TABLE_SECTORS, sectors - 2 - TABLE_SECTORS,
+        disk_guid.bytes_le, entries_lba, ENTRIES, ENTRY_SIZE, table_crc))
+    struct.pack_into("<I", header, 16, zlib.crc32(header))
+    return bytes(header).ljust(SECTOR_SIZE, b"\0")
+
+
+def _protective_mbr(sectors):
+    """Return a protective MBR covering the disk."""
+    mbr = bytearray(SECTOR_SIZE)
+    struct.pack_into(
+        "<B3sB3sII", mbr, 446,
+        0, b"\x00\x02\x00", 0xee, b"\xff\xff\xff",
+        1, min(sectors - 1, 0xffffffff))
+    mbr[510:512] = b"\x55\xaa"
+    return bytes(mbr)
+
+
+def write_table(image, partitions, disk_guid):
+    """Write the protective MBR and the primary and backup GPT of an
+    image, leaving the rest of the image untouched.
+    """
+    with open(image, "r+b") as f:
+        f.seek(0, 2)
+        sectors = f.tell() // SECTOR_SIZE
+        if sectors < 2 * (2 + TABLE_SECTORS):
+            raise exceptions.ConfigError(f"{image} is too small for GPT.")
+        table = _entries(partitions)
+        crc = zlib.crc32(table)
+        backup = sectors - 1
+        f.seek(0)
+        f.write(_protective_mbr(sectors))
+        f.write(_header(1, backup, 2, sectors, disk_guid, crc))
+        f.write(table)
+        f.seek((backup - TABLE_SECTORS) * SECTOR_SIZE)
+        f.write(table)
+        f.write(_header(backup, 1, backup - TABLE_SECTORS, sectors,
+                        disk_guid, crc))
+
+
+def verify(image):
+    """Check the primary and backup GPT of an image agree and are not
+    corrupted, and return the partitions.
+    """
+    with open(image, "rb") as f:
+        f.seek(0, 2)
+        sectors = f.tell() // SECTOR_SIZE
+        tables = []
+        for lba in [1, sectors - 1]:
+            f.seek(lba * SECTOR_SIZE)
+            header = bytearray(f.read(HEADER_SIZE))
+            if header[:8] != SIGNATURE:
+                raise exceptions.ConfigError(
+                    f"{image} has no GPT header at LBA {lba}.")
+            (crc,) = struct.unpack_from("<I", header, 16)
+            struct.pack_into("<I", header, 16, 0)
+            if zlib.crc32(header) != crc:
+                raise exceptions.ConfigError(
+                    f"Invalid GPT header CRC at LBA {lba} of {image}.")
+            (current, entries_lba, count, entry_size, table_crc) = \
+                struct.unpack_from("<Q40xQIII", header, 24)
+            if current != lba:
+                raise exceptions.ConfigError(
+                    f"Misplaced GPT header at LBA {lba} of {image}.")
+            f.seek(entries_lba * SECTOR_SIZE)
+            table = f.read(count * entry_size)
+            if zlib.crc32(table) != table_crc:
+                raise exceptions.ConfigError(
+                    f"Invalid GPT partition entries CRC at LBA {lba} of "
+                    f"{image}.")
+            tables.append((bytes(header[56:72]), table))
+        if tables[0] != tables[1]:
+            raise exceptions.ConfigError(
+                f"The primary and backup GPT of {image} differ.")
+    return read_partitions(image)
@@ -0,0 +1,139 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import json
+import logging
+import os
+import threading
+
+from ruck.cache import artifact_state
+from ruck import checksum
+from ruck import exceptions
+
+
+def output_state(path):
+    """Return the state of an output, its size, modification time and
+    inode for files, which is cheap to compare even for disk images.
+    """
+    state = artifact_state(path)
+    if isinstance(state, list):
+        return checksum.stat_key(path)
+    return state
+
+
+class Journal(object):
+    """Record of the phases completed in a workspace."""
+
+    def __init__(self, workspace):
+        self.path = workspace.joinpath(".ruck", "journal.json")
+        self.logging = logging.getLogger(__name__)
+
+        self.phases = self._load().get("phases", {})
+        self._lock = threading.Lock()
+
+    def start(self, index):
+        """Mark a phase as incomplete."""
+        with self._lock:
+            self.phases.pop(str(index), None)
+            self.save()
+
+    def complete(self, index, phase, stage, key):
+        """Record a completed phase and the state of its outputs."""
+        outputs = {path: {"state": output_state(path)}
+                   for path in map(str, stage.outputs())}
+
+        with self._lock:
+            self.phases[str(index)] = {
+                "key": key,
+                "name": phase.name,
+                "stage": phase.stage,
+                "outputs": outputs,
+            }
+            self.save()
+
+    def refresh(self, path):
+        """Record the state of an artifact changed after its last writer
+        completed, such as an image unmounted after the phase.
+        """
+        path = str(path)
+        with self._lock:
+            writers = [index for index, entry in self.phases.items()
+                       if path in entry["outputs"]]
+            if not writers:
+                return
+            self.phases[max(writers, key=int)]["outputs"][path] = {
+                "state": output_state(path),
+            }
+            self.save()
+
+    def completed(self, index, key):
+        """Check if a phase completed with the same configuration."""
+        entry = self.phases.get(str(index))
+        return entry is not None and entry["key"] == key
+
+    def first_incomplete(self, keys):
+        """Return the index of the first phase left to run."""
+        for index, key in enumerate(keys):
+            if not self.completed(index, key):
+                return index
+        return len(keys)
+
+    def verify(self, stages, keys, start, end):
+        """Verify the artifacts a slice of the build needs from upstream."""
+        errors = []
+        written = set()
+        for phase, stage in stages[start:end]:
+            written.update(map(str, stage.outputs()))
+
+        for index in range(start, end):
+            phase, stage = stages[index]
+            for path in map(str, stage.inputs()):
+                producer = None
+                for prev in range(index):
+                    if path in map(str, stages[prev][1].outputs()):
+                        producer = prev
+                if producer is None or producer >= start:
+                    continue
+
+                if not self.completed(producer, keys[producer]):
+                    errors.append(
+                        f"{stages[producer][0].name} has not completed, "
+                        f"{path} is not available.")
+                    continue
+                record = self.phases[str(producer)]["outputs"][path]
+                if not os.path.exists(path):
+                    errors.append(f"{path} is missing.")
+                elif output_state(path) == record["state"]:
+                    continue
+                elif path in written:
+                    # The slice modifies the artifact itself, for
+                    # instance an image after a failed phase.
+                    self.logging.warning(
+                        f"{path} was modified since "
+                        f"{stages[producer][0].name} completed.")
+                elif record.get("sha256") is None or \
+                        checksum.file_digest(path) != record["sha256"]:
+                    # Journals written by earlier versions hold the
+                    # hash of the outputs.
+                    errors.append(
+                        f"{path} does not match the output of "
+                        f"{stages[producer][0].name}.")
+
+        if errors:
+            raise exceptions.JournalError(
+                "Unable to run the requested phases: " + " ".join(errors))
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump({"phases": self.phases}, f, indent=2)
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
@@ -4,13 +4,47 @@ Copyright (c) 2023 Wind River Systems, Inc.
 SPDX-License-Identifier: Apache-2.0
 """
 
+import contextlib
 import logging
+import threading
 
-from rich.console import Console
-from rich.logging import RichHandler
+_context = threading.local()
+
+
+def current_phase():
+    """Return the name of the phase run by this thread."""
+    return getattr(_context, "phase", None)
+
+
+def current_prefix():
+    """Return the log prefix of the phase run by this thread."""
+    return getattr(_context, "prefix", None)
+
+
+@contextlib.contextmanager
+def phase_context(phase, prefix=None):
+    """Track the phase run by this thread and prefix its log messages."""
+    _context.phase = phase
+    _context.prefix = prefix
+    try:
+        yield
+    finally:
+        _context.phase = None
+        _context.prefix = None
+
+
+class PhaseFilter(logging.Filter):
+    def filter(self, record):
+        prefix = current_prefix()
+        if prefix is not None:
+            record.msg = f"[{prefix}] {record.msg}"
+        return True
 
 
 def setup_log(debug=False):
+    from rich.console import Console
+    from rich.logging import RichHandler
+
     level = logging.DEBUG if debug else logging.INFO
     fmt = "%(asctime)s %(message)s"
 
@@ -25,6 +59,7 @@ def setup_log(debug=False):
                                console=console)
     rich_handler.setLevel(level)
     rich_handler.setFormatter(logging.Formatter(fmt))
+    rich_handler.addFilter(PhaseFilter())
     rootLogger.addHandler(rich_handler)
 
     return rootLogger
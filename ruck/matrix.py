@@ -0,0 +1,121 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+from concurrent import futures
+import contextlib
+import copy
+import logging
+import pathlib
+import threading
+
+from omegaconf import OmegaConf
+
+from ruck.build import ARCHITECTURES
+from ruck.build import Build
+from ruck.build import session
+from ruck.config import Config
+from ruck import exceptions
+from ruck import schema
+
+
+class SharedPhases(object):
+    """Phases that ran once on behalf of every variant of a build."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._workspaces = {}
+
+    @contextlib.contextmanager
+    def claim(self, key):
+        """Hold a phase and return the workspace it already ran in."""
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            yield self._workspaces.get(key)
+
+    def register(self, key, workspace):
+        self._workspaces[key] = workspace
+
+
+class Matrix(object):
+    """Build several manifests and architectures concurrently."""
+
+    def __init__(self, state):
+        self.state = state
+        self.logging = logging.getLogger(__name__)
+
+    def variants(self):
+        """Expand the manifests into (label, state, overrides) variants."""
+        variants = []
+        for path in self.state.configs:
+            state = copy.copy(self.state)
+            state.config = pathlib.Path(path)
+            config = Config(state).load_config()
+            if config.get("name") is None:
+                # Variants are named after the manifest.
+                raise exceptions.SchemaError(
+                    "Invalid manifest:\n" + "\n".join(
+                        schema.manifest_errors(
+                            OmegaConf.to_container(config))))
+            matrix = config.get("matrix") or {}
+
+            architectures = list(self.state.architectures
+                                 or matrix.get("architecture")
+                                 or [config.get("architecture")])
+            for arch in architectures:
+                if arch is not None and arch not in ARCHITECTURES:
+                    raise exceptions.ConfigError(f"{arch} is not supported.")
+            params = list(matrix.get("params") or [{}])
+
+            for arch in architectures:
+                for index, extra in enumerate(params):
+                    name = config.name
+                    if len(architectures) > 1:
+                        name = f"{name}-{arch}"
+                    if len(params) > 1:
+                        name = f"{name}-{index + 1}"
+                    overrides = {"name": name}
+                    if arch is not None:
+                        overrides["architecture"] = arch
+                    if extra:
+                        overrides["params"] = OmegaConf.to_container(extra)
+                    variants.append((name, state, overrides))
+
+        labels = [label for label, state, overrides in variants]
+        if len(set(labels)) != len(labels):
+            raise exceptions.ConfigError(
+                f"Variants do not have unique names: {', '.join(labels)}")
+        return variants
+
+    def build(self):
+        """Build every variant, running at most --jobs phases at once."""
+        variants = self.variants()
+        if len(variants) == 1:
+            label, state, overrides = variants[0]
+            return Build(state, overrides=overrides).build()
+
+        self.logging.info(
+            f"Building {len(variants)} variants: "
+            f"{', '.join(label for label, state, overrides in variants)}.")
+        slots = threading.BoundedSemaphore(self.state.jobs)
+        shared = SharedPhases()
+        with session(self.state), \
+                futures.ThreadPoolExecutor(len(variants)) as pool:
+            builds = [
+                pool.submit(Build(state, overrides=overrides, label=label,
+                                  slots=slots, shared=shared).run)
+                for label, state, overrides in variants]
+            errors = []
+            for future, (label, state, overrides) in zip(builds, variants):
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logging.error(f"{label} failed: {e}")
+                    errors.append(label)
+            if errors:
+                raise exceptions.RuckError(
+                    f"Failed to build: {', '.join(errors)}.")
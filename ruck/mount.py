@@ -4,6 +4,11 @@ Copyright (c) 2024 Wind River Systems, Inc.
 SPDX-License-Identifier: Apache-2.0
 
 """
+import contextlib
+import json
+import logging
+import os
+import threading
 
 from ruck import utils
 
@@ -16,3 +21,176 @@ def mount(image, rootfs):
 def umount(rootfs):
     utils.run_command(
         ["systemd-dissect", "-U", rootfs])
+
+
+def losetup(image):
+    """Attach an image to a loop device, scanning its partitions."""
+    (out, err) = utils.run_command(
+        ["losetup", "-P", "--find", "--show", image], capture=True)
+    return out.strip()
+
+
+def detach(loop):
+    utils.run_command(["losetup", "-d", loop])
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MountManager(object):
+    """Mounts and loop devices of the images of a build.
+
+    A mount outlives the phase that requested it so that the next phase
+    working on the same image reuses it. Mounts are torn down when a
+    phase fails, when a phase touches the image or its mount point
+    without mounting it, and at the end of the build.
+
+    The mounts and loop devices are recorded in a registry so that the
+    ones leaked by a crashed build are cleaned up by the next one.
+    """
+
+    def __init__(self, registry=None, keep=True, on_release=None):
+        self.registry = registry
+        # Keep the mounts once the phase is done.
+        self.keep = keep
+        # Called with the image once unmounted.
+        self.on_release = on_release
+        # Mount point -> image.
+        self.mounts = {}
+        # Loop device -> image.
+        self.loops = {}
+        self.lock = threading.RLock()
+        self.logging = logging.getLogger(__name__)
+
+    @contextlib.contextmanager
+    def mount(self, image, rootfs):
+        """Mount an image on rootfs for the duration of a phase."""
+        (image, rootfs) = (str(image), str(rootfs))
+        with self.lock:
+            if self.mounts.get(rootfs) == image and os.path.ismount(rootfs):
+                self.logging.info(f"Reusing the mount of {image}.")
+            else:
+                if rootfs in self.mounts:
+                    self._umount(rootfs)
+                for path in [p for p, i in self.mounts.items() if i == image]:
+                    self._umount(path)
+                os.makedirs(rootfs, exist_ok=True)
+                self.logging.info(f"Mounting {image} on {rootfs}.")
+                mount(image, rootfs)
+                self.mounts[rootfs] = image
+                self._save()
+        try:
+            yield rootfs
+        except BaseException:
+            self.release([rootfs])
+            raise
+        if not self.keep:
+            self.release([rootfs])
+
+    @contextlib.contextmanager
+    def loop(self, image):
+        """Attach an image to a loop device for the duration of a step."""
+        image = str(image)
+        with self.lock:
+            # The mounts of the image hold loop devices on it too.
+            self.release([image])
+            loop = losetup(image)
+            self.loops[loop] = image
+            self._save()
+        try:
+            yield loop
+        finally:
+            with self.lock:
+                detach(loop)
+                del self.loops[loop]
+                self._save()
+
+    def release(self, paths):
+        """Unmount the images and the mount points among paths."""
+        paths = set(map(str, paths))
+        with self.lock:
+            for rootfs, image in list(self.mounts.items()):
+                if rootfs in paths or image in paths:
+                    self._umount(rootfs)
+
+    def settle(self, stage):
+        """Release the mounts a phase is about to work on directly.
+
+        Stages with MOUNTS set mount the images they work on through
+        the manager, which reuses the mounts.
+        """
+        if stage.MOUNTS:
+            return
+        self.release([*stage.inputs(), *stage.outputs(), *stage.scratch()])
+
+    def close(self):
+        """Unmount everything, at the end of the build."""
+        with self.lock:
+            for rootfs in list(self.mounts):
+                self._umount(rootfs)
+            for loop in list(self.loops):
+                detach(loop)
+                del self.loops[loop]
+            self._save()
+
+    def recover(self):
+        """Clean up the mounts and loop devices of crashed builds."""
+        if self.registry is None:
+            return
+        try:
+            with open(self.registry, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        pid = entries.get("pid")
+        if pid and pid != os.getpid() and _alive(pid):
+            # The build is still running.
+            return
+        for rootfs, image in entries.get("mounts", {}).items():
+            if os.path.ismount(rootfs):
+                self.logging.warning(f"Unmounting leaked mount {rootfs}.")
+                utils.run_command(
+                    ["systemd-dissect", "-U", rootfs], check=False)
+        for loop, image in entries.get("loops", {}).items():
+            (out, err) = utils.run_command(
+                ["losetup", "--noheadings", "--output", "BACK-FILE",
+                 "--list", loop], capture=True, check=False)
+            if (out or "").strip() == image:
+                self.logging.warning(f"Detaching leaked {loop}.")
+                utils.run_command(["losetup", "-d", loop], check=False)
+        os.unlink(self.registry)
+
+    def _umount(self, rootfs):
+        self.logging.info(f"Umounting {rootfs}.")
+        image = self.mounts[rootfs]
+        try:
+            umount(rootfs)
+        finally:
+            del self.mounts[rootfs]
+            self._save()
+        if self.on_release is not None:
+            self.on_release(image)
+
+    def _save(self):
+        if self.registry is None:
+            return
+        if not self.mounts and not self.loops:
+            if os.path.exists(self.registry):
+                os.unlink(self.registry)
+            return
+        os.makedirs(os.path.dirname(self.registry), exist_ok=True)
+        tmp = f"{self.registry}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "pid": os.getpid(),
+                "mounts": self.mounts,
+                "loops": self.loops,
+            }, f, indent=2)
+        os.replace(tmp, self.registry)
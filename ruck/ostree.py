@@ -0,0 +1,385 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import copy
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import stat
+import tarfile
+import tempfile
+
+from ruck import archive
+from ruck import exceptions
+from ruck import utils
+
+# Files of the root filesystem not shipped in ostree commits.
+CRUFT = ["boot/initrd.img", "boot/vmlinuz",
+         "initrd.img", "initrd.img.old",
+         "vmlinuz", "vmlinuz.old"]
+
+# Directories of the root filesystem replaced by symlinks into /var,
+# /run and /sysroot.
+TOPLEVEL_LINKS = {
+    "media": "run/media",
+    "mnt": "var/mnt",
+    "opt": "var/opt",
+    "ostree": "sysroot/ostree",
+    "root": "var/roothome",
+    "srv": "var/srv",
+    "usr/local": "../var/usrlocal",
+}
+
+# Mount points ostree expects at the top of the deployments.
+TOPLEVEL_DIRS = ["sysroot", "efi"]
+
+# Where ostree looks for the kernel and the content of /boot.
+OSTREE_BOOT = "usr/lib/ostree-boot"
+
+# Kernels and initramfs bigger than this are spooled to disk.
+SPOOL_SIZE = 64 * 1024 * 1024
+
+READ_SIZE = 1024 * 1024
+
+# Bump when the layout of the commit cache changes.
+CACHE_VERSION = 1
+
+
+def _path(name):
+    """Return the path of a member without its leading ./ or /."""
+    name = name.lstrip("/")
+    while name.startswith("./"):
+        name = name[2:]
+    return name.rstrip("/")
+
+
+def _boot_kind(path):
+    """Return whether a path is the kernel or the initramfs of /boot,
+    or None.
+    """
+    (directory, _, name) = path.partition("/")
+    if directory != "boot" or not name or "/" in name:
+        return None
+    if name.startswith("vmlinuz"):
+        return "vmlinuz"
+    elif name.startswith("initrd.img") or name.startswith("initramfs"):
+        return "initrd"
+    return None
+
+
+def relocate(path):
+    """Return where a path of the root filesystem goes in the ostree
+    tree, or None if it is not committed.
+    """
+    if path in CRUFT:
+        return None
+    for link in TOPLEVEL_LINKS:
+        if path == link or path.startswith(f"{link}/"):
+            return None
+    if path == "etc" or path.startswith("etc/"):
+        return f"usr/{path}"
+    if path.startswith("boot/") and \
+            not path.split("/")[1].startswith("dtbs"):
+        return f"{OSTREE_BOOT}{path[len('boot'):]}"
+    return path
+
+
+def transform(tin):
+    """Yield the members of an ostree tree and their content from the
+    members of a root filesystem.
+
+    This is the tar equivalent of moving /etc to /usr/etc, moving the
+    content of /boot to /usr/lib/ostree-boot, naming the kernel and
+    initramfs after their checksum and replacing TOPLEVEL_LINKS with
+    symlinks, without unpacking the root filesystem.
+    """
+    seen = set()
+    boot = {}
+    template = None
+    for member in tin:
+        path = _path(member.name)
+        kind = _boot_kind(path)
+        if kind is not None and path not in CRUFT:
+            if kind in boot:
+                raise exceptions.ConfigError(
+                    f"More than one {kind} found in /boot.")
+            spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+            data = tin.extractfile(member)
+            if data is not None:
+                shutil.copyfileobj(data, spool, READ_SIZE)
+            spool.seek(0)
+            boot[kind] = (member, spool)
+            continue
+
+        target = relocate(path) if path else path
+        if target is None:
+            continue
+        if member.islnk():
+            linkname = relocate(_path(member.linkname))
+            if linkname is None:
+                continue
+            member.linkname = linkname
+        member.name = target or "."
+        if path == "":
+            template = member
+        yield (member, tin.extractfile(member) if member.isreg() else None)
+        seen.add(target)
+        if path == "boot":
+            # /usr/lib/ostree-boot takes over /boot.
+            directory = copy.copy(member)
+            directory.name = OSTREE_BOOT
+            yield (directory, None)
+            seen.add(OSTREE_BOOT)
+
+    if "vmlinuz" not in boot:
+        raise exceptions.ConfigError("No kernel found in /boot.")
+    m = hashlib.sha256()
+    for kind in ["vmlinuz", "initrd"]:
+        if kind in boot:
+            (member, spool) = boot[kind]
+            for chunk in iter(lambda: spool.read(READ_SIZE), b""):
+                m.update(chunk)
+            spool.seek(0)
+    csum = m.hexdigest()
+    for kind in ["vmlinuz", "initrd"]:
+        if kind not in boot:
+            continue
+        (member, spool) = boot[kind]
+        name = posixpath.basename(_path(member.name))
+        if kind == "initrd":
+            name = name.replace("initrd.img", "initramfs")
+        member.name = f"{OSTREE_BOOT}/{name}-{csum}"
+        with spool:
+            yield (member, spool)
+
+    for name in TOPLEVEL_DIRS:
+        if name in seen:
+            continue
+        directory = _tarinfo(template, name, tarfile.DIRTYPE)
+        directory.mode = 0o755
+        yield (directory, None)
+    for name, link in TOPLEVEL_LINKS.items():
+        symlink = _tarinfo(template, name, tarfile.SYMTYPE)
+        symlink.linkname = link
+        symlink.mode = 0o777
+        yield (symlink, None)
+
+
+def convert(src, dst):
+    """Convert the tar stream of a root filesystem into an ostree tree."""
+    with tarfile.open(fileobj=src, mode="r|") as tin, \
+            tarfile.open(fileobj=dst, mode="w|",
+                         format=tarfile.PAX_FORMAT) as tout:
+        for member, data in transform(tin):
+            tout.addfile(member, data)
+
+
+def _tarinfo(template, name, type):
+    """Return a root owned member."""
+    info = tarfile.TarInfo(name)
+    info.type = type
+    if template is not None:
+        info.mtime = template.mtime
+    return info
+
+
+def rev_parse(repo, ref):
+    """Return the commit a ref points to, or None if it does not exist."""
+    (out, err) = utils.run_command(
+        ["ostree", "rev-parse", f"--repo={repo}", ref],
+        capture=True, check=False)
+    commit = (out or "").strip()
+    return commit if re.fullmatch("[0-9a-f]{64}", commit) else None
+
+
+def history(repo, ref, depth=None):
+    """Return the commits of a ref, newest first.
+
+    depth is the number of parent commits to return at most.
+    """
+    (out, err) = utils.run_command(
+        ["ostree", "log", f"--repo={repo}", ref],
+        capture=True, check=False)
+    commits = re.findall("^commit ([0-9a-f]{64})$", out or "", re.MULTILINE)
+    return commits if depth is None else commits[:depth + 1]
+
+
+def static_deltas(repo):
+    """Return the names of the static deltas of a repository."""
+    (out, err) = utils.run_command(
+        ["ostree", "static-delta", "list", f"--repo={repo}"],
+        capture=True, check=False)
+    return set(line.strip() for line in (out or "").splitlines())
+
+
+def delta_name(from_commit, to_commit):
+    """Return the name of the static delta between two commits,
+    from_commit being None for deltas from scratch.
+    """
+    if from_commit is None:
+        return to_commit
+    return f"{from_commit}-{to_commit}"
+
+
+class CommitCache(object):
+    """Checkout of the last tree committed to a branch.
+
+    The checkout is made of hardlinks to the objects of a bare
+    repository. It is updated in place with the files that changed in
+    the next root filesystem, so that committing it with
+    --link-checkout-speedup only checksums those files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.repo = os.path.join(path, "repo")
+        self.tree = os.path.join(path, "tree")
+        self.state_path = os.path.join(path, "state.json")
+        self.commit = None
+        self.files = {}
+        self.logging = logging.getLogger(__name__)
+
+    @classmethod
+    def from_state(cls, state, repo, branch):
+        key = hashlib.sha256(
+            f"{os.path.abspath(repo)}:{branch}".encode("utf-8")).hexdigest()
+        return cls(os.path.join(state.workspace, ".ruck", "ostree", key))
+
+    def update(self, tarball, parent):
+        """Update the checkout with a root filesystem tarball and commit
+        it to the cache repository.
+
+        The checkout is only reused if its tree is the one of parent,
+        the head of the branch. Return the commit of the cache
+        repository.
+        """
+        state = self._load()
+        if state is not None and state["target"] == parent and \
+                os.path.isdir(self.tree):
+            old = state["files"]
+        else:
+            self.logging.info("Creating the ostree commit cache.")
+            shutil.rmtree(self.tree, ignore_errors=True)
+            old = {}
+        if not os.path.exists(os.path.join(self.repo, "config")):
+            os.makedirs(self.repo, exist_ok=True)
+            utils.run_command(
+                ["ostree", "init", f"--repo={self.repo}", "--mode=bare"])
+
+        with archive.uncompressed(tarball) as f:
+            (self.files, changed) = self._sync(f, old)
+        self.logging.info(
+            f"{changed} of {len(self.files)} files changed since the last "
+            "commit.")
+
+        (out, err) = utils.run_command(
+            ["ostree", "commit", f"--repo={self.repo}", "--branch=cache",
+             "--link-checkout-speedup", "--subject=cache",
+             f"--tree=dir={self.tree}"], capture=True)
+        self.commit = out.strip()
+
+        # Replace the files written by hardlinks to their objects for
+        # the next commit.
+        checkout = f"{self.tree}.new"
+        shutil.rmtree(checkout, ignore_errors=True)
+        utils.run_command(
+            ["ostree", "checkout", f"--repo={self.repo}", "--hardlink",
+             self.commit, checkout])
+        shutil.rmtree(self.tree)
+        os.rename(checkout, self.tree)
+        utils.run_command(
+            ["ostree", "prune", f"--repo={self.repo}", "--refs-only",
+             "--depth=0"])
+        return self.commit
+
+    def save(self, target):
+        """Record that the checkout holds the tree of target."""
+        tmp = f"{self.state_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "version": CACHE_VERSION,
+                "commit": self.commit,
+                "target": target,
+                "files": self.files,
+            }, f)
+        os.replace(tmp, self.state_path)
+
+    def _load(self):
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get("version") != CACHE_VERSION:
+            return None
+        return state
+
+    def _sync(self, f, old):
+        """Make the checkout match a root filesystem tar stream.
+
+        Files are compared on their tar header, like rsync does on
+        their size and modification time. Return the attributes of the
+        files and the number of files written.
+        """
+        files = {}
+        written = set()
+        with tarfile.open(fileobj=f, mode="r|") as tin:
+            for member, data in transform(tin):
+                attributes = [
+                    archive.TYPES.get(member.type, "other"), member.mode,
+                    member.uid, member.gid, member.size, member.mtime,
+                    member.linkname]
+                files[member.name] = attributes
+                if old.get(member.name) == attributes and \
+                        not (member.islnk() and member.linkname in written):
+                    continue
+                self._write(member, data)
+                written.add(member.name)
+        for name in sorted(set(old) - set(files), reverse=True):
+            path = os.path.join(self.tree, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.unlink(path)
+        return (files, len(written))
+
+    def _write(self, member, data):
+        """Write a member to the checkout, never modifying the files in
+        place as they are objects of the cache repository.
+        """
+        path = os.path.join(self.tree, member.name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            if not member.isdir():
+                shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if member.isdir():
+            os.makedirs(path, exist_ok=True)
+        elif member.isreg():
+            with open(path, "xb") as out:
+                shutil.copyfileobj(data, out, READ_SIZE)
+        elif member.issym():
+            os.symlink(member.linkname, path)
+        elif member.islnk():
+            os.link(os.path.join(self.tree, member.linkname), path)
+            return
+        elif member.ischr() or member.isblk():
+            os.mknod(path,
+                     member.mode | (stat.S_IFCHR if member.ischr()
+                                    else stat.S_IFBLK),
+                     os.makedev(member.devmajor, member.devminor))
+        elif member.isfifo():
+            os.mkfifo(path)
+        if os.geteuid() == 0:
+            os.lchown(path, member.uid, member.gid)
+        if not member.issym():
+            os.chmod(path, member.mode)
@@ -0,0 +1,181 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+# Size of the package cache before the least recently used packages
+# are evicted.
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+# Where apt downloads packages in the root filesystem.
+APT_ARCHIVES = "/var/cache/apt/archives"
+
+# List of the packages installed in the root filesystem, written by a
+# hook next to the harvested packages.
+INSTALLED = "installed"
+
+
+def deb_filename(package, version, architecture):
+    """Return the name apt gives to the .deb of a package."""
+    version = version.replace(":", "%3a")
+    return f"{package}_{version}_{architecture}.deb"
+
+
+class PackageCache(object):
+    """Local .deb cache shared by the bootstrap phases of a workspace.
+
+    The cached packages are copied into the root filesystem before apt
+    downloads anything, and the packages apt downloaded are harvested
+    from the root filesystem afterwards, both through mmdebstrap hooks.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.archives = os.path.join(path, "archives")
+        self.index_path = os.path.join(path, "index.json")
+        self.max_size = max_size
+        self.logging = logging.getLogger(__name__)
+
+    @classmethod
+    def from_state(cls, state, max_size=None):
+        return cls(os.path.join(state.workspace, ".ruck", "packages"),
+                   DEFAULT_MAX_SIZE if max_size is None else max_size)
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=False):
+        """Lock the cache against concurrent harvests and prunes."""
+        os.makedirs(self.archives, exist_ok=True)
+        with open(os.path.join(self.path, "lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def incoming(self):
+        """Return a new directory to harvest the packages of a run into."""
+        path = os.path.join(
+            self.path, "incoming", f"{os.getpid()}-{threading.get_ident()}")
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        return path
+
+    def hooks(self, incoming):
+        """Return the mmdebstrap arguments wiring in the cache."""
+        return [
+            # Keep the cached and the essential packages around for apt
+            # until they are harvested.
+            "--skip=download/empty",
+            "--skip=essential/unlink",
+            f"--setup-hook=mkdir -p \"$1\"{APT_ARCHIVES}/",
+            f"--setup-hook=sync-in {self.archives} {APT_ARCHIVES}/",
+            "--customize-hook=dpkg-query "
+            "--admindir=\"$1\"/var/lib/dpkg --show "
+            "--showformat='${Package} ${Version} ${Architecture}\\n' "
+            f"> {os.path.join(incoming, INSTALLED)} "
+            f"|| rm -f {os.path.join(incoming, INSTALLED)}",
+            f"--customize-hook=sync-out {APT_ARCHIVES} {incoming}",
+        ]
+
+    def harvest(self, incoming):
+        """Move the packages of a run into the cache and evict old ones."""
+        installed = self._installed(incoming)
+        now = time.time()
+        added = 0
+        with self.lock(exclusive=True):
+            index = self._load()
+            for name in os.listdir(incoming):
+                if not name.endswith(".deb"):
+                    continue
+                src = os.path.join(incoming, name)
+                dst = os.path.join(self.archives, name)
+                if name not in index:
+                    os.replace(src, dst)
+                    index[name] = {"size": os.path.getsize(dst), "used": now}
+                    added += 1
+                elif installed is None or name in installed:
+                    index[name]["used"] = now
+            evicted = self._evict(index, self.max_size)
+            self._save(index)
+        shutil.rmtree(incoming, ignore_errors=True)
+        self.logging.info(
+            f"Package cache: {added} package(s) added, "
+            f"{len(evicted)} evicted.")
+        return (added, evicted)
+
+    def prune(self, max_size=None):
+        """Evict the least recently used packages above max_size."""
+        with self.lock(exclusive=True):
+            index = self._load()
+            evicted = self._evict(
+                index, self.max_size if max_size is None else max_size)
+            self._save(index)
+        return evicted
+
+    def stats(self):
+        """Return the number, size and age of the cached packages."""
+        with self.lock():
+            index = self._load()
+        used = [entry["used"] for entry in index.values()]
+        return {
+            "packages": len(index),
+            "size": sum(entry["size"] for entry in index.values()),
+            "max_size": self.max_size,
+            "oldest": min(used) if used else None,
+            "newest": max(used) if used else None,
+        }
+
+    def _evict(self, index, max_size):
+        size = sum(entry["size"] for entry in index.values())
+        evicted = []
+        for name in sorted(index, key=lambda n: index[n]["used"]):
+            if size <= max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.archives, name))
+            except FileNotFoundError:
+                pass
+            size -= index.pop(name)["size"]
+            evicted.append(name)
+        return evicted
+
+    def _installed(self, incoming):
+        """Return the .deb names of the packages installed by the run."""
+        try:
+            with open(os.path.join(incoming, INSTALLED), "r") as f:
+                installed = set(deb_filename(*line.split())
+                                for line in f if len(line.split()) == 3)
+        except OSError:
+            return None
+        return installed or None
+
+    def _load(self):
+        """Load the index, dropping packages removed behind our back."""
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        for name in os.listdir(self.archives):
+            if name.endswith(".deb") and name not in index:
+                st = os.stat(os.path.join(self.archives, name))
+                index[name] = {"size": st.st_size, "used": st.st_mtime}
+        return {name: entry for name, entry in index.items()
+                if os.path.exists(os.path.join(self.archives, name))}
+
+    def _save(self, index):
+        tmp = f"{self.index_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp, self.index_path)
@@ -0,0 +1,135 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import logging
+import os
+
+from ruck import exceptions
+from ruck import gpt
+from ruck import utils
+
+log = logging.getLogger(__name__)
+
+# Directories of the root filesystem held by partitions other than the
+# root partition, by partition type.
+MOUNT_POINTS = {
+    gpt.ESP: "efi",
+    gpt.XBOOTLDR: "boot",
+    gpt.HOME: "home",
+    gpt.SRV: "srv",
+    gpt.VAR: "var",
+}
+
+EXT_FILESYSTEMS = ["ext2", "ext3", "ext4"]
+
+
+def layout(partitions):
+    """Return the (partition, directory) pairs of the partitions to
+    populate, the root partition having an empty directory.
+
+    Without a root partition type, the first Linux data partition
+    holds the root filesystem.
+    """
+    root = [p for p in partitions if p.type in gpt.ROOT.values()] or \
+        [p for p in partitions if p.type == gpt.LINUX_DATA]
+    pairs = []
+    for partition in partitions:
+        if root and partition == root[0]:
+            pairs.append((partition, ""))
+        elif partition.type in MOUNT_POINTS:
+            pairs.append((partition, MOUNT_POINTS[partition.type]))
+    if not root:
+        raise exceptions.ConfigError("No root partition found.")
+    return pairs
+
+
+def probe(image, partition):
+    """Return the TYPE, LABEL and UUID of the filesystem of a partition."""
+    (out, err) = utils.run_command(
+        ["blkid", "--probe", "--output", "export",
+         "--offset", str(partition.start), "--size", str(partition.size),
+         image], capture=True, check=False)
+    info = {}
+    for line in (out or "").splitlines():
+        (key, _, value) = line.partition("=")
+        info[key] = value
+    return info
+
+
+def split(rootfs, mounts, pairs):
+    """Move the content of the mount points out of the root filesystem
+    into the mounts directory.
+
+    Return the (partition, tree) pairs to create the filesystems from.
+    """
+    trees = []
+    for partition, directory in pairs:
+        if not directory:
+            trees.append((partition, rootfs))
+            continue
+        tree = os.path.join(mounts, directory)
+        os.makedirs(tree)
+        source = os.path.join(rootfs, directory)
+        os.makedirs(source, exist_ok=True)
+        for name in os.listdir(source):
+            os.rename(os.path.join(source, name), os.path.join(tree, name))
+        trees.append((partition, tree))
+    return trees
+
+
+def mkfs(image, partition, fs, tree, label=None, uuid=None):
+    """Create a filesystem in a partition of an image from a tree."""
+    log.info(f"Creating {fs} on partition {partition.number} from {tree}.")
+    if fs in EXT_FILESYSTEMS:
+        cmd = [f"mkfs.{fs}", "-F", "-q",
+               "-d", tree,
+               "-E", f"offset={partition.start},nodiscard"]
+        if label:
+            cmd.extend(["-L", label])
+        if uuid:
+            cmd.extend(["-U", uuid])
+        utils.run_command(cmd + [image, f"{partition.size // 1024}k"])
+    elif fs == "vfat":
+        cmd = ["mkfs.vfat", "-F", "32",
+               "--offset", str(partition.start // gpt.SECTOR_SIZE)]
+        if label:
+            cmd.extend(["-n", label])
+        if uuid:
+            cmd.extend(["-i", uuid.replace("-", "")])
+        utils.run_command(cmd + [image, str(partition.size // 1024)])
+        entries = sorted(os.listdir(tree))
+        if entries:
+            utils.run_command(
+                ["mcopy", "-s", "-p", "-Q", "-m",
+                 "-i", f"{image}@@{partition.start}",
+                 *[os.path.join(tree, name) for name in entries], "::/"],
+                env=dict(os.environ, MTOOLS_SKIP_CHECK="1"))
+    else:
+        raise exceptions.ConfigError(
+            f"Unable to populate {fs} filesystems when formatting.")
+
+
+def populate(image, rootfs, mounts):
+    """Format the partitions of an image with the content of a root
+    filesystem tree, without mounting them.
+
+    The content of the other partitions, such as the ESP, is moved
+    out of the tree into the mounts directory. The filesystem type,
+    label and UUID of the existing filesystems are kept.
+    """
+    pairs = layout(gpt.read_partitions(image))
+    filesystems = []
+    for partition, directory in pairs:
+        info = probe(image, partition)
+        fs = info.get("TYPE") or \
+            ("vfat" if partition.type == gpt.ESP else "ext4")
+        filesystems.append(
+            (fs, info.get("LABEL") or partition.name or None,
+             info.get("UUID")))
+
+    trees = split(rootfs, mounts, pairs)
+    for (partition, tree), (fs, label, uuid) in zip(trees, filesystems):
+        mkfs(image, partition, fs, tree, label=label, uuid=uuid)
@@ -0,0 +1,248 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from ruck import archive
+from ruck import checksum
+from ruck import utils
+
+# Size of the root filesystem cache before the least recently used
+# root filesystems are evicted.
+DEFAULT_MAX_SIZE = 20 * 1024 * 1024 * 1024
+
+# Age in seconds after which a cached root filesystem is bootstrapped
+# again, to pick up the updates of the mirror.
+DEFAULT_MAX_AGE = 7 * 86400
+
+
+def archive_format(target):
+    """Return the extension mmdebstrap picks the output format from."""
+    name = os.path.basename(target)
+    index = name.rfind(".tar")
+    if index >= 0:
+        return name[index:]
+    return os.path.splitext(name)[1]
+
+
+class RootfsCache(object):
+    """Base root filesystems shared by the bootstrap phases of a workspace.
+
+    A root filesystem is stored under the key of everything mmdebstrap
+    creates it from, and materialized into the target of later phases
+    with the same key by reflink or hardlink. Root filesystems older than
+    max_age are bootstrapped again, and the least recently used ones are
+    evicted above max_size.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE,
+                 max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.logging = logging.getLogger(__name__)
+
+    @classmethod
+    def from_state(cls, state, max_size=None, max_age=None):
+        return cls(os.path.join(state.workspace, ".ruck", "rootfs"),
+                   DEFAULT_MAX_SIZE if max_size is None else max_size,
+                   DEFAULT_MAX_AGE if max_age is None else max_age)
+
+    def digests(self, workspace, inputs):
+        """Return the digests of the overlays, hook directories and files
+        read from the host, relative to the workspace so that manifests
+        share entries.
+        """
+        digests = []
+        for path in inputs:
+            path = str(path)
+            if os.path.isdir(path):
+                digest = checksum.tree_digest(path)
+            elif os.path.exists(path):
+                digest = checksum.file_digest(path)
+            else:
+                digest = None
+            digests.append([os.path.relpath(path, workspace), digest])
+        return sorted(digests)
+
+    def key(self, options, digests, packages=True):
+        """Return the key of a root filesystem.
+
+        options are the resolved bootstrap options. Without packages,
+        return the key shared by the root filesystems that differ only
+        by their package list.
+        """
+        options = dict(options)
+        target = options.pop("target")
+        for option in ["package_cache", "package_cache_size",
+                       "rootfs_cache", "rootfs_cache_size",
+                       "rootfs_cache_max_age", "incremental",
+                       "incremental_max_changes", "incremental_max_age"]:
+            options.pop(option, None)
+        if not packages:
+            options.pop("packages", None)
+        material = {
+            "options": options,
+            "format": archive_format(target),
+            "inputs": digests,
+        }
+        return hashlib.sha256(
+            json.dumps(material, sort_keys=True).encode()).hexdigest()
+
+    def entry(self, key, target):
+        """Return the path of the stored root filesystem of key."""
+        return os.path.join(self.path, key, f"rootfs{archive_format(target)}")
+
+    def _meta(self, key):
+        try:
+            with open(os.path.join(self.path, key, "meta.json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def closest(self, base, packages, target, max_age):
+        """Find the stored root filesystem with the closest package list.
+
+        Only root filesystems created from the same base key, and
+        bootstrapped less than max_age seconds ago, are considered.
+        Return (key, added, removed) or None.
+        """
+        packages = set(packages)
+        best = None
+        try:
+            keys = os.listdir(self.path)
+        except OSError:
+            return None
+        for key in keys:
+            meta = self._meta(key)
+            if meta is None or meta["base"] != base or \
+                    time.time() - meta["created"] > max_age or \
+                    not os.path.isfile(self.entry(key, target)):
+                continue
+            added = sorted(packages - set(meta["packages"]))
+            removed = sorted(set(meta["packages"]) - packages)
+            if best is None or \
+                    len(added) + len(removed) < len(best[1]) + len(best[2]):
+                best = (key, added, removed)
+        return best
+
+    def created(self, key):
+        """Return when the root filesystem of key was bootstrapped."""
+        meta = self._meta(key)
+        return meta["created"] if meta else None
+
+    def restore(self, key, target):
+        """Materialize the root filesystem of key, if it was stored."""
+        entry = self.entry(key, target)
+        if not os.path.isfile(entry):
+            return False
+        created = self.created(key)
+        if created is None or time.time() - created > self.max_age:
+            self.logging.info(
+                f"The cached root filesystem {key[:12]} is too old.")
+            self._remove(key)
+            return False
+        if os.path.lexists(target):
+            os.unlink(target)
+        utils.link_file(entry, target)
+        archive.copy_index(entry, target)
+        self._touch(key)
+        return True
+
+    def store(self, key, target, base, packages, created=None):
+        """Keep the root filesystem created under key.
+
+        created is when the packages were downloaded from the mirror,
+        now unless the root filesystem was derived from another one.
+        """
+        entry = self.entry(key, target)
+        if os.path.exists(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = f"{entry}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            utils.link_file(target, tmp)
+            with open(os.path.join(os.path.dirname(entry), "meta.json"),
+                      "w") as f:
+                json.dump({
+                    "base": base,
+                    "packages": sorted(packages),
+                    "created": created or time.time(),
+                }, f, indent=2)
+            os.replace(tmp, entry)
+            archive.copy_index(target, entry)
+        except OSError as e:
+            self.logging.warning(f"Unable to cache {target}: {e}")
+            return
+        finally:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Remove the root filesystems older than max_age, then the
+        least recently used ones until the cache fits in max_size.
+
+        The root filesystem of keep is never evicted. Return the keys
+        of the evicted root filesystems.
+        """
+        try:
+            keys = os.listdir(self.path)
+        except OSError:
+            return []
+        evicted = []
+        entries = []
+        size = self._size(keep) if keep else 0
+        for key in keys:
+            meta = self._meta(key)
+            if meta is None or key == keep:
+                continue
+            if time.time() - meta["created"] > self.max_age:
+                self._remove(key)
+                evicted.append(key)
+                continue
+            try:
+                used = os.stat(
+                    os.path.join(self.path, key, "meta.json")).st_mtime
+            except OSError:
+                continue
+            entries.append((used, key, self._size(key)))
+            size += entries[-1][2]
+        for (used, key, entry_size) in sorted(entries):
+            if size <= self.max_size:
+                break
+            self._remove(key)
+            evicted.append(key)
+            size -= entry_size
+        if evicted:
+            self.logging.info(
+                f"Evicted {len(evicted)} cached root filesystem(s).")
+        return evicted
+
+    def _size(self, key):
+        path = os.path.join(self.path, key)
+        try:
+            return sum(os.lstat(os.path.join(path, name)).st_blocks * 512
+                       for name in os.listdir(path))
+        except OSError:
+            return 0
+
+    def _touch(self, key):
+        """Record the use of a root filesystem for the eviction."""
+        try:
+            os.utime(os.path.join(self.path, key, "meta.json"))
+        except OSError:
+            pass
+
+    def _remove(self, key):
+        self.logging.debug(f"Removing the cached root filesystem {key}.")
+        shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
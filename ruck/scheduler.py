@@ -0,0 +1,84 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+from concurrent import futures
+import logging
+
+
+class Scheduler(object):
+    """Run the phases of a manifest following their dependencies."""
+
+    def __init__(self, stages, jobs=1):
+        self.stages = stages
+        self.jobs = jobs
+        self.logging = logging.getLogger(__name__)
+
+        self.dependencies = self._graph()
+
+    def run(self, func):
+        """Call func with the index of every phase once it is ready."""
+        if self.jobs <= 1:
+            for index in range(len(self.stages)):
+                func(index)
+            return
+
+        pending = list(range(len(self.stages)))
+        done = set()
+        running = {}
+        error = None
+        with futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                if error is None:
+                    for index in list(pending):
+                        if len(running) >= self.jobs:
+                            break
+                        if self.dependencies[index] <= done:
+                            pending.remove(index)
+                            running[pool.submit(func, index)] = index
+                if not running:
+                    break
+
+                finished, _ = futures.wait(
+                    running, return_when=futures.FIRST_COMPLETED)
+                for future in finished:
+                    index = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(index)
+                    except Exception as e:
+                        if error is None:
+                            error = e
+        if error is not None:
+            raise error
+
+    def _graph(self):
+        """Compute the phases each phase has to wait for."""
+        accessed = []
+        written = []
+        for phase, stage in self.stages:
+            scratch = set(map(str, stage.scratch()))
+            outputs = set(map(str, stage.outputs())) | scratch
+            accessed.append(set(map(str, stage.inputs())) | outputs)
+            written.append(outputs)
+
+        dependencies = []
+        for index in range(len(self.stages)):
+            deps = set()
+            for prev in range(index):
+                # Phases that do not declare their artifacts keep the
+                # manifest order.
+                if not accessed[index] or not accessed[prev] or \
+                        written[prev] & accessed[index] or \
+                        accessed[prev] & written[index]:
+                    deps.add(prev)
+            dependencies.append(deps)
+
+        for index, deps in enumerate(dependencies):
+            phase, stage = self.stages[index]
+            self.logging.debug(
+                f"{phase.name} depends on "
+                f"{[self.stages[d][0].name for d in sorted(deps)]}")
+        return dependencies
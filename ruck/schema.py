@@ -4,19 +4,94 @@ Copyright (c) 2024 Wind River Systems, Inc.
 SPDX-License-Identifier: Apache-2.0
 
 """
+import threading
 
 from cerberus import Validator
 
 from ruck.exceptions import SchemaError
 
+MANIFEST_SCHEMA = {
+    "name": {"type": "string", "required": True},
+    "description": {"type": "string"},
+    "architecture": {"type": "string", "required": True},
+    "version": {"type": ["string", "number"], "required": True},
+    "schemaVersion": {"type": "integer", "required": True, "allowed": [1]},
+    "params": {"type": "dict"},
+    "matrix": {
+        "type": "dict",
+        "schema": {
+            "architecture": {"type": "list", "schema": {"type": "string"}},
+            "params": {"type": "list", "schema": {"type": "dict"}},
+        },
+    },
+    "phases": {
+        "type": "list",
+        "required": True,
+        "empty": False,
+        "schema": {"type": "dict"},
+    },
+}
 
-def validate(action, schema):
+STRING_LIST = {"type": "list", "schema": {"type": "string"}}
+
+_lock = threading.Lock()
+_validators = {}
+
+
+def phase_schema(options):
+    """Return the schema of a phase given the schema of its options."""
+    return {
+        "name": {"type": "string", "required": True},
+        "stage": {"type": "string", "required": True},
+        "options": {"type": "dict", "required": True, "schema": options},
+    }
+
+
+def validator(schema, key=None):
+    """Return the validator of a schema and the lock serializing its use.
+
+    The validators of the schemas given a key, such as the SCHEMA of a
+    stage class, are compiled once per key.
+    """
+    if key is None:
+        return (Validator(schema), threading.Lock())
+    with _lock:
+        entry = _validators.get(key)
+        if entry is None:
+            entry = _validators[key] = (Validator(schema), threading.Lock())
+    return entry
+
+
+def errors(action, schema, key=None):
+    """Return the list of errors of the action block."""
+    (v, lock) = validator(schema, key)
+    with lock:
+        if v.validate(action):
+            return []
+        return list(_flatten(v.errors))
+
+
+def manifest_errors(manifest):
+    """Return the list of errors of the top level of a manifest."""
+    return errors(manifest, MANIFEST_SCHEMA, key="manifest")
+
+
+def validate(action, schema, key=None):
     """Validates the action block based on the cerberus schema."""
 
-    v = Validator(schema)
-    status = v.validate(action)
+    (v, lock) = validator(schema, key)
+    with lock:
+        status = v.validate(action)
+        if not status:
+            raise SchemaError("Invalid syntax: {0}".format(v.errors))
+    return status
+
 
-    if not status:
-        raise SchemaError("Invalid syntax: {0}".format(v.errors))
-    else:
-        return status
+def _flatten(errors, path=""):
+    for field, value in errors.items():
+        name = f"{path}.{field}" if path else str(field)
+        for item in value:
+            if isinstance(item, dict):
+                yield from _flatten(item, name)
+            else:
+                yield f"{name}: {item}"
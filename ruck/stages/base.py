@@ -9,8 +9,19 @@ from abc import ABC
 from abc import abstractmethod
 import logging
 
+from ruck.mount import MountManager
+
 
 class Base(ABC):
+    # Cerberus schema of the phase, see ruck.schema.phase_schema.
+    SCHEMA = None
+    # Programs the stage runs on the host.
+    TOOLS = []
+    # Whether the stage mounts the images it works on through mount().
+    MOUNTS = False
+    # Mounts of the build running the phase, set by the build.
+    mount_manager = None
+
     def __init__(self):
         self.workspace = None
         self.rootfs = None
@@ -27,6 +38,30 @@ class Base(ABC):
     def post_install(self):
         pass
 
+    def inputs(self):
+        """Artifacts consumed by the stage."""
+        return []
+
+    def outputs(self):
+        """Artifacts created or modified by the stage."""
+        return []
+
+    def scratch(self):
+        """Working directories used by the stage while it runs."""
+        return []
+
+    def mount(self, image, rootfs):
+        """Mount an image on rootfs for the duration of a step."""
+        if self.mount_manager is None:
+            self.mount_manager = MountManager(keep=False)
+        return self.mount_manager.mount(image, rootfs)
+
+    def loop(self, image):
+        """Attach an image to a loop device for the duration of a step."""
+        if self.mount_manager is None:
+            self.mount_manager = MountManager(keep=False)
+        return self.mount_manager.loop(image)
+
 
 class OstreeBase(Base):
     def __init__(self, state, config, workspace):
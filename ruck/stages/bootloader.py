@@ -8,13 +8,22 @@ SPDX-License-Identifier: Apache-2.0
 import logging
 
 from ruck import exceptions
-from ruck.mount import mount
-from ruck.mount import umount
+from ruck.schema import phase_schema
 from ruck.stages.base import Base
 from ruck import utils
 
+SCHEMA = phase_schema({
+    "type": {"type": "string", "required": True, "allowed": ["sd-boot"]},
+    "image": {"type": "string", "required": True},
+    "kernel_cmdline": {"type": "string", "required": True},
+})
+
 
 class BootloaderPlugin(Base):
+    SCHEMA = SCHEMA
+    TOOLS = ["systemd-dissect", "bwrap"]
+    MOUNTS = True
+
     def __init__(self, state, config, workspace):
         self.state = state
         self.config = config
@@ -49,16 +58,20 @@ class BootloaderPlugin(Base):
     def post_install(self):
         pass
 
+    def inputs(self):
+        return [self.workspace.joinpath(self.config.options.image)]
+
+    def outputs(self):
+        return [self.workspace.joinpath(self.config.options.image)]
+
+    def scratch(self):
+        return [self.rootfs]
+
     def _install_sd_boot(self):
         """Install bootloader via bootctl."""
         self.logging.info("Installing bootloader via bootctl")
 
-        self.logging.info(f"Mounting {self.image} on {self.rootfs}")
-
-        try:
-            self.rootfs.mkdir(parents=True, exist_ok=True)
-            mount(self.image, self.rootfs)
-
+        with self.mount(self.image, self.rootfs):
             self.logging.info("Installing bootloader")
             utils.run_chroot_command(
                 ["bootctl", "install",
@@ -68,14 +81,11 @@ class BootloaderPlugin(Base):
                 efi=self.rootfs)
 
             kver = self._install_kernel()
-            self.logging.info(f"Unmounting {self.rootfs}.")
 
             self.logging.info(f"Insalling kernel {kver}.")
             utils.run_chroot_command(
                 ["kernel-install", "add", kver, f"/boot/vmlinuz-{kver}"],
                 self.rootfs, efi=self.rootfs)
-        finally:
-            umount(self.rootfs)
 
     def _install_kernel(self):
         """Configure kernel cmdine."""
@@ -5,17 +5,76 @@ SPDX-License-Identifier: Apache-2.0
 
 """
 
+import contextlib
+import functools
 import logging
 import os
+import shlex
 import shutil
 
+from omegaconf import OmegaConf
+
+from ruck import archive
 from ruck.config import get_config
 from ruck import exceptions
+from ruck.packages import PackageCache
+from ruck.rootfs import archive_format
+from ruck.rootfs import RootfsCache
+from ruck.schema import phase_schema
+from ruck.schema import STRING_LIST
 from ruck.stages.base import Base
+from ruck import stream
 from ruck import utils
 
+# mmdebstrap special hooks reading from the host.
+HOST_PATH_HOOKS = ["copy-in", "sync-in", "tar-in", "upload"]
+SPECIAL_HOOKS = HOST_PATH_HOOKS + [
+    "copy-out", "sync-out", "tar-out", "download"]
+
+# Limits of an incremental bootstrap, see incremental_max_changes and
+# incremental_max_age.
+INCREMENTAL_MAX_CHANGES = 20
+INCREMENTAL_MAX_AGE = 7
+
+SCHEMA = phase_schema({
+    "suite": {"type": "string", "required": True},
+    "target": {"type": "string", "required": True},
+    "architecture": {"type": "string", "required": True},
+    "packages": STRING_LIST,
+    "repo": {"type": "string"},
+    "components": STRING_LIST,
+    "variant": {"type": "string"},
+    "mode": {"type": "string"},
+    "hooks": STRING_LIST,
+    "setup_hooks": STRING_LIST,
+    "extract_hooks": STRING_LIST,
+    "essential_hooks": STRING_LIST,
+    "customize_hooks": STRING_LIST,
+    "apt_hooks": STRING_LIST,
+    "keyring": STRING_LIST,
+    "dpkgopt": STRING_LIST,
+    "package_cache": {"type": "boolean"},
+    # Size in MiB the package cache is shrunk to after a bootstrap.
+    "package_cache_size": {"type": "integer", "min": 0},
+    "rootfs_cache": {"type": "boolean"},
+    # Size in MiB and age in days of the root filesystem cache.
+    "rootfs_cache_size": {"type": "integer", "min": 0},
+    "rootfs_cache_max_age": {"type": "integer", "min": 0},
+    "incremental": {"type": "boolean"},
+    "incremental_max_changes": {"type": "integer", "min": 0},
+    "incremental_max_age": {"type": "integer", "min": 0},
+    "compression_level": {"type": "integer", "min": 0},
+    "compression_threads": {"type": "integer", "min": 0},
+    "stream": {"type": "boolean"},
+    "index": {"type": "boolean"},
+    "seekable": {"type": "boolean"},
+})
+
 
 class BootstrapPlugin(Base):
+    SCHEMA = SCHEMA
+    TOOLS = ["mmdebstrap"]
+
     def __init__(self, state, config, workspace):
         self.state = state
         self.config = config
@@ -38,7 +97,29 @@ class BootstrapPlugin(Base):
 
     def run(self):
         """Run the mmdebstrap command."""
-        self.logging.info(f"Running mmdebstrap.")
+        target = self.workspace.joinpath(
+            get_config(self.config, "options.target"))
+        rootfs = self._rootfs_cache(target)
+        if rootfs is not None:
+            options = OmegaConf.to_container(
+                self.config.options, resolve=True)
+            digests = rootfs.digests(self.workspace, self.inputs())
+            key = rootfs.key(options, digests)
+            base = rootfs.key(options, digests, packages=False)
+            packages = options.get("packages") or []
+            if rootfs.restore(key, target):
+                self.logging.info(
+                    f"Reusing the cached root filesystem {key[:12]}.")
+                self._index(target)
+                return
+            if get_config(self.config, "options.incremental"):
+                created = self._incremental(rootfs, base, target)
+                if created is not None:
+                    self._index(target)
+                    rootfs.store(key, target, base, packages, created)
+                    return
+
+        self.logging.info("Running mmdebstrap.")
 
         cmd = [
             self.mmdebstrap,
@@ -47,9 +128,9 @@ class BootstrapPlugin(Base):
         ]
 
         # Extend mmdesbtrap configuration, see manpage for details.
-        packages = get_config(self.config, "options.packages")
-        if packages:
-            cmd.extend([f"--include={', '.join(packages)}"])
+        include = get_config(self.config, "options.packages")
+        if include:
+            cmd.extend([f"--include={', '.join(include)}"])
 
         repo = get_config(self.config, "options.repo")
         if repo:
@@ -61,10 +142,10 @@ class BootstrapPlugin(Base):
         if customize_hooks:
             cmd.extend([f"--customize-hook={hook}"
                         for hook in customize_hooks])
-        components = get_config(self.config, "options.compoents")
+        components = get_config(self.config, "options.components")
         if components:
             cmd.extend([f"--components={','.join(components)}"])
-        variant = get_config(self.config, "options.varant")
+        variant = get_config(self.config, "options.variant")
         if variant:
             cmd.extend([f"--variant={variant}"])
         hooks = get_config(self.config, "options.hooks")
@@ -94,14 +175,249 @@ class BootstrapPlugin(Base):
         if dpkg_opts:
             cmd.extend([f"--dpkgopts='{hook}'" for hook in dpkg_opts])
 
+        (cache, incoming) = (None, None)
+        if get_config(self.config, "options.package_cache") is not False:
+            size = get_config(self.config, "options.package_cache_size")
+            cache = PackageCache.from_state(
+                self.state, None if size is None else size * 1024 * 1024)
+            incoming = cache.incoming()
+            cmd.extend(cache.hooks(incoming))
+
         suite = get_config(self.config, "options.suite")
-        target = self.workspace.joinpath(
-            get_config(self.config, "options.target"))
-        cmd.extend([suite, target])
+        streaming = get_config(self.config, "options.stream")
+        if streaming:
+            # mmdebstrap writes an uncompressed tarball to stdout.
+            (output, env) = ("-", None)
+        else:
+            (output, env) = self._output(target)
+        cmd.extend([suite, output])
         if repo is not None:
             # include our mirror from the manifest.
             cmd.extend([repo])
-        utils.run_command(cmd)
+
+        if os.path.isfile(target):
+            # The target may share its data with the root filesystem cache,
+            # replace it rather than overwrite it.
+            os.unlink(target)
+        if streaming:
+            self.logging.info(
+                f"Streaming {target} to the phase reading it.")
+            stream.register(
+                target,
+                functools.partial(self._mmdebstrap, cmd, env, cache, incoming))
+            return
+
+        self._mmdebstrap(cmd, env, cache, incoming)
+        if output != target:
+            try:
+                archive.compress(
+                    output, target,
+                    level=get_config(self.config, "options.compression_level"),
+                    threads=get_config(
+                        self.config, "options.compression_threads"),
+                    seekable=bool(
+                        get_config(self.config, "options.seekable")))
+            finally:
+                if os.path.exists(output):
+                    os.unlink(output)
+
+        self._index(target)
+        if rootfs is not None:
+            rootfs.store(key, target, base, packages)
+
+    def _mmdebstrap(self, cmd, env, cache, incoming, consumer=None):
+        """Run mmdebstrap, piping its output into consumer if given."""
+        try:
+            with cache.lock() if cache else contextlib.nullcontext():
+                if consumer is None:
+                    utils.run_command(cmd, env=env)
+                else:
+                    utils.run_pipeline([cmd, consumer], env=env)
+        except Exception:
+            if incoming is not None:
+                shutil.rmtree(incoming, ignore_errors=True)
+            raise
+        if cache is not None:
+            cache.harvest(incoming)
+
+    def _incremental(self, rootfs, base, target):
+        """Create the target from the closest cached root filesystem.
+
+        The packages added to or removed from the manifest are installed
+        or purged with apt, and the customize hooks run again. Return
+        when the base root filesystem was bootstrapped, or None to fall
+        back to a full bootstrap.
+        """
+        packages = get_config(self.config, "options.packages") or []
+        max_changes = get_config(
+            self.config, "options.incremental_max_changes")
+        if max_changes is None:
+            max_changes = INCREMENTAL_MAX_CHANGES
+        max_age = get_config(self.config, "options.incremental_max_age")
+        if max_age is None:
+            max_age = INCREMENTAL_MAX_AGE
+
+        if os.geteuid() != 0:
+            self.logging.info(
+                "Incremental bootstrap needs root, running mmdebstrap.")
+            return None
+        hooks = get_config(self.config, "options.customize_hooks") or []
+        for hook in hooks:
+            args = shlex.split(hook)
+            if args and args[0] in SPECIAL_HOOKS and \
+                    args[0] not in ["copy-in", "sync-in"]:
+                self.logging.info(
+                    f"Unable to replay '{hook}', running mmdebstrap.")
+                return None
+        closest = rootfs.closest(base, packages, target, max_age * 86400)
+        if closest is None:
+            self.logging.info("No recent root filesystem to start from.")
+            return None
+        (key, added, removed) = closest
+        if len(added) + len(removed) > max_changes:
+            self.logging.info(
+                f"{len(added) + len(removed)} package(s) changed, "
+                "running mmdebstrap.")
+            return None
+
+        self.logging.info(
+            f"Bootstrapping from {key[:12]}: installing "
+            f"{', '.join(added) or 'nothing'}, removing "
+            f"{', '.join(removed) or 'nothing'}.")
+        root = self.workspace.joinpath(".ruck", "incremental")
+        if root.exists():
+            shutil.rmtree(root)
+        root.mkdir(parents=True)
+        try:
+            utils.run_command(
+                ["tar", "-C", root, "--numeric-owner", "-xf",
+                 rootfs.entry(key, target)])
+            self._apt(root, added, removed)
+            for hook in hooks:
+                self._customize(root, hook)
+            if os.path.isfile(target):
+                os.unlink(target)
+            archive.pack(
+                root, target,
+                level=get_config(self.config, "options.compression_level"),
+                threads=get_config(
+                    self.config, "options.compression_threads"))
+        except (exceptions.RuckError, OSError) as e:
+            self.logging.warning(
+                f"Incremental bootstrap failed, running mmdebstrap: {e}")
+            if os.path.isfile(target):
+                os.unlink(target)
+            return None
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        return rootfs.created(key)
+
+    def _apt(self, root, added, removed):
+        """Apply a package delta with apt in the root filesystem."""
+        env = dict(os.environ, DEBIAN_FRONTEND="noninteractive")
+        utils.run_chroot_command(["apt-get", "update"], root, env=env)
+        if added:
+            utils.run_chroot_command(
+                ["apt-get", "install", "--yes", "--no-install-recommends",
+                 *added], root, env=env)
+        if removed:
+            utils.run_chroot_command(
+                ["apt-get", "purge", "--yes", *removed], root, env=env)
+            utils.run_chroot_command(
+                ["apt-get", "autoremove", "--purge", "--yes"], root, env=env)
+        # mmdebstrap leaves neither packages nor package lists behind.
+        utils.run_chroot_command(["apt-get", "clean"], root, env=env)
+        lists = root.joinpath("var/lib/apt/lists")
+        for entry in lists.iterdir() if lists.exists() else []:
+            if entry.is_file():
+                entry.unlink()
+
+    def _customize(self, root, hook):
+        """Run a customize hook the way mmdebstrap does."""
+        args = shlex.split(hook)
+        if args and args[0] in ["copy-in", "sync-in"]:
+            (sources, dest) = (args[1:-1], root.joinpath(
+                args[-1].lstrip("/")))
+            for source in sources:
+                source = self.workspace.joinpath(source)
+                if args[0] == "sync-in":
+                    utils.run_command(
+                        ["cp", "-a", "--no-preserve=ownership",
+                         f"{source}/.", dest])
+                else:
+                    utils.run_command(["cp", "-a", source, dest])
+            return
+        utils.run_command(["sh", "-c", hook, "exec", root],
+                          cwd=self.workspace)
+
+    def _output(self, target):
+        """Return where mmdebstrap writes the root filesystem to, and the
+        environment setting its compression level and threads.
+        """
+        level = get_config(self.config, "options.compression_level")
+        threads = get_config(self.config, "options.compression_threads")
+        try:
+            fmt = archive.format_from_name(target)
+        except exceptions.ConfigError:
+            # Directories and the other formats mmdebstrap supports.
+            return (target, None)
+        seekable = get_config(self.config, "options.seekable")
+        if seekable and fmt != "gzip":
+            raise exceptions.ConfigError(
+                f"Seekable {fmt} archives are not supported.")
+        if fmt == "lz4" or seekable or \
+                (fmt == "gzip" and (level, threads) != (None, None)):
+            # mmdebstrap cannot compress these, compress its tarball.
+            return (target.with_name(f"{target.name}.ruck.tar"), None)
+        env = archive.environment(fmt, level=level, threads=threads)
+        if not env:
+            return (target, None)
+        return (target, dict(os.environ, **env))
+
+    def _index(self, target):
+        """Write the index of the members of the target archive."""
+        if get_config(self.config, "options.index") is False or \
+                not archive_format(target) or not os.path.isfile(target):
+            return
+        try:
+            archive.load_index(target)
+        except exceptions.ConfigError as e:
+            self.logging.warning(e)
+
+    def _rootfs_cache(self, target):
+        """Return the root filesystem cache, if it applies to the phase."""
+        if self.state.no_cache or \
+                get_config(self.config, "options.rootfs_cache") is False:
+            return None
+        if not archive_format(target):
+            # Directories are modified in place by later phases.
+            return None
+        size = get_config(self.config, "options.rootfs_cache_size")
+        max_age = get_config(self.config, "options.rootfs_cache_max_age")
+        return RootfsCache.from_state(
+            self.state,
+            None if size is None else size * 1024 * 1024,
+            None if max_age is None else max_age * 86400)
 
     def post_install(self):
         pass
+
+    def inputs(self):
+        """Overlays and hook directories used by mmdebstrap."""
+        inputs = []
+        for option in ["setup_hooks", "extract_hooks", "essential_hooks",
+                       "customize_hooks"]:
+            for hook in get_config(self.config, f"options.{option}") or []:
+                args = shlex.split(hook)
+                if args and args[0] in HOST_PATH_HOOKS:
+                    inputs.extend(
+                        self.workspace.joinpath(a) for a in args[1:-1])
+        for hook in get_config(self.config, "options.hooks") or []:
+            inputs.append(self.workspace.joinpath(hook))
+        repo = get_config(self.config, "options.repo")
+        if repo:
+            inputs.append(self.workspace.joinpath(repo))
+        return inputs
+
+    def outputs(self):
+        return [self.workspace.joinpath(self.config.options.target)]
@@ -6,15 +6,32 @@ SPDX-License-Identifier: Apache-2.0
 """
 
 import logging
+import shutil
 
 from ruck.archive import unpack
+from ruck.config import get_config
 from ruck import exceptions
-from ruck.mount import mount
-from ruck.mount import umount
+from ruck.populate import populate
+from ruck.schema import phase_schema
 from ruck.stages.base import Base
+from ruck import stream
+
+SCHEMA = phase_schema({
+    "source": {"type": "string", "required": True},
+    "target": {"type": "string", "required": True},
+    # mount: unpack into the mounted image, mkfs: create the filesystems
+    # of the image from the unpacked tree.
+    "method": {"type": "string", "allowed": ["mount", "mkfs"]},
+})
+
+MKFS_TOOLS = ["tar", "blkid", "mkfs.ext4", "mkfs.vfat", "mcopy"]
 
 
 class DeployPlugin(Base):
+    SCHEMA = SCHEMA
+    TOOLS = ["systemd-dissect", "tar"]
+    MOUNTS = True
+
     def __init__(self, state, config, workspace):
         self.state = state
         self.config = config
@@ -22,13 +39,17 @@ class DeployPlugin(Base):
         self.logging = logging.getLogger(__name__)
 
         self.rootfs = self.workspace.joinpath("rootfs")
+        self.mounts = self.workspace.joinpath("rootfs.mounts")
+        self.method = get_config(self.config, "options.method") or "mount"
+        if self.method == "mkfs":
+            self.TOOLS = MKFS_TOOLS
 
     def preflight_check(self):
         """Deploy rootfs to an image."""
         self.logging.info("Deploying to image.")
 
         self.target = self.workspace.joinpath(self.config.options.source)
-        if not self.target.exists():
+        if not self.target.exists() and not stream.streamed(self.target):
             raise exceptions.ConfigError(f"{self.target} not found.")
 
         self.image = self.workspace.joinpath(self.config.options.target)
@@ -36,18 +57,41 @@ class DeployPlugin(Base):
             raise exceptions.ConfigError(f"{self.image} not found.")
 
     def run(self):
-        self.logging.info("Deploying to image.")
-        try:
-            self.rootfs.mkdir(parents=True, exist_ok=True)
-
-            self.logging.info(f"Mounting {self.image} on {self.rootfs}.")
-            mount(self.image, self.rootfs)
+        if self.method == "mkfs":
+            return self._populate()
 
+        self.logging.info("Deploying to image.")
+        with self.mount(self.image, self.rootfs):
             # Unpack the tarball.
             unpack(self.target, self.rootfs)
+
+    def _populate(self):
+        """Create the filesystems of the image from the unpacked tarball."""
+        self.logging.info("Populating the filesystems of the image.")
+        if self.mount_manager is not None:
+            # The filesystems are recreated, drop the mount of a
+            # previous phase.
+            self.mount_manager.release([self.image, self.rootfs])
+        for path in [self.rootfs, self.mounts]:
+            if path.exists():
+                shutil.rmtree(path)
+        self.rootfs.mkdir(parents=True)
+        try:
+            unpack(self.target, self.rootfs)
+            populate(self.image, self.rootfs, self.mounts)
         finally:
-            self.logging.info(f"Umounting {self.rootfs}.")
-            umount(self.rootfs)
+            for path in [self.rootfs, self.mounts]:
+                shutil.rmtree(path, ignore_errors=True)
 
     def post_install(self):
         pass
+
+    def inputs(self):
+        return [self.workspace.joinpath(self.config.options.source),
+                self.workspace.joinpath(self.config.options.target)]
+
+    def outputs(self):
+        return [self.workspace.joinpath(self.config.options.target)]
+
+    def scratch(self):
+        return [self.rootfs, self.mounts]
@@ -0,0 +1,83 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import logging
+import os
+
+from ruck.config import get_config
+from ruck import exceptions
+from ruck import export
+from ruck.schema import phase_schema
+from ruck.stages.base import Base
+
+SCHEMA = phase_schema({
+    "image": {"type": "string", "required": True},
+    "formats": {
+        "type": "list",
+        "required": True,
+        "empty": False,
+        "schema": {"type": "string", "allowed": list(export.FORMATS)},
+    },
+    # Name of the exported images, without the format extension.
+    "name": {"type": "string"},
+    # Compress the clusters of qcow2 images.
+    "compress": {"type": "boolean"},
+    "compression_level": {"type": "integer", "min": 0},
+    "compression_threads": {"type": "integer", "min": 0},
+    "checksum": {"type": "boolean"},
+})
+
+
+class ExportPlugin(Base):
+    """Convert a raw disk image into qcow2 or compressed raw images,
+    reading it once whatever the number of formats.
+    """
+    SCHEMA = SCHEMA
+
+    def __init__(self, state, config, workspace):
+        self.state = state
+        self.config = config
+        self.workspace = workspace
+        self.logging = logging.getLogger(__name__)
+
+        self.TOOLS = [
+            export.FORMATS[fmt] for fmt in self.config.options.formats
+            if export.FORMATS.get(fmt)]
+
+    def preflight_check(self):
+        self.image = self.workspace.joinpath(self.config.options.image)
+        if not self.image.exists():
+            raise exceptions.ConfigError(f"Unable to find {self.image}.")
+
+    def run(self):
+        outputs = dict(zip(self.config.options.formats, self.outputs()))
+        self.logging.info(
+            f"Exporting {self.image} to {', '.join(outputs)}.")
+        checksums = get_config(self.config, "options.checksum") is not False
+        digests = export.export(
+            self.image, outputs,
+            compress=bool(get_config(self.config, "options.compress")),
+            level=get_config(self.config, "options.compression_level"),
+            threads=get_config(self.config, "options.compression_threads"),
+            checksums=checksums)
+        for fmt, path in outputs.items():
+            if checksums:
+                export.write_checksum(path, digests[fmt])
+            self.logging.info(
+                f"Exported {path} ({os.path.getsize(path) // 1024 // 1024} "
+                "MiB).")
+
+    def post_install(self):
+        pass
+
+    def inputs(self):
+        return [self.workspace.joinpath(self.config.options.image)]
+
+    def outputs(self):
+        name = get_config(self.config, "options.name") or \
+            os.path.splitext(self.config.options.image)[0]
+        return [self.workspace.joinpath(f"{name}.{fmt}")
+                for fmt in self.config.options.formats]
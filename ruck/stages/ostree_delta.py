@@ -0,0 +1,123 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+from concurrent import futures
+import os
+
+from ruck.config import get_config
+from ruck import exceptions
+from ruck.log import current_phase
+from ruck.log import current_prefix
+from ruck.log import phase_context
+from ruck import ostree
+from ruck.schema import phase_schema
+from ruck.stages.base import OstreeBase
+from ruck import utils
+
+SCHEMA = phase_schema({
+    "repo": {"type": "string", "required": True},
+    "branch": {"type": "string", "required": True},
+    "from_scratch": {"type": "boolean"},
+    "depth": {"type": "integer", "min": 0},
+    "jobs": {"type": "integer", "min": 1},
+    "summary": {"type": "boolean"},
+    "retention": {
+        "type": "dict",
+        "schema": {
+            "depth": {"type": "integer", "min": 0},
+            "keep_younger_than": {"type": "string"},
+        },
+    },
+})
+
+# Number of previous commits static deltas are generated from.
+DEFAULT_DEPTH = 1
+
+
+class OstreeDeltaPlugin(OstreeBase):
+    """Generate the static deltas updating devices to the head of a
+    branch, prune old commits and update the summary of the repository.
+    """
+    SCHEMA = SCHEMA
+    TOOLS = ["ostree"]
+
+    def preflight_check(self):
+        self.repo = self.workspace.joinpath(self.config.options.repo)
+        self.branch = self.config.options.branch
+        if not self.repo.exists():
+            raise exceptions.ConfigError(f"Unable to find {self.repo}.")
+
+    def run(self):
+        self._prune()
+
+        depth = get_config(self.config, "options.depth")
+        commits = ostree.history(
+            self.repo, self.branch,
+            DEFAULT_DEPTH if depth is None else depth)
+        if not commits:
+            raise exceptions.ConfigError(
+                f"{self.branch} has no commits in {self.repo}.")
+        (to_commit, parents) = (commits[0], commits[1:])
+
+        sources = list(parents)
+        if get_config(self.config, "options.from_scratch") is not False:
+            sources.insert(0, None)
+        existing = ostree.static_deltas(self.repo)
+        sources = [source for source in sources
+                   if ostree.delta_name(source, to_commit) not in existing]
+
+        jobs = get_config(self.config, "options.jobs") or \
+            min(len(sources), os.cpu_count() or 1) or 1
+        self.logging.info(
+            f"Generating {len(sources)} static delta(s) to {to_commit}.")
+        # The workers account and log their commands under the phase.
+        context = (current_phase(), current_prefix())
+
+        def generate(source):
+            with phase_context(*context):
+                self._generate(source, to_commit)
+
+        with futures.ThreadPoolExecutor(jobs) as pool:
+            list(pool.map(generate, sources))
+
+        if get_config(self.config, "options.summary") is not False:
+            self.logging.info(f"Updating the summary of {self.repo}.")
+            utils.run_command(
+                ["ostree", "summary", f"--repo={self.repo}", "--update"])
+
+    def post_install(self):
+        pass
+
+    def inputs(self):
+        return [self.workspace.joinpath(self.config.options.repo)]
+
+    def outputs(self):
+        return [self.workspace.joinpath(self.config.options.repo)]
+
+    def _generate(self, from_commit, to_commit):
+        """Generate a static delta, from scratch if from_commit is None."""
+        cmd = ["ostree", "static-delta", "generate",
+               f"--repo={self.repo}", f"--to={to_commit}"]
+        if from_commit is None:
+            cmd.append("--empty")
+        else:
+            cmd.append(f"--from={from_commit}")
+        utils.run_command(cmd)
+
+    def _prune(self):
+        """Prune the commits beyond the retention policy."""
+        depth = get_config(self.config, "options.retention.depth")
+        younger = get_config(
+            self.config, "options.retention.keep_younger_than")
+        if depth is None and younger is None:
+            return
+        cmd = ["ostree", "prune", f"--repo={self.repo}", "--refs-only"]
+        if depth is not None:
+            cmd.append(f"--depth={depth}")
+        if younger is not None:
+            cmd.append(f"--keep-younger-than={younger}")
+        self.logging.info(f"Pruning {self.repo}.")
+        utils.run_command(cmd)
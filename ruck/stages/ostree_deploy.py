@@ -7,13 +7,24 @@ SPDX-License-Identifier: Apache-2.0
 import shutil
 
 from ruck import exceptions
-from ruck.mount import mount
-from ruck.mount import umount
+from ruck.schema import phase_schema
+from ruck.schema import STRING_LIST
 from ruck.stages.base import OstreeBase
 from ruck import utils
 
+SCHEMA = phase_schema({
+    "repo": {"type": "string", "required": True},
+    "branch": {"type": "string", "required": True},
+    "image": {"type": "string", "required": True},
+    "kernel_args": STRING_LIST,
+})
+
 
 class OstreeDeployPlugin(OstreeBase):
+    SCHEMA = SCHEMA
+    TOOLS = ["ostree", "systemd-dissect", "bwrap"]
+    MOUNTS = True
+
     def preflight_check(self):
         self. repo = self.config.options.repo
         self.branch = self.config.options.branch
@@ -21,7 +32,7 @@ class OstreeDeployPlugin(OstreeBase):
         self.kernel_args = self.config.options.kernel_args
 
         self.rootfs = self.workspace.joinpath("rootfs")
-        if self.rootfs.exists():
+        if self.rootfs.exists() and not self.rootfs.is_mount():
             shutil.rmtree(self.rootfs)
         if not self.image.exists():
             raise exceptions.ConfigError(f"Unable to find {self.image}.")
@@ -29,10 +40,7 @@ class OstreeDeployPlugin(OstreeBase):
     def run(self):
         self.logging.info("Deploying ostree repository.")
 
-        self.logging.info(f"Mounting {self.image} on {self.rootfs}")
-        try:
-            mount(self.image, self.rootfs)
-
+        with self.mount(self.image, self.rootfs):
             ostree_repo = self.rootfs.joinpath("ostree/repo")
             self.logging.info(f"Creating {ostree_repo}.")
             ostree_repo.mkdir(parents=True, exist_ok=True)
@@ -74,8 +82,16 @@ class OstreeDeployPlugin(OstreeBase):
                 self.rootfs.joinpath(
                     "boot/loader/entries/ostree-1-debian.conf"),
                 self.rootfs.joinpath("efi/loader/entries/ostree-0-1.conf"))
-        finally:
-            umount(self.rootfs)
 
     def post_install(self):
         pass
+
+    def inputs(self):
+        return [self.workspace.joinpath(self.config.options.repo),
+                self.workspace.joinpath(self.config.options.image)]
+
+    def outputs(self):
+        return [self.workspace.joinpath(self.config.options.image)]
+
+    def scratch(self):
+        return [self.workspace.joinpath("rootfs")]
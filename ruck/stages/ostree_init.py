@@ -5,11 +5,22 @@ SPDX-License-Identifier: Apache-2.0
 """
 import pathlib
 
+from ruck.schema import phase_schema
 from ruck.stages.base import OstreeBase
 from ruck import utils
 
+SCHEMA = phase_schema({
+    "repo": {"type": "string", "required": True},
+    "mode": {"type": "string", "required": True,
+             "allowed": ["bare", "bare-user", "bare-user-only",
+                         "archive", "archive-z2"]},
+})
+
 
 class OstreeInitPlugin(OstreeBase):
+    SCHEMA = SCHEMA
+    TOOLS = ["ostree"]
+
     def preflight_check(self):
         self.logging.info("Creating ostree repository.")
         self.repo = pathlib.Path(self.config.options.repo)
@@ -26,3 +37,6 @@ class OstreeInitPlugin(OstreeBase):
 
     def post_install(self):
         pass
+
+    def outputs(self):
+        return [self.workspace.joinpath(self.config.options.repo)]
@@ -5,26 +5,43 @@ SPDX-License-Identifier: Apache-2.0
 
 """
 import hashlib
+import logging
 import os
 import shutil
-import subprocess
-import sys
 
-from ruck.archive import unpack
+from ruck import archive
+from ruck.config import get_config
+from ruck import ostree as ostree_tree
+from ruck.schema import phase_schema
 from ruck.stages.base import OstreeBase
+from ruck import stream
+from ruck import utils
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA = phase_schema({
+    "repo": {"type": "string", "required": True},
+    "branch": {"type": "string", "required": True},
+    "target": {"type": "string", "required": True},
+    "method": {"type": "string", "allowed": ["tar", "unpack"]},
+    "subject": {"type": "string"},
+    "body": {"type": "string"},
+    "version": {"type": ["string", "number"]},
+    "parent": {"type": "boolean"},
+    "commit_cache": {"type": "boolean"},
+})
 
 
 def ostree(*args, _input=None, **kwargs):
     args = list(args) + [f'--{k}={v}' for k, v in kwargs.items()]
-    print("ostree " + " ".join(args), file=sys.stderr)
-    subprocess.run(["ostree"] + args,
-                   encoding="utf-8",
-                   stdout=sys.stderr,
-                   input=_input,
-                   check=True)
+    LOG.debug("ostree " + " ".join(args))
+    utils.run_command(["ostree"] + args, data=_input)
 
 
 class OstreePrepPlugin(OstreeBase):
+    SCHEMA = SCHEMA
+    TOOLS = ["ostree", "tar"]
+
     def preflight_check(self):
         self.logging.info("Creating ostree branch.")
 
@@ -36,8 +53,17 @@ class OstreePrepPlugin(OstreeBase):
         self.rootfs = self.workspace.joinpath("rootfs")
         if self.rootfs.exists():
             shutil.rmtree(self.rootfs)
+        if get_config(self.config, "options.method") != "unpack" and \
+                not stream.streamed(self.target):
+            cache = self._commit_cache()
+            if cache is not None:
+                self._commit_cached(cache)
+            else:
+                self._commit_tar()
+            return
+
         self.rootfs.mkdir(parents=True, exist_ok=True)
-        unpack(self.target, self.rootfs)
+        archive.unpack(self.target, self.rootfs)
 
         self._setup_boot(self.rootfs.joinpath("boot"),
                          self.rootfs.joinpath("usr/lib/ostree-boot"))
@@ -45,22 +71,102 @@ class OstreePrepPlugin(OstreeBase):
         self.logging.info("Commiting to ostree")
         ostree("commit",
                str(self.rootfs),
-               repo=self.repo,
-               branch=self.branch,
-               subject="Initial commit")
+               **self._commit_options())
 
     def post_install(self):
-        self.logging.info("Cleaning up")
-        shutil.rmtree(self.rootfs)
+        if self.rootfs.exists():
+            self.logging.info("Cleaning up")
+            shutil.rmtree(self.rootfs)
 
-    def _convert_to_ostree(self):
-        CRUFT = ["boot/initrd.img", "boot/vmlinuz",
-                 "initrd.img", "initrd.img.old",
-                 "vmlinuz", "vmlinuz.old"]
+    def inputs(self):
+        return [self.workspace.joinpath(self.config.options.target),
+                self.workspace.joinpath(self.config.options.repo)]
+
+    def outputs(self):
+        return [self.workspace.joinpath(self.config.options.repo)]
+
+    def scratch(self):
+        return [self.workspace.joinpath("rootfs")]
+
+    def _commit_tar(self):
+        """Commit the target tarball without unpacking it.
+
+        The tarball is converted on the fly into the tree the unpack
+        method creates, and fed to ostree commit.
+        """
+        self.logging.info("Commiting to ostree from the tarball")
+
+        def feed(stdin):
+            with archive.uncompressed(self.target) as f:
+                ostree_tree.convert(f, stdin)
+
+        cmd = ["ostree", "commit",
+               "--tree=tar=/dev/stdin",
+               "--tar-autocreate-parents"]
+        cmd.extend(f"--{k}={v}" for k, v in self._commit_options().items())
+        self.logging.debug(" ".join(cmd))
+        utils.run_feed(cmd, feed)
+
+    def _commit_cache(self):
+        """Return the commit cache, if it applies to the phase."""
+        if self.state.no_cache or \
+                get_config(self.config, "options.commit_cache") is False:
+            return None
+        if os.geteuid() != 0:
+            self.logging.info(
+                "Not using the ostree commit cache, it requires root.")
+            return None
+        return ostree_tree.CommitCache.from_state(
+            self.state, self.repo, self.branch)
+
+    def _commit_cached(self, cache):
+        """Commit the target tarball through the commit cache.
+
+        The tree is committed to the bare repository of the cache,
+        where unchanged files are not checksummed again, pulled into
+        the repository and committed there on top of the branch.
+        """
+        options = self._commit_options()
+        parent = options["parent"] if options["parent"] != "none" else None
+        self.logging.info("Updating the ostree commit cache")
+        commit = cache.update(self.target, parent)
 
+        self.logging.info("Commiting to ostree")
+        utils.run_command(
+            ["ostree", "pull-local", f"--repo={self.repo}", cache.repo,
+             commit])
+        cmd = ["ostree", "commit", f"--tree=ref={commit}"]
+        cmd.extend(f"--{k}={v}" for k, v in options.items())
+        (out, err) = utils.run_command(cmd, capture=True)
+        cache.save(out.strip())
+
+    def _commit_options(self):
+        """Return the options of ostree commit.
+
+        Successive builds of a branch are committed on top of each
+        other so that updates can be computed between them.
+        """
+        options = {"repo": self.repo, "branch": self.branch}
+        parent = None
+        if get_config(self.config, "options.parent") is not False:
+            parent = ostree_tree.rev_parse(self.repo, self.branch)
+        if parent is not None:
+            self.logging.info(f"Committing on top of {parent}.")
+        options["parent"] = parent or "none"
+        options["subject"] = get_config(self.config, "options.subject") or \
+            ("Initial commit" if parent is None else "Update")
+        body = get_config(self.config, "options.body")
+        if body:
+            options["body"] = body
+        version = get_config(self.config, "options.version")
+        if version is not None:
+            options["add-metadata-string"] = f"version={version}"
+        return options
+
+    def _convert_to_ostree(self):
         # Remove unecessary files
         self.logging.info("Removing unnecessary files.")
-        for c in CRUFT:
+        for c in ostree_tree.CRUFT:
             try:
                 os.remove(self.rootfs.joinpath(c))
             except OSError:
@@ -79,17 +185,8 @@ class OstreePrepPlugin(OstreeBase):
             pass
 
         self.logging.info("Setting up symlinks.")
-        TOPLEVEL_LINKS = {
-            "media": "run/media",
-            "mnt": "var/mnt",
-            "opt": "var/opt",
-            "ostree": "sysroot/ostree",
-            "root": "var/roothome",
-            "srv": "var/srv",
-            "usr/local": "../var/usrlocal",
-        }
         fd = os.open(self.rootfs, os.O_DIRECTORY)
-        for l, t in TOPLEVEL_LINKS.items():
+        for l, t in ostree_tree.TOPLEVEL_LINKS.items():
             shutil.rmtree(self.rootfs.joinpath(l))
             os.symlink(t, l, dir_fd=fd)
 
@@ -5,16 +5,79 @@ SPDX-License-Identifier: Apache-2.0
 
 """
 
+from concurrent import futures
 import logging
 import os
-import shlex
-import subprocess
-
+import shutil
+import time
+import uuid
+
+from omegaconf import OmegaConf
+
+from ruck.config import get_config
+from ruck import gpt
+from ruck.log import current_phase
+from ruck.log import current_prefix
+from ruck.log import phase_context
+from ruck.schema import phase_schema
+from ruck.schema import STRING_LIST
 from ruck.stages.base import Base
+from ruck import trace
 from ruck import utils
 
+SCHEMA = phase_schema({
+    "image": {
+        "type": "dict",
+        "required": True,
+        "schema": {
+            "name": {"type": "string", "required": True},
+            "size": {"type": "string", "required": True},
+            "label": {"type": "string", "required": True,
+                      "allowed": ["gpt"]},
+        },
+    },
+    # loop: format the partitions through a loop device, assemble:
+    # format standalone files and copy them into the image.
+    "method": {"type": "string", "allowed": ["loop", "assemble"]},
+    # Number of filesystems formatted concurrently.
+    "jobs": {"type": "integer", "min": 1},
+    "partitions": {
+        "type": "list",
+        "required": True,
+        "schema": {
+            "type": "dict",
+            "schema": {
+                "name": {"type": "string", "required": True},
+                "start": {"type": "string", "required": True},
+                "end": {"type": "string", "required": True},
+                "type": {"type": "string"},
+                "flags": STRING_LIST,
+            },
+        },
+    },
+    "filesystems": {
+        "type": "list",
+        "required": True,
+        "schema": {
+            "type": "dict",
+            "schema": {
+                "name": {"type": "string", "required": True},
+                "label": {"type": "string", "required": True},
+                "fs": {"type": "string", "required": True},
+                "options": STRING_LIST,
+            },
+        },
+    },
+})
+
+
+ASSEMBLE_TOOLS = ["mkfs", "mkfs.vfat"]
+
 
 class PartedPlugin(Base):
+    SCHEMA = SCHEMA
+    TOOLS = ["losetup", "mkfs", "mkfs.vfat"]
+
     def __init__(self, state, config, workspace):
         self.state = state
         self.config = config
@@ -23,21 +86,44 @@ class PartedPlugin(Base):
         self.logging = logging.getLogger(__name__)
 
         self.image = None
+        self.method = get_config(self.config, "options.method") or "loop"
+        if self.method == "assemble":
+            self.TOOLS = ASSEMBLE_TOOLS
 
     def preflight_check(self):
         self.images = self.config.options.image
         self.partitions = self.config.options.partitions
         self.filesystems = self.config.options.filesystems
 
+        # Compute the layout before touching the image.
+        self.size = gpt.parse_size(self.images.size)
+        self.layout = gpt.layout(
+            OmegaConf.to_container(self.partitions, resolve=True),
+            self.size, seed=self.images.name)
+
     def run(self):
         self._create_image()
         self._create_label()
         self._create_partitions()
-        self._create_filesystems()
+        if self.method == "assemble":
+            self._assemble_filesystems()
+        else:
+            self._create_filesystems()
 
     def post_install(self):
         pass
 
+    def outputs(self):
+        return [self.workspace.joinpath(self.config.options.image.name)]
+
+    def scratch(self):
+        return [self._parts()]
+
+    def _parts(self):
+        """Directory holding the filesystems being assembled."""
+        return self.workspace.joinpath(
+            f"{self.config.options.image.name}.parts")
+
     def _create_image(self):
         """Create a raw disk image."""
         self.image = self.workspace.joinpath(self.images.name)
@@ -47,69 +133,106 @@ class PartedPlugin(Base):
             self.logging.info(f"Found previous image, removing {self.image}")
             os.unlink(self.image)
 
-        self.logging.info(f"Creating {self.image}")
-        utils.run_command(["truncate", "-s", size, self.image])
+        self.logging.info(f"Creating {self.image} ({size})")
+        with open(self.image, "wb") as f:
+            f.truncate(self.size)
 
     def _create_label(self):
         """Create a GPT label for the disk."""
         label = self.images.label
-        if self.image.exists():
-            # TODO(chuck): add msdos support
-            if label not in ["gpt"]:
-                self.logging.error(f"{label} is not a valid type.")
-
-            self.logging.info(f"Creating GPT label for {self.image}.")
-            utils.run_command(
-                ["parted", self.image, "--script", "mklabel", label])
+        # TODO(chuck): add msdos support
+        if label not in ["gpt"]:
+            self.logging.error(f"{label} is not a valid type.")
 
     def _create_partitions(self):
-        """Use parted to create the partitions."""
-        for index, part in enumerate(self.partitions, start=1):
-            self.logging.info(f"Creating parttion for {part.name}.")
-            (out, err) = utils.run_command(
-                ["parted", "-s", self.image, "--", "mkpart", part.name,
-                 part.start, part.end])
-
-            self.logging.info(f"Setting partition type(s) for {part.name}.")
-            for flag in part.flags:
-                cmd = f"parted -s {self.image} -- set {index} {flag} on"
-                utils.run_command(shlex.split(cmd))
+        """Write the partition table of the disk."""
+        for p in self.layout:
+            self.logging.info(
+                f"Creating partition {p.number} for {p.name} at "
+                f"{p.start // gpt.SECTOR_SIZE}s, "
+                f"{p.size // 1024 // 1024} MiB.")
+        self.logging.info(f"Creating GPT label for {self.image}.")
+        gpt.write_table(self.image, self.layout,
+                        uuid.uuid5(gpt.NAMESPACE, self.images.name))
+        gpt.verify(self.image)
 
     def _create_filesystems(self):
         """Setup the image for the filesystems to be formatted."""
         self.logging.info(f"Setting up loopback device for {self.image}.")
-        try:
+        with self.loop(self.image) as loop:
             self.logging.info(f"Creating device map for {self.image}")
-            loop = self.losetup()
-
+            targets = []
             for index, part in enumerate(self.filesystems, start=1):
                 fs = f"/dev/{os.path.basename(loop)}p{index}"
                 if os.path.exists(fs):
-                    self._mkfs(fs,
-                               part.fs,
-                               part.label,
-                               part.name)
-
+                    targets.append((part, fs))
+            self._format(targets, lambda part, fs: self._mkfs(
+                fs, part.fs, part.label, part.name, part.get("options")))
+
+    def _assemble_filesystems(self):
+        """Format the filesystems in files and copy them into the image.
+
+        No loop device nor privilege is needed, and only the blocks
+        written by mkfs are copied.
+        """
+        parts = self._parts()
+        if parts.exists():
+            shutil.rmtree(parts)
+        parts.mkdir(parents=True)
+        try:
+            self._format(list(zip(self.filesystems, self.layout)),
+                         self._assemble)
         finally:
-            subprocess.run(["losetup", "-d", loop], check=True)
-
-    def _mkfs(self, fs, fs_type, label, name):
+            shutil.rmtree(parts, ignore_errors=True)
+
+    def _assemble(self, part, partition):
+        """Format a filesystem in a file and copy it into its partition."""
+        path = self._parts().joinpath(f"{partition.number}-{part.name}.img")
+        with open(path, "wb") as f:
+            f.truncate(partition.size)
+        self._mkfs(path, part.fs, part.label, part.name, part.get("options"))
+        self.logging.info(
+            f"Copying {part.name} to partition {partition.number}.")
+        utils.splice_file(path, self.image, partition.start)
+        os.unlink(path)
+
+    def _format(self, targets, format):
+        """Call format on the (filesystem, target) pairs concurrently and
+        report how long each filesystem took.
+        """
+        if not targets:
+            return
+        jobs = get_config(self.config, "options.jobs") or \
+            min(len(targets), os.cpu_count() or 1)
+        # The workers account and log their commands under the phase.
+        (phase, prefix) = (current_phase(), current_prefix())
+
+        def timed(target):
+            (part, _) = target
+            name = prefix
+            if jobs > 1:
+                # Tell the output of the filesystems apart.
+                name = f"{prefix} {part.name}" if prefix else part.name
+            start = time.monotonic()
+            with phase_context(phase, name), \
+                    trace.span(f"mkfs {part.name}", cat="mkfs", fs=part.fs):
+                format(*target)
+            return time.monotonic() - start
+
+        with futures.ThreadPoolExecutor(jobs) as pool:
+            timings = list(pool.map(timed, targets))
+        for (part, _), elapsed in zip(targets, timings):
+            self.logging.info(
+                f"Formatted {part.name} ({part.fs}) in {elapsed:.2f}s.")
+
+    def _mkfs(self, fs, fs_type, label, name, options=None):
         """Formatting the filesystem."""
         self.logging.info(f"Formatting filesystems for {name}.")
 
+        options = list(options or [])
         if fs_type == "vfat":
             # vfat is a special case
-            subprocess.run(
-                ["mkfs.vfat", "-F", "32", "-n", label, fs],
-                check=True)
+            cmd = ["mkfs.vfat", "-F", "32", "-n", label, *options, fs]
         else:
-            subprocess.run(
-                ["mkfs", "-t", fs_type, "-L", label, fs], check=True)
-
-    def losetup(self):
-        """Find an empty loopt back device."""
-        cmd = f"losetup -P  --find --show {self.image}"
-        return subprocess.run(shlex.split(cmd),
-                              encoding="utf8",
-                              check=True,
-                              stdout=subprocess.PIPE).stdout.strip()
+            cmd = ["mkfs", "-t", fs_type, "-L", label, *options, fs]
+        utils.run_command(cmd)
@@ -9,11 +9,21 @@ import os
 import shutil
 
 from ruck import exceptions
+from ruck.schema import phase_schema
 from ruck.stages.base import Base
 from ruck.utils import run_command
 
+SCHEMA = phase_schema({
+    "image": {"type": "string", "required": True},
+    "size": {"type": "string", "required": True},
+    "definitions": {"type": "string", "required": True},
+})
+
 
 class RepartPlugin(Base):
+    SCHEMA = SCHEMA
+    TOOLS = ["systemd-repart"]
+
     def __init__(self, state, config, workspace):
         self.state = state
         self.config = config
@@ -62,3 +72,9 @@ class RepartPlugin(Base):
 
     def post_install(self):
         self.logging.info(f"{self.image} can be found at {self.workspace}.")
+
+    def inputs(self):
+        return [self.workspace.joinpath(self.config.options.definitions)]
+
+    def outputs(self):
+        return [self.workspace.joinpath(self.config.options.image)]
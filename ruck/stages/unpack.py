@@ -7,20 +7,18 @@ SPDX-License-Identifier: Apache-2.0
 import logging
 
 from ruck.archive import unpack
+from ruck.schema import phase_schema
 from ruck.stages.base import Base
 
-SCHEMA = {
-    "target": {"type": "string"},
-    "options": {
-        "type": "dict",
-        "schema": {
-                "target": {"type": "string", "required": True}
-            },
-        }
-}
+SCHEMA = phase_schema({
+    "target": {"type": "string", "required": True},
+})
 
 
 class UnpackPlugin(Base):
+    SCHEMA = SCHEMA
+    TOOLS = ["tar"]
+
     def __init__(self, state, config, workspace):
         self.state = state
         self.config = config
@@ -36,3 +34,9 @@ class UnpackPlugin(Base):
         self.logging.info(f"Unpacking {self.rootfs}.")
         self.rootfs.mkdir(parents=True, exist_ok=True)
         unpack(self.target, self.rootfs)
+
+    def inputs(self):
+        return [self.workspace.joinpath(self.options.get("target"))]
+
+    def outputs(self):
+        return [self.rootfs]
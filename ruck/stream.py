@@ -0,0 +1,46 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import threading
+
+from ruck import exceptions
+
+_lock = threading.Lock()
+_producers = {}
+_consumed = set()
+
+
+def register(path, producer):
+    """Stream an artifact to its consumer instead of writing it.
+
+    producer is called with the command reading the uncompressed tar
+    stream of the artifact from its standard input.
+    """
+    with _lock:
+        _producers[str(path)] = producer
+        _consumed.discard(str(path))
+
+
+def streamed(path):
+    """Check if an artifact is streamed rather than written to disk."""
+    with _lock:
+        return str(path) in _producers or str(path) in _consumed
+
+
+def take(path):
+    """Return the producer of a streamed artifact, or None.
+
+    A stream can only be consumed once.
+    """
+    with _lock:
+        if str(path) in _consumed:
+            raise exceptions.ConfigError(
+                f"{path} is streamed to another phase already, "
+                "disable stream to write it to disk.")
+        producer = _producers.pop(str(path), None)
+        if producer is not None:
+            _consumed.add(str(path))
+        return producer
@@ -0,0 +1,122 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import json
+import logging
+import os
+import shutil
+
+from ruck import checksum
+from ruck import utils
+
+LOG = logging.getLogger(__name__)
+
+
+def sync_tree(source, target, manifest, checksums=False):
+    """Incrementally copy a directory tree.
+
+    Only files whose size or modification time differ are copied, and
+    files removed from the source since the last sync, as recorded in
+    the manifest file, are removed from the target along with the
+    directories they leave empty. Files that exist only in the target
+    and were never synced are left alone.
+
+    Return the number of files and bytes copied.
+    """
+    previous = _load(manifest)
+    synced = {}
+    copied = 0
+    copied_bytes = 0
+
+    for root, dirs, files in os.walk(source):
+        rel = os.path.relpath(root, source)
+        if rel == ".":
+            rel = ""
+        os.makedirs(os.path.join(target, rel), exist_ok=True)
+        if rel:
+            synced[rel] = "dir"
+        # Symlinks to directories are synced as links.
+        links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+        dirs[:] = [d for d in dirs if d not in links]
+        for name in files + links:
+            path = os.path.join(rel, name)
+            src = os.path.join(source, path)
+            dst = os.path.join(target, path)
+            st = os.lstat(src)
+            synced[path] = [st.st_size, st.st_mtime_ns]
+            if not _changed(src, dst, st, checksums):
+                continue
+
+            _copy(src, dst)
+            copied += 1
+            copied_bytes += st.st_size
+
+    removed = set(previous) - set(synced)
+    for path in removed:
+        if previous[path] == "dir":
+            continue
+        LOG.debug(f"Removing {path}.")
+        try:
+            os.unlink(os.path.join(target, path))
+        except OSError:
+            pass
+    # Deepest directories first, keeping the ones holding files that
+    # were not synced.
+    for path in sorted((p for p in removed if previous[p] == "dir"),
+                       reverse=True):
+        try:
+            os.rmdir(os.path.join(target, path))
+        except OSError:
+            continue
+        LOG.debug(f"Removed {path}.")
+
+    os.makedirs(os.path.dirname(manifest), exist_ok=True)
+    with open(manifest, "w") as f:
+        json.dump(synced, f)
+    return (copied, copied_bytes)
+
+
+def _changed(src, dst, st, checksums):
+    """Check if a file has to be copied."""
+    try:
+        dst_st = os.lstat(dst)
+    except OSError:
+        return True
+    if os.path.islink(src) or os.path.islink(dst):
+        return not (os.path.islink(src) and os.path.islink(dst)
+                    and os.readlink(src) == os.readlink(dst))
+    if st.st_size != dst_st.st_size:
+        return True
+    if st.st_mtime_ns == dst_st.st_mtime_ns:
+        return False
+    if checksums and checksum.file_digest(src) == checksum.file_digest(dst):
+        shutil.copystat(src, dst)
+        return False
+    return True
+
+
+def _copy(src, dst):
+    """Replace a file, sharing its data with the source if possible."""
+    tmp = f"{dst}.ruck-sync"
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), tmp)
+    else:
+        utils.clone_file(src, tmp)
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    # Files are replaced rather than rewritten so that hardlinks to the
+    # previous version are left untouched.
+    os.replace(tmp, dst)
+
+
+def _load(manifest):
+    try:
+        with open(manifest, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
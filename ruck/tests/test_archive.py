@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+from unittest import mock
+
+import fixtures
+
+from ruck import archive
+from ruck import exceptions
+from ruck import stream
+from ruck.tests import base
+from ruck import utils
+
+
+class TestArchive(base.TestCase):
+
+    def setUp(self):
+        super(TestArchive, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.rootfs = os.path.join(self.path, "rootfs")
+        os.makedirs(os.path.join(self.rootfs, "etc"))
+        with open(os.path.join(self.rootfs, "etc/hostname"), "w") as f:
+            f.write("ruck\n" * 1000)
+
+    def test_format_from_name(self):
+        self.assertEqual("zstd", archive.format_from_name("rootfs.tar.zst"))
+        self.assertEqual("gzip", archive.format_from_name("a-0.1.tgz"))
+        self.assertEqual("tar", archive.format_from_name("rootfs.tar"))
+        self.assertRaises(exceptions.ConfigError,
+                          archive.format_from_name, "rootfs")
+
+    def test_compressor(self):
+        with mock.patch("shutil.which", return_value=True):
+            self.assertEqual(["zstd", "-19", "-T0", "-c"],
+                             archive.compressor("zstd", level=19, threads=0))
+            self.assertEqual(["pigz", "-d", "-p", "4", "-c"],
+                             archive.compressor("gzip", threads=4,
+                                                decompress=True))
+            self.assertIsNone(archive.compressor("tar"))
+        with mock.patch("shutil.which", return_value=None):
+            self.assertRaises(exceptions.CommandNotFoundError,
+                              archive.compressor, "lz4")
+
+    def test_environment(self):
+        self.assertEqual({"XZ_OPT": "-6 -T0"},
+                         archive.environment("xz", level=6, threads=0))
+        self.assertEqual({}, archive.environment("zstd"))
+
+    def test_detect_and_unpack(self):
+        for fmt, fmt_info in archive.FORMATS.items():
+            if fmt_info["programs"] and not any(
+                    shutil.which(p) for p in fmt_info["programs"]):
+                continue
+            name = f"rootfs{fmt_info['extensions'][0]}"
+            path = os.path.join(self.path, name)
+            archive.pack(self.rootfs, path, level=1, threads=1)
+            # Detected from the content, not the name.
+            os.rename(path, os.path.join(self.path, "rootfs.img"))
+            path = os.path.join(self.path, "rootfs.img")
+            self.assertEqual(fmt, archive.detect(path))
+
+            target = os.path.join(self.path, fmt)
+            os.makedirs(target)
+            archive.unpack(path, target)
+            with open(os.path.join(target, "etc/hostname")) as f:
+                self.assertEqual("ruck\n" * 1000, f.read())
+
+    def test_detect_unknown(self):
+        path = os.path.join(self.path, "rootfs.tar.gz")
+        with open(path, "w") as f:
+            f.write("not an archive")
+        self.assertRaises(exceptions.ConfigError, archive.detect, path)
+
+    def test_unpack_stream(self):
+        path = os.path.join(self.path, "rootfs.tar.gz")
+
+        def producer(consumer):
+            utils.run_pipeline(
+                [["tar", "-C", self.rootfs, "-cf", "-", "."], consumer])
+        stream.register(path, producer)
+        self.assertTrue(stream.streamed(path))
+
+        target = os.path.join(self.path, "target")
+        os.makedirs(target)
+        archive.unpack(path, target)
+        self.assertFalse(os.path.exists(path))
+        with open(os.path.join(target, "etc/hostname")) as f:
+            self.assertEqual("ruck\n" * 1000, f.read())
+        # A stream is consumed once.
+        self.assertRaises(exceptions.ConfigError,
+                          archive.unpack, path, target)
+
+    def test_index_and_extract(self):
+        os.symlink("hostname", os.path.join(self.rootfs, "etc/name"))
+        for fmt, fmt_info in archive.FORMATS.items():
+            if fmt_info["programs"] and not any(
+                    shutil.which(p) for p in fmt_info["programs"]):
+                continue
+            path = os.path.join(self.path,
+                                f"rootfs{fmt_info['extensions'][0]}")
+            archive.pack(self.rootfs, path, level=1, threads=1)
+            index = archive.write_index(path)
+            self.assertEqual(fmt, index["format"])
+            entries = {e["path"]: e for e in archive.members(path)}
+            self.assertEqual("file", entries["etc/hostname"]["type"])
+            self.assertEqual(5000, entries["etc/hostname"]["size"])
+            self.assertEqual("hostname", entries["etc/name"]["linkname"])
+            self.assertEqual(b"ruck\n" * 1000,
+                             archive.extract(path, "./etc/hostname"))
+            self.assertRaises(exceptions.ConfigError,
+                              archive.extract, path, "etc/name")
+
+    def test_index_stale(self):
+        path = os.path.join(self.path, "rootfs.tar")
+        archive.pack(self.rootfs, path)
+        archive.write_index(path)
+        with open(os.path.join(self.rootfs, "etc/hostname"), "w") as f:
+            f.write("updated\n")
+        archive.pack(self.rootfs, path)
+        self.assertEqual(b"updated\n", archive.extract(path, "etc/hostname"))
+
+    def test_copy_index(self):
+        path = os.path.join(self.path, "rootfs.tar")
+        copy = os.path.join(self.path, "copy.tar")
+        archive.pack(self.rootfs, path)
+        archive.write_index(path)
+        shutil.copy(path, copy)
+        archive.copy_index(path, copy)
+        with mock.patch.object(archive, "write_index") as write_index:
+            self.assertEqual(b"ruck\n" * 1000,
+                             archive.extract(copy, "etc/hostname"))
+        write_index.assert_not_called()
+
+    def test_seekable_gzip(self):
+        with open(os.path.join(self.rootfs, "etc/random"), "wb") as f:
+            f.write(os.urandom(300 * 1024))
+        tar = os.path.join(self.path, "rootfs.tar")
+        path = os.path.join(self.path, "rootfs.tar.gz")
+        archive.pack(self.rootfs, tar)
+        with mock.patch.object(archive, "SEEKABLE_CHUNK_SIZE", 64 * 1024):
+            archive.compress(tar, path, seekable=True, threads=2)
+        index = archive.write_index(path)
+        self.assertGreater(len(index["members"]), 4)
+
+        target = os.path.join(self.path, "target")
+        os.makedirs(target)
+        archive.unpack(path, target)
+        with open(os.path.join(target, "etc/random"), "rb") as f:
+            random = f.read()
+        self.assertEqual(random, archive.extract(path, "etc/random"))
+        self.assertEqual(b"ruck\n" * 1000,
+                         archive.extract(path, "etc/hostname"))
+        self.assertRaises(exceptions.ConfigError, archive.compress,
+                          tar, path, fmt="zstd", seekable=True)
+
+    def test_diff(self):
+        old = os.path.join(self.path, "old.tar.gz")
+        new = os.path.join(self.path, "new.tar.gz")
+        with open(os.path.join(self.rootfs, "etc/removed"), "w") as f:
+            f.write("removed\n")
+        archive.pack(self.rootfs, old)
+        os.unlink(os.path.join(self.rootfs, "etc/removed"))
+        with open(os.path.join(self.rootfs, "etc/added"), "w") as f:
+            f.write("added\n")
+        with open(os.path.join(self.rootfs, "etc/hostname"), "w") as f:
+            f.write("changed\n")
+        archive.pack(self.rootfs, new)
+        self.assertEqual(
+            (["etc/added"], ["etc/removed"], ["etc/hostname"]),
+            archive.diff(old, new))
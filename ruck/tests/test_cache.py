@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import pathlib
+from unittest import mock
+
+import fixtures
+from omegaconf import OmegaConf
+
+from ruck.cache import PhaseCache
+from ruck.tests import base
+
+
+class FakeStage(object):
+    def __init__(self, workspace, inputs=(), outputs=()):
+        self._inputs = [workspace.joinpath(p) for p in inputs]
+        self._outputs = [workspace.joinpath(p) for p in outputs]
+
+    def inputs(self):
+        return self._inputs
+
+    def outputs(self):
+        return self._outputs
+
+    def run(self):
+        for path in self._outputs:
+            with open(path, "a") as f:
+                f.write("x")
+
+
+class TestPhaseCache(base.TestCase):
+
+    def setUp(self):
+        super(TestPhaseCache, self).setUp()
+        self.workspace = pathlib.Path(
+            self.useFixture(fixtures.TempDir()).path)
+
+    def _stages(self, cmdline="quiet"):
+        def phase(name, **options):
+            return OmegaConf.create(
+                {"name": name, "stage": name, "options": options})
+        ws = self.workspace
+        return [
+            (phase("bootstrap", suite="bookworm"),
+             FakeStage(ws, outputs=["rootfs.tar.gz"])),
+            (phase("repart", size="10G"),
+             FakeStage(ws, outputs=["disk.img"])),
+            (phase("deploy"),
+             FakeStage(ws, inputs=["rootfs.tar.gz", "disk.img"],
+                       outputs=["disk.img"])),
+            (phase("bootloader", kernel_cmdline=cmdline),
+             FakeStage(ws, inputs=["disk.img"], outputs=["disk.img"])),
+        ]
+
+    def _build(self, stages, **kwargs):
+        cache = PhaseCache(self.workspace, **kwargs)
+        run = cache.plan(stages)
+        for index, (phase, stage) in enumerate(stages):
+            if run[index]:
+                stage.run()
+            cache.record(index, phase, stage)
+        return run
+
+    def test_unchanged_build_is_cached(self):
+        self.assertEqual([True] * 4, self._build(self._stages()))
+        self.assertEqual([False] * 4, self._build(self._stages()))
+
+    def test_changed_phase_replays_modified_artifacts(self):
+        self._build(self._stages())
+        run = self._build(self._stages(cmdline="console=ttyS0"))
+        self.assertEqual([False, True, True, True], run)
+
+    def test_missing_output(self):
+        self._build(self._stages())
+        self.workspace.joinpath("rootfs.tar.gz").unlink()
+        self.assertEqual([True, False, False, False],
+                         self._build(self._stages()))
+
+    def test_streamed_output(self):
+        def stages(size):
+            stages = self._stages()
+            stages[1][0].options.size = size
+            # The bootstrap tarball is streamed, never written.
+            stages[0][1].run = lambda: None
+            return stages
+        self.assertEqual([True] * 4, self._build(stages("10G")))
+        self.assertEqual([True] * 4, self._build(stages("20G")))
+
+    def test_no_cache(self):
+        self._build(self._stages())
+        self.assertEqual([True] * 4,
+                         self._build(self._stages(), enabled=False))
+
+    def test_directory_input_is_memoized(self):
+        overlay = self.workspace.joinpath("overlay")
+        overlay.mkdir()
+        overlay.joinpath("hostname").write_text("ruck\n")
+        stages = self._stages()
+        stages[0][1]._inputs.append(overlay)
+        self._build(stages)
+        with mock.patch("ruck.checksum.tree_digest") as tree_digest:
+            self.assertEqual([False] * 4, self._build(stages))
+        tree_digest.assert_not_called()
+        overlay.joinpath("hostname").write_text("other\n")
+        self.assertEqual([True] * 4, self._build(stages))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import pathlib
+from unittest import mock
+
+import fixtures
+
+from ruck.cmd import State
+from ruck import config
+from ruck.config import Config
+from ruck import exceptions
+from ruck.tests import base
+
+
+class TestConfig(base.TestCase):
+
+    def setUp(self):
+        super(TestConfig, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.state = State()
+        self.state.config = pathlib.Path(self.path, "config", "image.yaml")
+        self.state.workspace = pathlib.Path(self.path, "workspace")
+
+        os.makedirs(os.path.join(self.path, "config", "include"))
+        self._write("config/image.yaml",
+                    "name: test\n"
+                    "packages: !include include/packages.yaml\n")
+        self._write("config/include/packages.yaml",
+                    "- !include common.yaml\n"
+                    "- vim\n")
+        self._write("config/include/common.yaml", "bash\n")
+
+    def _write(self, path, content):
+        with open(os.path.join(self.path, path), "w") as f:
+            f.write(content)
+
+    def test_include_relative_to_file(self):
+        c = Config(self.state)
+        self.assertEqual(["bash", "vim"], list(c.load_config().packages))
+        self.assertEqual(
+            sorted(os.path.join(self.path, "config", p) for p in
+                   ["image.yaml", "include/packages.yaml",
+                    "include/common.yaml"]),
+            sorted(c.dependencies))
+
+    def test_recursive_include(self):
+        self._write("config/include/common.yaml", "!include packages.yaml\n")
+        self.assertRaises(exceptions.ConfigError,
+                          Config(self.state).load_config)
+
+    def test_cached(self):
+        Config(self.state).load_config()
+        with mock.patch.object(config, "load_yaml") as load_yaml:
+            c = Config(self.state)
+            self.assertEqual(["bash", "vim"], list(c.load_config().packages))
+            self.assertFalse(load_yaml.called)
+        self.assertEqual(3, len(c.dependencies))
+
+    def test_include_changed(self):
+        Config(self.state).load_config()
+        self._write("config/include/common.yaml", "zsh\n")
+        self.assertEqual(["zsh", "vim"],
+                         list(Config(self.state).load_config().packages))
+
+    def test_no_cache(self):
+        self.state.no_cache = True
+        Config(self.state).load_config()
+        self.assertFalse(os.path.exists(self.state.workspace))
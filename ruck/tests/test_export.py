@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import os
+import pathlib
+import shutil
+import struct
+import subprocess
+from unittest import mock
+import zlib
+
+import fixtures
+from omegaconf import OmegaConf
+
+from ruck.cmd import State
+from ruck import exceptions
+from ruck import export
+from ruck.stages.export import ExportPlugin
+from ruck.tests import base
+
+MIB = 1024 * 1024
+
+
+def read_qcow2(path):
+    """Return the virtual disk of a qcow2 image and the refcounts of its
+    clusters.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    (magic, version, _, _, cluster_bits, size, _, l1_size, l1_offset,
+     rt_offset, rt_clusters) = struct.unpack_from(">4sIQIIQIIQQI", data)
+    assert (magic, version, cluster_bits) == (b"QFI\xfb", 3, 16)
+    cluster_size = 1 << cluster_bits
+    disk = bytearray(size)
+    used = {}
+
+    def use(offset, length):
+        for cluster in range(offset // cluster_size,
+                             (offset + length - 1) // cluster_size + 1):
+            used[cluster] = used.get(cluster, 0) + 1
+
+    use(0, cluster_size)
+    use(l1_offset, l1_size * 8)
+    for index, l2 in enumerate(struct.unpack_from(f">{l1_size}Q", data,
+                                                  l1_offset)):
+        if not l2:
+            continue
+        l2 &= (1 << 62) - 1
+        use(l2, cluster_size)
+        for slot, entry in enumerate(struct.unpack_from(
+                f">{cluster_size // 8}Q", data, l2)):
+            guest = (index * cluster_size // 8 + slot) * cluster_size
+            if entry & export.OFLAG_COMPRESSED:
+                offset = entry & ((1 << export.CSIZE_SHIFT) - 1)
+                sectors = (entry >> export.CSIZE_SHIFT) & 0xff
+                length = (sectors + 1) * 512 - offset % 512
+                use(offset, length)
+                cluster = zlib.decompressobj(-12).decompress(
+                    data[offset:offset + length], cluster_size)
+            elif entry:
+                offset = entry & ((1 << 62) - 1)
+                use(offset, cluster_size)
+                cluster = data[offset:offset + cluster_size]
+            else:
+                continue
+            disk[guest:guest + cluster_size] = cluster[:size - guest]
+    table = struct.unpack_from(
+        f">{rt_clusters * cluster_size // 8}Q", data, rt_offset)
+    use(rt_offset, rt_clusters * cluster_size)
+    refcounts = {}
+    for block, offset in enumerate(table):
+        if not offset:
+            continue
+        use(offset, cluster_size)
+        for i, count in enumerate(struct.unpack_from(
+                f">{cluster_size // 2}H", data, offset)):
+            if count:
+                refcounts[block * cluster_size // 2 + i] = count
+    return (bytes(disk), refcounts, used)
+
+
+class TestExport(base.TestCase):
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.image = os.path.join(self.path, "disk.img")
+        with open(self.image, "wb") as f:
+            f.truncate(64 * MIB + 4096)
+            f.seek(MIB + 100)
+            f.write(b"boot" * 1000)
+            # Incompressible data spanning clusters.
+            f.seek(32 * MIB - 4096)
+            f.write(os.urandom(3 * 65536))
+            f.seek(64 * MIB)
+            f.write(b"end")
+        with open(self.image, "rb") as f:
+            self.disk = f.read()
+
+    def test_qcow2(self):
+        path = os.path.join(self.path, "disk.qcow2")
+        digests = export.export(self.image, {"qcow2": path})
+        (disk, refcounts, used) = read_qcow2(path)
+        self.assertEqual(self.disk, disk)
+        self.assertEqual(used, refcounts)
+        self.assertLess(os.path.getsize(path), 2 * MIB)
+        with open(path, "rb") as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(),
+                             digests["qcow2"])
+
+    def test_qcow2_compressed(self):
+        path = os.path.join(self.path, "disk.qcow2")
+        export.export(self.image, {"qcow2": path}, compress=True, threads=2)
+        (disk, refcounts, used) = read_qcow2(path)
+        self.assertEqual(self.disk, disk)
+        self.assertEqual(used, refcounts)
+
+    def test_qcow2_qemu_img(self):
+        if shutil.which("qemu-img") is None:
+            self.skipTest("qemu-img is not found.")
+        path = os.path.join(self.path, "disk.qcow2")
+        export.export(self.image, {"qcow2": path}, compress=True)
+        subprocess.run(["qemu-img", "check", path], check=True)
+        subprocess.run(["qemu-img", "compare", self.image, path],
+                       check=True)
+
+    def test_no_checksums(self):
+        path = os.path.join(self.path, "disk.qcow2")
+        with mock.patch("builtins.open", side_effect=open) as m:
+            digests = export.export(self.image, {"qcow2": path},
+                                    checksums=False)
+        self.assertEqual({"qcow2": None}, digests)
+        # The image is not read back.
+        self.assertNotIn(mock.call(path, "rb"), m.call_args_list)
+        self.assertEqual(self.disk, read_qcow2(path)[0])
+
+    def test_raw_zst(self):
+        if shutil.which("zstd") is None:
+            self.skipTest("zstd is not found.")
+        path = os.path.join(self.path, "disk.raw.zst")
+        digests = export.export(self.image, {"raw.zst": path}, threads=2)
+        with open(path, "rb") as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(),
+                             digests["raw.zst"])
+        out = subprocess.run(["zstd", "-dc", path], check=True,
+                             stdout=subprocess.PIPE).stdout
+        self.assertEqual(self.disk, out)
+
+    def test_several_formats(self):
+        for tool in ["zstd", "xz"]:
+            if shutil.which(tool) is None:
+                self.skipTest(f"{tool} is not found.")
+        outputs = {fmt: os.path.join(self.path, f"disk.{fmt}")
+                   for fmt in export.FORMATS}
+        digests = export.export(self.image, outputs)
+        self.assertEqual(set(export.FORMATS), set(digests))
+        out = subprocess.run(["xz", "-dc", outputs["raw.xz"]], check=True,
+                             stdout=subprocess.PIPE).stdout
+        self.assertEqual(self.disk, out)
+        self.assertEqual(self.disk, read_qcow2(outputs["qcow2"])[0])
+
+    def test_failure(self):
+        path = os.path.join(self.path, "disk.qcow2")
+        self.assertRaises(exceptions.ConfigError, export.export,
+                          self.image, {"qcow2": path, "raw.gz": "x"})
+        self.assertFalse(os.path.exists(path))
+
+    def test_export_stage(self):
+        phase = OmegaConf.create({
+            "name": "export", "stage": "export",
+            "options": {"image": "disk.img", "formats": ["qcow2"],
+                        "compress": True, "checksum": False}})
+        plugin = ExportPlugin(State(), phase, pathlib.Path(self.path))
+        self.assertEqual([], plugin.TOOLS)
+        self.assertEqual([pathlib.Path(self.path, "disk.qcow2")],
+                         plugin.outputs())
+        plugin.preflight_check()
+        plugin.run()
+        path = os.path.join(self.path, "disk.qcow2")
+        self.assertEqual(self.disk, read_qcow2(path)[0])
+        self.assertFalse(os.path.exists(f"{path}.sha256"))
+        plugin.config.options.checksum = True
+        plugin.run()
+        with open(f"{path}.sha256") as f:
+            (digest, name) = f.read().split()
+        self.assertEqual("disk.qcow2", name)
+        with open(path, "rb") as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(), digest)
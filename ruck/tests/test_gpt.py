@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import pathlib
+import shutil
+import subprocess
+import uuid
+from unittest import mock
+
+import fixtures
+from omegaconf import OmegaConf
+
+from ruck.cmd import State
+from ruck import exceptions
+from ruck import gpt
+from ruck.log import current_phase
+from ruck.log import current_prefix
+from ruck.log import phase_context
+from ruck import populate
+from ruck.stages.parted import PartedPlugin
+from ruck.tests import base
+from ruck import utils
+
+MIB = 1024 * 1024
+
+SPECS = [
+    {"name": "EFI", "start": "0%", "end": "16MiB", "flags": ["boot", "esp"]},
+    {"name": "ROOT", "start": "16MiB", "end": "100%",
+     "type": "4F68BCE3-E8CD-4DB1-96E7-FBCAF984B709",
+     "flags": ["legacy_boot"]},
+]
+
+
+class TestGpt(base.TestCase):
+
+    def setUp(self):
+        super(TestGpt, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.image = os.path.join(self.path, "disk.img")
+        with open(self.image, "wb") as f:
+            f.truncate(64 * MIB)
+
+    def test_parse(self):
+        self.assertEqual(10 * 1024 ** 3, gpt.parse_size("10G"))
+        self.assertEqual(2 * 1000 ** 2, gpt.parse_size("2MB"))
+        self.assertRaises(exceptions.ConfigError, gpt.parse_size, "10X")
+        self.assertEqual(256 * 1000 ** 2, gpt.parse_offset("256MB", 0))
+        self.assertEqual(256 * 1000 ** 2, gpt.parse_offset("256", 0))
+        self.assertEqual(2048 * 512, gpt.parse_offset("2048s", 0))
+        self.assertEqual(50, gpt.parse_offset("50%", 100))
+        self.assertEqual(64 * MIB - MIB, gpt.parse_offset("-1MiB", 64 * MIB))
+
+    def test_layout(self):
+        (efi, root) = gpt.layout(SPECS, 64 * MIB, seed="disk.img")
+        self.assertEqual((gpt.ESP, MIB, 15 * MIB, 0),
+                         (efi.type, efi.start, efi.size, efi.attributes))
+        self.assertEqual(gpt.ROOT["amd64"], root.type)
+        self.assertEqual(16 * MIB, root.start)
+        # The end of the disk holds the backup table.
+        self.assertEqual(64 * MIB - 33 * 512, root.start + root.size)
+        self.assertEqual(4, root.attributes)
+        # Reproducible.
+        self.assertEqual([efi, root],
+                         gpt.layout(SPECS, 64 * MIB, seed="disk.img"))
+
+    def test_layout_errors(self):
+        self.assertRaises(
+            exceptions.ConfigError, gpt.layout,
+            [{"name": "A", "start": "0%", "end": "32MiB"},
+             {"name": "B", "start": "16MiB", "end": "100%"}], 64 * MIB)
+        self.assertRaises(
+            exceptions.ConfigError, gpt.layout,
+            [{"name": "A", "start": "32MiB", "end": "16MiB"}], 64 * MIB)
+        self.assertRaises(
+            exceptions.ConfigError, gpt.layout,
+            [{"name": "A", "start": "0%", "end": "100%",
+              "flags": ["unknown"]}], 64 * MIB)
+
+    def test_write_table(self):
+        partitions = gpt.layout(SPECS, 64 * MIB, seed="disk.img")
+        gpt.write_table(self.image, partitions, uuid.uuid4())
+        self.assertEqual(partitions, gpt.verify(self.image))
+        # Sparse but for the tables.
+        self.assertLess(os.stat(self.image).st_blocks * 512, MIB)
+        if shutil.which("blkid"):
+            out = subprocess.check_output(
+                ["blkid", "--probe", "--output", "export", self.image],
+                text=True)
+            self.assertIn("PTTYPE=gpt", out.splitlines())
+
+    def test_verify_corrupted(self):
+        partitions = gpt.layout(SPECS, 64 * MIB)
+        gpt.write_table(self.image, partitions, uuid.uuid4())
+        with open(self.image, "r+b") as f:
+            f.seek(64 * MIB - 512 - 32 * 512)
+            f.write(b"\xff")
+        self.assertRaises(exceptions.ConfigError, gpt.verify, self.image)
+
+    def test_parted_stage(self):
+        phase = OmegaConf.create({
+            "name": "parted", "stage": "parted",
+            "options": {
+                "image": {"name": "disk.img", "size": "64M",
+                          "label": "gpt"},
+                "partitions": SPECS,
+                "filesystems": [],
+            }})
+        plugin = PartedPlugin(State(), phase, pathlib.Path(self.path))
+        plugin.preflight_check()
+        plugin._create_image()
+        plugin._create_label()
+        plugin._create_partitions()
+        self.assertEqual(64 * MIB, os.path.getsize(self.image))
+        self.assertEqual(["EFI", "ROOT"],
+                         [p.name for p in gpt.verify(self.image)])
+
+    def test_splice_file(self):
+        src = os.path.join(self.path, "part.img")
+        with open(src, "wb") as f:
+            f.truncate(4 * MIB)
+            f.seek(MIB)
+            f.write(b"data")
+        with open(self.image, "wb") as f:
+            f.truncate(16 * MIB)
+        utils.splice_file(src, self.image, 8 * MIB)
+        with open(self.image, "rb") as f:
+            f.seek(9 * MIB)
+            self.assertEqual(b"data", f.read(4))
+        self.assertLess(os.stat(self.image).st_blocks * 512, 4 * MIB)
+
+    def test_parted_assemble(self):
+        for tool in ["mkfs.ext4", "blkid"]:
+            if shutil.which(tool) is None:
+                self.skipTest(f"{tool} is not found.")
+        phase = OmegaConf.create({
+            "name": "parted", "stage": "parted",
+            "options": {
+                "image": {"name": "disk.img", "size": "64M",
+                          "label": "gpt"},
+                "method": "assemble",
+                "jobs": 2,
+                "partitions": [
+                    {"name": "DATA", "start": "0%", "end": "16MiB"},
+                    SPECS[1]],
+                "filesystems": [
+                    {"name": "DATA", "label": "data", "fs": "ext4",
+                     "options": ["-E", "lazy_itable_init=1,nodiscard"]},
+                    {"name": "ROOT", "label": "root", "fs": "ext4"}],
+            }})
+        plugin = PartedPlugin(State(), phase, pathlib.Path(self.path))
+        self.assertNotIn("losetup", plugin.TOOLS)
+        plugin.preflight_check()
+        plugin.run()
+        for partition, label in zip(gpt.verify(self.image),
+                                    ["data", "root"]):
+            info = populate.probe(self.image, partition)
+            self.assertEqual("ext4", info["TYPE"])
+            self.assertEqual(label, info["LABEL"])
+        self.assertFalse(os.path.exists(plugin._parts()))
+
+    def test_mkfs_options(self):
+        phase = OmegaConf.create({
+            "name": "parted", "stage": "parted",
+            "options": {
+                "image": {"name": "disk.img", "size": "64M",
+                          "label": "gpt"},
+                "partitions": SPECS,
+                "filesystems": [],
+            }})
+        plugin = PartedPlugin(State(), phase, pathlib.Path(self.path))
+        with mock.patch("ruck.utils.run_command") as run_command:
+            plugin._mkfs("/dev/loop0p2", "ext4", "ROOT", "ROOT",
+                         ["-E", "nodiscard"])
+        run_command.assert_called_once_with(
+            ["mkfs", "-t", "ext4", "-L", "ROOT", "-E", "nodiscard",
+             "/dev/loop0p2"])
+
+    def test_format_phase_context(self):
+        phase = OmegaConf.create({
+            "name": "parted", "stage": "parted",
+            "options": {
+                "image": {"name": "disk.img", "size": "64M",
+                          "label": "gpt"},
+                "jobs": 2,
+                "partitions": SPECS,
+                "filesystems": [],
+            }})
+        plugin = PartedPlugin(State(), phase, pathlib.Path(self.path))
+        parts = [OmegaConf.create({"name": name, "label": name, "fs": "ext4"})
+                 for name in ["EFI", "ROOT"]]
+        contexts = {}
+
+        def run_command(cmd, **kwargs):
+            contexts[cmd[-1]] = (current_phase(), current_prefix())
+
+        with mock.patch("ruck.utils.run_command", side_effect=run_command), \
+                phase_context("image: parted", "image 3/5 parted"):
+            plugin._format(
+                [(part, f"/dev/loop0p{index}")
+                 for index, part in enumerate(parts, start=1)],
+                lambda part, fs: plugin._mkfs(
+                    fs, part.fs, part.label, part.name))
+        self.assertEqual({
+            "/dev/loop0p1": ("image: parted", "image 3/5 parted EFI"),
+            "/dev/loop0p2": ("image: parted", "image 3/5 parted ROOT"),
+        }, contexts)
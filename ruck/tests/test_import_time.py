@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import subprocess
+import sys
+
+from ruck.tests import base
+
+# Cumulative import time of the command line entry point, in microseconds.
+# Generous so that slow CI machines do not fail, importing omegaconf or
+# rich alone is enough to exceed it.
+BUDGET = 150000
+
+HEAVY_MODULES = ["rich", "omegaconf", "yaml", "cerberus", "stevedore",
+                 "libvirt", "pbr"]
+
+
+class TestImportTime(base.TestCase):
+
+    def _importtime(self, statement):
+        """Return the cumulative import time of every top level module."""
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", statement],
+            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        modules = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            (self_us, cumulative, name) = line[12:].split("|")
+            if not cumulative.strip().isdigit():
+                continue
+            modules[name.strip()] = int(cumulative)
+        return modules
+
+    def test_no_heavy_imports(self):
+        modules = self._importtime("import ruck.cmd.shell")
+        self.assertIn("ruck.cmd.shell", modules)
+        for name in HEAVY_MODULES:
+            self.assertNotIn(name, modules)
+
+    def test_budget(self):
+        modules = self._importtime("import ruck.cmd.shell")
+        self.assertLess(modules["ruck.cmd.shell"], BUDGET)
+
+    def test_help(self):
+        # Listing the sub-commands only imports the command modules.
+        result = subprocess.run(
+            [sys.executable, "-c",
+             "import sys\n"
+             "from ruck.cmd.shell import cli\n"
+             "cli.main(['--help'], standalone_mode=False)\n"
+             "print(' '.join(sys.modules))"],
+            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        modules = result.stdout.splitlines()[-1].split()
+        self.assertIn("ruck.cmd.build", modules)
+        for name in HEAVY_MODULES + ["ruck.matrix", "ruck.vm"]:
+            self.assertNotIn(name, modules)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import pathlib
+from unittest import mock
+
+import fixtures
+from omegaconf import OmegaConf
+
+from ruck import exceptions
+from ruck.journal import Journal
+from ruck.tests import base
+
+
+class FakeStage(object):
+    def __init__(self, workspace, inputs=(), outputs=()):
+        self._inputs = [workspace.joinpath(p) for p in inputs]
+        self._outputs = [workspace.joinpath(p) for p in outputs]
+
+    def inputs(self):
+        return self._inputs
+
+    def outputs(self):
+        return self._outputs
+
+    def run(self):
+        for path in self._outputs:
+            with open(path, "a") as f:
+                f.write("x")
+
+
+class TestJournal(base.TestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.workspace = pathlib.Path(
+            self.useFixture(fixtures.TempDir()).path)
+
+        def phase(name):
+            return OmegaConf.create({"name": name, "stage": name})
+        ws = self.workspace
+        self.stages = [
+            (phase("bootstrap"), FakeStage(ws, outputs=["rootfs.tar.gz"])),
+            (phase("repart"), FakeStage(ws, outputs=["disk.img"])),
+            (phase("deploy"),
+             FakeStage(ws, inputs=["rootfs.tar.gz", "disk.img"],
+                       outputs=["disk.img"])),
+            (phase("bootloader"),
+             FakeStage(ws, inputs=["disk.img"], outputs=["disk.img"])),
+        ]
+        self.keys = ["a", "b", "c", "d"]
+
+    def _run(self, journal, until):
+        for index, (phase, stage) in enumerate(self.stages[:until]):
+            journal.start(index)
+            stage.run()
+            journal.complete(index, phase, stage, self.keys[index])
+
+    def test_resume(self):
+        self._run(Journal(self.workspace), 3)
+        journal = Journal(self.workspace)
+        self.assertEqual(3, journal.first_incomplete(self.keys))
+        journal.verify(self.stages, self.keys, 3, 4)
+
+        self.keys[1] = "changed"
+        self.assertEqual(1, journal.first_incomplete(self.keys))
+
+    def test_verify_modified_input(self):
+        self._run(Journal(self.workspace), 4)
+        with open(self.workspace.joinpath("rootfs.tar.gz"), "a") as f:
+            f.write("y")
+        self.assertRaises(exceptions.JournalError,
+                          Journal(self.workspace).verify,
+                          self.stages, self.keys, 2, 4)
+
+    def test_verify_incomplete_producer(self):
+        self._run(Journal(self.workspace), 1)
+        self.assertRaises(exceptions.JournalError,
+                          Journal(self.workspace).verify,
+                          self.stages, self.keys, 2, 4)
+
+    def test_outputs_are_not_hashed(self):
+        with mock.patch("ruck.checksum.file_digest") as file_digest:
+            journal = Journal(self.workspace)
+            self._run(journal, 4)
+            journal.refresh(self.workspace.joinpath("disk.img"))
+            Journal(self.workspace).verify(self.stages, self.keys, 2, 4)
+        file_digest.assert_not_called()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import pathlib
+from unittest import mock
+
+import fixtures
+from stevedore.exception import NoMatches
+
+from ruck.cmd import State
+from ruck import exceptions
+from ruck.matrix import Matrix
+from ruck.schema import phase_schema
+from ruck.tests import base
+
+MANIFEST = """
+name: example
+architecture: amd64
+version: 0.1
+schemaVersion: 1
+params:
+  flavor: minimal
+matrix:
+  architecture: [amd64, arm64]
+  params:
+    - flavor: minimal
+    - flavor: full
+phases: []
+"""
+
+SHARED = """
+name: example
+architecture: amd64
+version: 0.1
+schemaVersion: 1
+matrix:
+  params:
+    - flavor: minimal
+    - flavor: full
+phases:
+  - name: bootstrap
+    stage: fake
+    options:
+      target: rootfs.tar
+"""
+
+
+class FakeStage(object):
+    """Stage reading an overlay of the manifest directory."""
+    SCHEMA = phase_schema({"target": {"type": "string"}})
+    TOOLS = []
+    MOUNTS = False
+    mount_manager = None
+    runs = []
+
+    def __init__(self, state, config, workspace):
+        self.config = config
+        self.workspace = workspace
+
+    def preflight_check(self):
+        pass
+
+    def run(self):
+        self.runs.append(self.workspace)
+        self.outputs()[0].write_text("rootfs")
+
+    def post_install(self):
+        pass
+
+    def inputs(self):
+        return [self.workspace.joinpath("overlay")]
+
+    def outputs(self):
+        return [self.workspace.joinpath(self.config.options.target)]
+
+    def scratch(self):
+        return []
+
+
+class TestMatrix(base.TestCase):
+
+    def setUp(self):
+        super(TestMatrix, self).setUp()
+        self.path = pathlib.Path(
+            self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = self.path
+
+    def _manifest(self, content):
+        config = self.path.joinpath("image.yaml")
+        config.write_text(content)
+        self.state.config = config
+        self.state.configs = [config]
+
+    def test_variants(self):
+        self._manifest(MANIFEST)
+        variants = Matrix(self.state).variants()
+        self.assertEqual(
+            ["example-amd64-1", "example-amd64-2",
+             "example-arm64-1", "example-arm64-2"],
+            [label for label, state, overrides in variants])
+        label, state, overrides = variants[3]
+        self.assertEqual("arm64", overrides["architecture"])
+        self.assertEqual({"flavor": "full"}, overrides["params"])
+
+    def test_architecture_option(self):
+        self._manifest(MANIFEST.split("matrix:")[0] + "phases: []\n")
+        self.state.architectures = ["arm64"]
+        variants = Matrix(self.state).variants()
+        self.assertEqual(1, len(variants))
+        self.assertEqual("arm64", variants[0][2]["architecture"])
+
+    def test_unsupported_architecture(self):
+        self._manifest(MANIFEST)
+        self.state.architectures = ["riscv64"]
+        self.assertRaises(exceptions.ConfigError,
+                          Matrix(self.state).variants)
+
+    def test_shared_phase_with_inputs(self):
+        config = self.path.joinpath("manifest")
+        config.joinpath("overlay/etc").mkdir(parents=True)
+        config.joinpath("overlay/etc/hostname").write_text("ruck\n")
+        config.joinpath("image.yaml").write_text(SHARED)
+        self.state.config = config.joinpath("image.yaml")
+        self.state.configs = [self.state.config]
+        self.state.workspace = self.path.joinpath("workspace")
+        FakeStage.runs = []
+        with mock.patch("ruck.build.stage_plugin", return_value=FakeStage):
+            Matrix(self.state).build()
+        self.assertEqual(1, len(FakeStage.runs))
+        for name in ["example-1", "example-2"]:
+            self.assertEqual(
+                "rootfs", self.state.workspace.joinpath(
+                    name, "rootfs.tar").read_text())
+
+    def test_missing_name(self):
+        self._manifest(MANIFEST.replace("name: example\n", ""))
+        e = self.assertRaises(exceptions.SchemaError,
+                              Matrix(self.state).variants)
+        self.assertIn("name: required field", str(e))
+
+    def test_missing_architecture(self):
+        manifest = SHARED.replace("architecture: amd64\n", "")
+        self._manifest(manifest.split("matrix:")[0]
+                       + "phases:" + manifest.split("phases:")[1])
+        # Keep the workspace out of the synced manifest directory.
+        self.state.workspace = pathlib.Path(
+            self.useFixture(fixtures.TempDir()).path)
+        with mock.patch("ruck.build.stage_plugin", return_value=FakeStage):
+            e = self.assertRaises(exceptions.SchemaError,
+                                  Matrix(self.state).build)
+        self.assertIn("architecture: required field", str(e))
+
+    def test_phase_numbers(self):
+        self._manifest(SHARED.split("matrix:")[0] + """phases:
+  - name: a
+    stage: fake
+    options:
+      target: rootfs.tar
+  - name: b
+    stage: unknown
+    options: {}
+  - name: c
+    stage: fake
+    options:
+      target: 1
+""")
+        self.state.workspace = pathlib.Path(
+            self.useFixture(fixtures.TempDir()).path)
+
+        def stage_plugin(name):
+            if name != "fake":
+                raise NoMatches(name)
+            return FakeStage
+        with mock.patch("ruck.build.stage_plugin", side_effect=stage_plugin):
+            e = self.assertRaises(exceptions.SchemaError,
+                                  Matrix(self.state).build)
+        self.assertIn("phase 2: unknown stage unknown.", str(e))
+        self.assertIn("phase 3 (c): options.target: must be of string type",
+                      str(e))
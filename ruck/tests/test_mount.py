@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+from unittest import mock
+
+import fixtures
+
+from ruck.mount import MountManager
+from ruck.tests import base
+
+
+class FakeStage(object):
+    MOUNTS = False
+
+    def __init__(self, outputs=(), scratch=()):
+        self._outputs = list(outputs)
+        self._scratch = list(scratch)
+
+    def inputs(self):
+        return []
+
+    def outputs(self):
+        return self._outputs
+
+    def scratch(self):
+        return self._scratch
+
+
+class TestMountManager(base.TestCase):
+
+    def setUp(self):
+        super(TestMountManager, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.registry = os.path.join(self.path, ".ruck", "mounts.json")
+        self.image = os.path.join(self.path, "disk.img")
+        self.rootfs = os.path.join(self.path, "rootfs")
+        self.commands = []
+        self.mounted = set()
+
+        def run_command(cmd, **kwargs):
+            self.commands.append(cmd[:2])
+            if cmd[:2] == ["systemd-dissect", "-M"]:
+                self.mounted.add(cmd[3])
+            elif cmd[:2] == ["systemd-dissect", "-U"]:
+                self.mounted.discard(cmd[2])
+            elif cmd[0] == "losetup" and "--show" in cmd:
+                return ("/dev/loop7\n", "")
+            return (None, None)
+        self.useFixture(fixtures.MockPatch(
+            "ruck.utils.run_command", side_effect=run_command))
+        self.useFixture(fixtures.MockPatch(
+            "os.path.ismount", side_effect=lambda p: p in self.mounted))
+
+    def test_reuse(self):
+        released = []
+        manager = MountManager(self.registry, on_release=released.append)
+        with manager.mount(self.image, self.rootfs):
+            with open(self.registry) as f:
+                self.assertEqual({self.rootfs: self.image},
+                                 json.load(f)["mounts"])
+        with manager.mount(self.image, self.rootfs):
+            pass
+        self.assertEqual([["systemd-dissect", "-M"]], self.commands)
+
+        manager.close()
+        self.assertEqual(["systemd-dissect", "-U"], self.commands[-1])
+        self.assertEqual([self.image], released)
+        self.assertFalse(os.path.exists(self.registry))
+
+    def test_error(self):
+        manager = MountManager(self.registry)
+
+        def fail():
+            with manager.mount(self.image, self.rootfs):
+                raise RuntimeError()
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(set(), self.mounted)
+        self.assertEqual({}, manager.mounts)
+
+    def test_standalone(self):
+        manager = MountManager(keep=False)
+        with manager.mount(self.image, self.rootfs):
+            self.assertEqual({self.rootfs}, self.mounted)
+        self.assertEqual(set(), self.mounted)
+
+    def test_settle(self):
+        manager = MountManager(self.registry)
+        with manager.mount(self.image, self.rootfs):
+            pass
+        manager.settle(FakeStage(outputs=["other.img"]))
+        self.assertEqual({self.rootfs}, self.mounted)
+        stage = FakeStage(outputs=[self.image])
+        stage.MOUNTS = True
+        manager.settle(stage)
+        self.assertEqual({self.rootfs}, self.mounted)
+        manager.settle(FakeStage(scratch=[self.rootfs]))
+        self.assertEqual(set(), self.mounted)
+
+    def test_loop_releases_mounts(self):
+        manager = MountManager(self.registry)
+        with manager.mount(self.image, self.rootfs):
+            pass
+        with manager.loop(self.image) as loop:
+            self.assertEqual("/dev/loop7", loop)
+            self.assertEqual(set(), self.mounted)
+            self.assertEqual({loop: self.image}, manager.loops)
+        self.assertEqual(["losetup", "-d"], self.commands[-1])
+        self.assertEqual({}, manager.loops)
+
+    def test_recover(self):
+        self.mounted.add(self.rootfs)
+        os.makedirs(os.path.dirname(self.registry))
+        with open(self.registry, "w") as f:
+            json.dump({"pid": 2 ** 22 + 1,
+                       "mounts": {self.rootfs: self.image},
+                       "loops": {}}, f)
+        with mock.patch("ruck.mount._alive", return_value=False):
+            MountManager(self.registry).recover()
+        self.assertEqual(set(), self.mounted)
+        self.assertFalse(os.path.exists(self.registry))
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import io
+import os
+import pathlib
+import tarfile
+from unittest import mock
+
+import fixtures
+from omegaconf import OmegaConf
+
+from ruck import archive
+from ruck.cmd import State
+from ruck import exceptions
+from ruck.log import current_phase
+from ruck.log import phase_context
+from ruck import ostree
+from ruck.stages.ostree_delta import OstreeDeltaPlugin
+from ruck.stages.ostree_prep import OstreePrepPlugin
+from ruck.tests import base
+
+COMMITS = [str(i) * 64 for i in range(4)]
+
+LOG = "".join(f"""commit {commit}
+ContentChecksum:  {"f" * 64}
+Date:  2024-05-01 10:00:00 +0000
+
+    Update
+
+""" for commit in COMMITS)
+
+
+class TestOstree(base.TestCase):
+
+    def setUp(self):
+        super(TestOstree, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.rootfs = os.path.join(self.path, "rootfs")
+        for directory in ["etc", "boot/grub", "boot/dtbs", "opt/app",
+                          "usr/local/bin", "usr/bin"]:
+            os.makedirs(os.path.join(self.rootfs, directory))
+        files = {
+            "etc/hostname": b"ruck\n",
+            "boot/vmlinuz-6.1.0-amd64": b"kernel",
+            "boot/initrd.img-6.1.0-amd64": b"initrd",
+            "boot/grub/grub.cfg": b"grub",
+            "boot/dtbs/board.dtb": b"dtb",
+            "opt/app/data": b"data",
+            "usr/bin/true": b"true",
+        }
+        for name, data in files.items():
+            with open(os.path.join(self.rootfs, name), "wb") as f:
+                f.write(data)
+        os.link(os.path.join(self.rootfs, "etc/hostname"),
+                os.path.join(self.rootfs, "etc/hostname.bak"))
+        os.symlink("boot/vmlinuz-6.1.0-amd64",
+                   os.path.join(self.rootfs, "vmlinuz"))
+        self.tarball = os.path.join(self.path, "rootfs.tar.gz")
+        archive.pack(self.rootfs, self.tarball)
+
+    def convert(self):
+        out = io.BytesIO()
+        with archive.uncompressed(self.tarball) as f:
+            ostree.convert(f, out)
+        out.seek(0)
+        with tarfile.open(fileobj=out) as tar:
+            return {m.name: (m, tar.extractfile(m).read()
+                             if m.isreg() else None)
+                    for m in tar.getmembers()}
+
+    def test_convert(self):
+        members = self.convert()
+        csum = hashlib.sha256(b"kernel" + b"initrd").hexdigest()
+
+        (link, regular) = sorted(
+            ["usr/etc/hostname", "usr/etc/hostname.bak"],
+            key=lambda name: members[name][0].isreg())
+        self.assertEqual(b"ruck\n", members[regular][1])
+        self.assertEqual(regular, members[link][0].linkname)
+        self.assertNotIn("etc", members)
+        self.assertEqual(
+            b"kernel",
+            members[f"usr/lib/ostree-boot/vmlinuz-6.1.0-amd64-{csum}"][1])
+        self.assertEqual(
+            b"initrd",
+            members[f"usr/lib/ostree-boot/initramfs-6.1.0-amd64-{csum}"][1])
+        self.assertEqual(b"grub",
+                         members["usr/lib/ostree-boot/grub/grub.cfg"][1])
+        self.assertEqual(b"dtb", members["boot/dtbs/board.dtb"][1])
+        self.assertTrue(members["boot"][0].isdir())
+        self.assertNotIn("vmlinuz", members)
+        self.assertNotIn("opt/app/data", members)
+        self.assertNotIn("usr/local/bin", members)
+        self.assertEqual("var/opt", members["opt"][0].linkname)
+        self.assertEqual("../var/usrlocal", members["usr/local"][0].linkname)
+        self.assertTrue(members["sysroot"][0].isdir())
+        self.assertTrue(members["efi"][0].isdir())
+
+    def test_convert_without_kernel(self):
+        os.unlink(os.path.join(self.rootfs, "boot/vmlinuz-6.1.0-amd64"))
+        archive.pack(self.rootfs, self.tarball)
+        self.assertRaises(exceptions.ConfigError, self.convert)
+
+    def test_commit_parent(self):
+        phase = OmegaConf.create({
+            "name": "prep", "stage": "ostree_prep",
+            "options": {"repo": "repo", "branch": "main",
+                        "target": "rootfs.tar.gz", "version": "1.2"}})
+        plugin = OstreePrepPlugin(State(), phase, pathlib.Path(self.path))
+        plugin.preflight_check()
+        with mock.patch("ruck.utils.run_command",
+                        return_value=(COMMITS[0] + "\n", "")):
+            options = plugin._commit_options()
+        self.assertEqual(COMMITS[0], options["parent"])
+        self.assertEqual("Update", options["subject"])
+        self.assertEqual("version=1.2", options["add-metadata-string"])
+        with mock.patch("ruck.utils.run_command", return_value=("", "")):
+            options = plugin._commit_options()
+        self.assertEqual("none", options["parent"])
+        self.assertEqual("Initial commit", options["subject"])
+
+    def _sync(self, cache, old):
+        archive.pack(self.rootfs, self.tarball)
+        with archive.uncompressed(self.tarball) as f:
+            return cache._sync(f, old)
+
+    def test_commit_cache_sync(self):
+        cache = ostree.CommitCache(os.path.join(self.path, "cache"))
+        (files, changed) = self._sync(cache, {})
+        self.assertEqual(len(files), changed)
+        hostname = os.path.join(cache.tree, "usr/etc/hostname")
+        with open(hostname, "rb") as f:
+            self.assertEqual(b"ruck\n", f.read())
+        self.assertEqual("../var/usrlocal",
+                         os.readlink(os.path.join(cache.tree, "usr/local")))
+
+        # Stand for the repository object the checkout links to.
+        kernel = os.path.join(self.path, "object")
+        os.link(os.path.join(cache.tree, "usr/bin/true"), kernel)
+        with open(os.path.join(self.rootfs, "usr/bin/true"), "wb") as f:
+            f.write(b"false")
+        os.unlink(os.path.join(self.rootfs, "etc/hostname.bak"))
+        (files, changed) = self._sync(cache, files)
+        # usr/bin/true, usr/etc and possibly usr/etc/hostname if it
+        # was the hardlink.
+        self.assertIn(changed, [2, 3])
+        with open(os.path.join(cache.tree, "usr/bin/true"), "rb") as f:
+            self.assertEqual(b"false", f.read())
+        with open(kernel, "rb") as f:
+            self.assertEqual(b"true", f.read())
+        self.assertFalse(os.path.exists(
+            os.path.join(cache.tree, "usr/etc/hostname.bak")))
+        self.assertNotIn("usr/etc/hostname.bak", files)
+
+
+class TestOstreeDelta(base.TestCase):
+
+    def setUp(self):
+        super(TestOstreeDelta, self).setUp()
+        self.path = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.path.joinpath("repo").mkdir()
+
+    def _plugin(self, **options):
+        options.setdefault("repo", "repo")
+        options.setdefault("branch", "exampleos/testing")
+        phase = OmegaConf.create(
+            {"name": "delta", "stage": "ostree_delta", "options": options})
+        plugin = OstreeDeltaPlugin(State(), phase, self.path)
+        plugin.preflight_check()
+        return plugin
+
+    def _run(self, plugin, deltas=""):
+        """Run a phase, returning the ostree commands it ran."""
+        def run_command(cmd, **kwargs):
+            if cmd[1] == "log":
+                return (LOG, "")
+            elif cmd[1:3] == ["static-delta", "list"]:
+                return (deltas, "")
+            return (None, None)
+        with mock.patch("ruck.utils.run_command",
+                        side_effect=run_command) as run:
+            plugin.run()
+        return [call.args[0][1:] for call in run.call_args_list]
+
+    def test_history(self):
+        with mock.patch("ruck.utils.run_command", return_value=(LOG, "")):
+            self.assertEqual(COMMITS, ostree.history("repo", "main"))
+            self.assertEqual(COMMITS[:2],
+                             ostree.history("repo", "main", depth=1))
+
+    def test_deltas(self):
+        repo = self.path.joinpath("repo")
+        commands = self._run(self._plugin(depth=2, jobs=2))
+        generated = sorted(cmd[3:] for cmd in commands
+                           if cmd[:2] == ["static-delta", "generate"])
+        self.assertEqual(sorted([
+            [f"--to={COMMITS[0]}", "--empty"],
+            [f"--to={COMMITS[0]}", f"--from={COMMITS[1]}"],
+            [f"--to={COMMITS[0]}", f"--from={COMMITS[2]}"],
+        ]), generated)
+        self.assertEqual(["summary", f"--repo={repo}", "--update"],
+                         commands[-1])
+        self.assertFalse([cmd for cmd in commands if cmd[0] == "prune"])
+
+    def test_deltas_phase_context(self):
+        phases = set()
+
+        def run_command(cmd, **kwargs):
+            if cmd[1] == "log":
+                return (LOG, "")
+            phases.add(current_phase())
+            return ("", "")
+        plugin = self._plugin(depth=2, jobs=2)
+        with mock.patch("ruck.utils.run_command", side_effect=run_command), \
+                phase_context("deltas"):
+            plugin.run()
+        self.assertEqual({"deltas"}, phases)
+
+    def test_existing_deltas(self):
+        commands = self._run(
+            self._plugin(summary=False),
+            deltas=f"{COMMITS[0]}\n{COMMITS[1]}-{COMMITS[0]}\n")
+        self.assertEqual(["log", "static-delta"],
+                         [cmd[0] for cmd in commands])
+
+    def test_prune(self):
+        repo = self.path.joinpath("repo")
+        commands = self._run(self._plugin(
+            retention={"depth": 5, "keep_younger_than": "30 days ago"}))
+        self.assertEqual(
+            ["prune", f"--repo={repo}", "--refs-only", "--depth=5",
+             "--keep-younger-than=30 days ago"], commands[0])
+
+    def test_no_commits(self):
+        with mock.patch("ruck.utils.run_command", return_value=("", "")):
+            self.assertRaises(exceptions.ConfigError,
+                              self._plugin().run)
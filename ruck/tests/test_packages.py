@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+from unittest import mock
+
+import fixtures
+
+from ruck import packages
+from ruck.packages import deb_filename
+from ruck.packages import PackageCache
+from ruck.tests import base
+
+
+class TestPackageCache(base.TestCase):
+
+    def setUp(self):
+        super(TestPackageCache, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.cache = PackageCache(os.path.join(self.path, "packages"),
+                                  max_size=250)
+
+    def _run(self, debs, installed=None):
+        """Fake a bootstrap run that used the given packages."""
+        incoming = self.cache.incoming()
+        for name, size in debs.items():
+            with open(os.path.join(incoming, name), "wb") as f:
+                f.write(b"x" * size)
+        if installed is not None:
+            with open(os.path.join(incoming, packages.INSTALLED), "w") as f:
+                f.write("".join(f"{line}\n" for line in installed))
+        return self.cache.harvest(incoming)
+
+    def test_deb_filename(self):
+        self.assertEqual("libc6_1%3a2.36-9_amd64.deb",
+                         deb_filename("libc6", "1:2.36-9", "amd64"))
+
+    def test_hooks(self):
+        hooks = self.cache.hooks("/tmp/incoming")
+        self.assertIn(
+            f"--setup-hook=sync-in {self.cache.archives} "
+            "/var/cache/apt/archives/", hooks)
+        self.assertEqual(
+            "--customize-hook=sync-out /var/cache/apt/archives "
+            "/tmp/incoming", hooks[-1])
+
+    def test_harvest(self):
+        self.assertEqual((2, []), self._run({"a_1_all.deb": 100,
+                                             "b_1_all.deb": 100}))
+        self.assertEqual((0, []), self._run({"a_1_all.deb": 100}))
+        self.assertEqual(["a_1_all.deb", "b_1_all.deb"],
+                         sorted(os.listdir(self.cache.archives)))
+        self.assertEqual(200, self.cache.stats()["size"])
+
+    def test_lru_eviction(self):
+        with mock.patch.object(packages.time, "time", return_value=1):
+            self._run({"a_1_all.deb": 100, "b_1_all.deb": 100})
+        # Both packages are synced back out, only b is still installed.
+        with mock.patch.object(packages.time, "time", return_value=2):
+            (added, evicted) = self._run(
+                {"a_1_all.deb": 100, "b_1_all.deb": 100,
+                 "c_1_all.deb": 100},
+                installed=["b 1 all", "c 1 all"])
+        self.assertEqual((1, ["a_1_all.deb"]), (added, evicted))
+        self.assertEqual(["b_1_all.deb", "c_1_all.deb"],
+                         sorted(os.listdir(self.cache.archives)))
+
+    def test_prune(self):
+        self._run({"a_1_all.deb": 100, "b_1_all.deb": 100})
+        self.assertEqual(2, len(self.cache.prune(max_size=0)))
+        self.assertEqual(0, self.cache.stats()["packages"])
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import struct
+import subprocess
+import uuid
+
+import fixtures
+
+from ruck import gpt
+from ruck import populate
+from ruck.tests import base
+
+MIB = 1024 * 1024
+
+
+def write_gpt(image, size, partitions):
+    """Write a minimal GPT label, partitions are (type, start, size, name)."""
+    with open(image, "wb") as f:
+        f.truncate(size)
+        header = bytearray(92)
+        header[0:8] = gpt.SIGNATURE
+        struct.pack_into("<QII", header, 72, 2, 128, 128)
+        f.seek(gpt.SECTOR_SIZE)
+        f.write(header)
+        for index, (type_guid, start, length, name) in enumerate(partitions):
+            entry = bytearray(128)
+            entry[0:16] = type_guid.bytes_le
+            entry[16:32] = uuid.uuid4().bytes_le
+            struct.pack_into(
+                "<QQ", entry, 32, start // gpt.SECTOR_SIZE,
+                (start + length) // gpt.SECTOR_SIZE - 1)
+            entry[56:56 + 2 * len(name)] = name.encode("utf-16-le")
+            f.seek(2 * gpt.SECTOR_SIZE + index * 128)
+            f.write(entry)
+
+
+class TestPopulate(base.TestCase):
+
+    def setUp(self):
+        super(TestPopulate, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.image = os.path.join(self.path, "disk.img")
+
+    def test_read_partitions(self):
+        write_gpt(self.image, 8 * MIB, [
+            (gpt.ESP, MIB, 2 * MIB, "EFI"),
+            (gpt.LINUX_DATA, 3 * MIB, 4 * MIB, "ROOT")])
+        partitions = gpt.read_partitions(self.image)
+        self.assertEqual(
+            [(1, gpt.ESP, MIB, 2 * MIB, "EFI"),
+             (2, gpt.LINUX_DATA, 3 * MIB, 4 * MIB, "ROOT")],
+            [(p.number, p.type, p.start, p.size, p.name)
+             for p in partitions])
+
+    def test_layout(self):
+        write_gpt(self.image, 8 * MIB, [
+            (gpt.ESP, MIB, MIB, "EFI"),
+            (gpt.LINUX_DATA, 2 * MIB, MIB, "DATA"),
+            (gpt.ROOT["amd64"], 3 * MIB, MIB, "ROOT"),
+            (gpt.VAR, 4 * MIB, MIB, "VAR")])
+        self.assertEqual(
+            [("EFI", "efi"), ("ROOT", ""), ("VAR", "var")],
+            [(p.name, d) for p, d in
+             populate.layout(gpt.read_partitions(self.image))])
+
+    def test_populate(self):
+        for tool in ["mkfs.ext4", "debugfs", "blkid"]:
+            if shutil.which(tool) is None:
+                self.skipTest(f"{tool} is not found.")
+        write_gpt(self.image, 16 * MIB, [
+            (gpt.LINUX_DATA, MIB, 8 * MIB, "ROOT")])
+        rootfs = os.path.join(self.path, "rootfs")
+        os.makedirs(os.path.join(rootfs, "etc"))
+        with open(os.path.join(rootfs, "etc/hostname"), "w") as f:
+            f.write("ruck\n")
+
+        populate.populate(self.image, rootfs,
+                          os.path.join(self.path, "mounts"))
+        partition = gpt.read_partitions(self.image)[0]
+        self.assertEqual("ROOT",
+                         populate.probe(self.image, partition)["LABEL"])
+        out = subprocess.check_output(
+            ["debugfs", "-R", "cat /etc/hostname",
+             f"{self.image}?offset={MIB}"],
+            stderr=subprocess.DEVNULL, universal_newlines=True)
+        self.assertEqual("ruck\n", out)
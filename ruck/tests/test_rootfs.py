@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import pathlib
+from unittest import mock
+
+import fixtures
+from omegaconf import OmegaConf
+
+from ruck.cmd import State
+from ruck.packages import PackageCache
+from ruck.rootfs import archive_format
+from ruck.rootfs import RootfsCache
+from ruck.stages.bootstrap import BootstrapPlugin
+from ruck import stream
+from ruck.tests import base
+
+
+class TestRootfsCache(base.TestCase):
+
+    def setUp(self):
+        super(TestRootfsCache, self).setUp()
+        self.path = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = self.path
+        self.workspace = self.path.joinpath("image")
+        os.makedirs(self.workspace.joinpath("overlay/etc"))
+        self._write("overlay/etc/hostname", "ruck\n")
+
+    def _write(self, path, content):
+        with open(self.workspace.joinpath(path), "w") as f:
+            f.write(content)
+
+    def _plugin(self, **options):
+        options.setdefault("suite", "bookworm")
+        options.setdefault("target", "rootfs-0.1.tar.gz")
+        options.setdefault("architecture", "amd64")
+        options.setdefault("packages", ["vim"])
+        if options["packages"] is None:
+            del options["packages"]
+        options.setdefault("setup_hooks", ["sync-in overlay/ /"])
+        options.setdefault("package_cache", False)
+        phase = OmegaConf.create(
+            {"name": "bootstrap", "stage": "bootstrap", "options": options})
+        plugin = BootstrapPlugin(self.state, phase, self.workspace)
+        plugin.mmdebstrap = "mmdebstrap"
+        return plugin
+
+    def _run(self, plugin):
+        """Run a bootstrap phase, returning whether mmdebstrap ran."""
+        def mmdebstrap(cmd, **kwargs):
+            with open(cmd[-1], "w") as f:
+                f.write("rootfs")
+        with mock.patch("ruck.utils.run_command",
+                        side_effect=mmdebstrap) as run_command:
+            plugin.run()
+        return run_command.called
+
+    def _key(self, plugin):
+        cache = RootfsCache.from_state(self.state)
+        return cache.key(
+            OmegaConf.to_container(plugin.config.options, resolve=True),
+            cache.digests(self.workspace, plugin.inputs()))
+
+    def test_archive_format(self):
+        self.assertEqual(".tar.gz", archive_format("rootfs-0.1.tar.gz"))
+        self.assertEqual(".squashfs", archive_format("rootfs.squashfs"))
+        self.assertEqual("", archive_format("rootfs"))
+
+    def test_key(self):
+        key = self._key(self._plugin())
+        self.assertEqual(key, self._key(self._plugin(target="other.tar.gz")))
+        self.assertNotEqual(key, self._key(self._plugin(target="a.tar.xz")))
+        self.assertNotEqual(key, self._key(self._plugin(packages=["nano"])))
+        self._write("overlay/etc/hostname", "other\n")
+        self.assertNotEqual(key, self._key(self._plugin()))
+
+    def test_reuse(self):
+        self.assertTrue(self._run(self._plugin()))
+        plugin = self._plugin(target="rootfs-0.2.tar.gz")
+        self.assertFalse(self._run(plugin))
+        with open(self.workspace.joinpath("rootfs-0.2.tar.gz")) as f:
+            self.assertEqual("rootfs", f.read())
+        self.assertTrue(self._run(self._plugin(packages=["nano"])))
+
+    def test_no_packages(self):
+        self.assertTrue(self._run(self._plugin(packages=None)))
+        cache = RootfsCache.from_state(self.state)
+        key = self._key(self._plugin(packages=None))
+        entry = cache.entry(key, "rootfs-0.1.tar.gz")
+        self.assertTrue(os.path.exists(entry))
+        with open(os.path.join(os.path.dirname(entry), "meta.json")) as f:
+            self.assertEqual([], json.load(f)["packages"])
+        self.assertFalse(self._run(self._plugin(packages=None,
+                                                target="copy.tar.gz")))
+
+    def test_package_cache_size(self):
+        cache = PackageCache.from_state(self.state)
+        os.makedirs(cache.archives)
+        with open(os.path.join(cache.archives, "vim_1_amd64.deb"), "wb") as f:
+            f.write(b"x" * 1024)
+        self._run(self._plugin(package_cache=True))
+        self.assertEqual(1, cache.stats()["packages"])
+        self._run(self._plugin(package_cache=True, package_cache_size=0,
+                               rootfs_cache=False))
+        self.assertEqual(0, cache.stats()["packages"])
+
+    def test_rebuild_does_not_modify_cache(self):
+        self._run(self._plugin())
+        self.state.no_cache = True
+        self.assertTrue(self._run(self._plugin()))
+        self.state.no_cache = False
+        self.assertFalse(self._run(self._plugin(target="copy.tar.gz")))
+
+    def test_max_age(self):
+        self._run(self._plugin())
+        self.assertFalse(self._run(self._plugin(rootfs_cache_max_age=1)))
+        cache = RootfsCache.from_state(self.state)
+        key = self._key(self._plugin())
+        meta = os.path.join(self.path, ".ruck/rootfs", key, "meta.json")
+        with open(meta) as f:
+            content = json.load(f)
+        content["created"] -= 2 * 86400
+        with open(meta, "w") as f:
+            json.dump(content, f)
+        self.assertTrue(self._run(self._plugin(rootfs_cache_max_age=1)))
+        self.assertGreater(cache.created(key), content["created"])
+
+    def test_evict(self):
+        keys = []
+        for packages in [["vim"], ["nano"], ["curl"]]:
+            self._run(self._plugin(packages=packages))
+            keys.append(self._key(self._plugin(packages=packages)))
+        (vim, nano, curl) = keys
+        cache = RootfsCache.from_state(self.state)
+        for (used, key) in enumerate(keys):
+            os.utime(os.path.join(cache.path, key, "meta.json"),
+                     (used, used))
+        # Use the root filesystem of vim last.
+        self.assertFalse(self._run(self._plugin(packages=["vim"])))
+        cache.max_size = cache._size(vim) + cache._size(curl)
+        self.assertEqual([nano], cache.evict())
+        self.assertEqual(sorted([vim, curl]), sorted(os.listdir(cache.path)))
+        self._run(self._plugin(packages=["less"], rootfs_cache_size=0))
+        self.assertEqual([self._key(self._plugin(packages=["less"]))],
+                         os.listdir(cache.path))
+
+    def test_directory_target(self):
+        self.assertIsNone(self._plugin(target="rootfs")._rootfs_cache(
+            self.workspace.joinpath("rootfs")))
+
+    def test_closest(self):
+        self._run(self._plugin(packages=["vim"]))
+        self._run(self._plugin(packages=["vim", "nano", "curl"]))
+        plugin = self._plugin(packages=["vim", "nano", "curl", "less"])
+        cache = RootfsCache.from_state(self.state)
+        base = cache.key(
+            OmegaConf.to_container(plugin.config.options, resolve=True),
+            cache.digests(self.workspace, plugin.inputs()), packages=False)
+        (key, added, removed) = cache.closest(
+            base, ["vim", "nano", "curl", "less"], "rootfs.tar.gz", 3600)
+        self.assertEqual((["less"], []), (added, removed))
+        self.assertIsNone(cache.closest(
+            base, ["vim"], "rootfs.tar.xz", 3600))
+        self.assertIsNone(cache.closest(
+            base, ["vim"], "rootfs.tar.gz", -1))
+
+    def _run_incremental(self, plugin):
+        """Run an incremental bootstrap, returning the commands run."""
+        commands = []
+
+        def run_command(cmd, **kwargs):
+            commands.append([str(a) for a in cmd])
+            if cmd[0] == "mmdebstrap":
+                path = cmd[-1]
+            elif "-cf" in cmd:
+                path = cmd[cmd.index("-cf") + 1]
+            else:
+                return
+            with open(path, "w") as f:
+                f.write("rootfs")
+
+        def run_chroot_command(cmd, rootfs, **kwargs):
+            commands.append(cmd)
+
+        with mock.patch("ruck.utils.run_command",
+                        side_effect=run_command), \
+                mock.patch("ruck.utils.run_chroot_command",
+                           side_effect=run_chroot_command), \
+                mock.patch("os.geteuid", return_value=0):
+            plugin.run()
+        return commands
+
+    def test_incremental(self):
+        self._run(self._plugin(packages=["vim", "curl"],
+                               customize_hooks=["echo test"]))
+        commands = self._run_incremental(self._plugin(
+            packages=["vim", "nano"], incremental=True,
+            customize_hooks=["echo test"]))
+        self.assertNotIn("mmdebstrap", [c[0] for c in commands])
+        self.assertIn(["apt-get", "install", "--yes",
+                       "--no-install-recommends", "nano"], commands)
+        self.assertIn(["apt-get", "purge", "--yes", "curl"], commands)
+        self.assertIn("echo test", commands[-2])
+        # The result is cached in turn.
+        self.assertFalse(self._run(self._plugin(
+            packages=["vim", "nano"], customize_hooks=["echo test"],
+            target="copy.tar.gz")))
+
+    def test_incremental_too_many_changes(self):
+        self._run(self._plugin(packages=["vim"]))
+        commands = self._run_incremental(self._plugin(
+            packages=["vim", "nano", "curl"], incremental=True,
+            incremental_max_changes=1))
+        self.assertEqual("mmdebstrap", commands[-1][0])
+
+    def test_compression(self):
+        target = self.workspace.joinpath("rootfs.tar.lz4")
+        (output, env) = self._plugin()._output(target)
+        self.assertEqual("rootfs.tar.lz4.ruck.tar", output.name)
+        target = self.workspace.joinpath("rootfs.tar.zst")
+        (output, env) = self._plugin(compression_level=3)._output(target)
+        self.assertEqual((target, "3"), (output, env["ZSTD_CLEVEL"]))
+
+    def test_stream(self):
+        self.assertFalse(self._run(self._plugin(stream=True,
+                                                rootfs_cache=False)))
+        target = self.workspace.joinpath("rootfs-0.1.tar.gz")
+        self.assertFalse(target.exists())
+        with mock.patch("ruck.utils.run_pipeline") as run_pipeline:
+            stream.take(target)(["tar", "-x"])
+        (cmd, consumer) = run_pipeline.call_args[0][0]
+        self.assertEqual(["bookworm", "-"], cmd[-2:])
+        self.assertEqual(["tar", "-x"], consumer)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+
+from omegaconf import OmegaConf
+
+from ruck.scheduler import Scheduler
+from ruck.tests import base
+
+
+class FakeStage(object):
+    def __init__(self, inputs=(), outputs=(), scratch=()):
+        self._inputs = list(inputs)
+        self._outputs = list(outputs)
+        self._scratch = list(scratch)
+
+    def inputs(self):
+        return self._inputs
+
+    def outputs(self):
+        return self._outputs
+
+    def scratch(self):
+        return self._scratch
+
+
+def phase(name):
+    return OmegaConf.create({"name": name, "stage": name})
+
+
+class TestScheduler(base.TestCase):
+
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        # Layout of config/uefi-ostree/image.yaml
+        self.stages = [
+            (phase("bootstrap"), FakeStage(outputs=["rootfs.tar.gz"])),
+            (phase("ostree_init"), FakeStage(outputs=["repo"])),
+            (phase("ostree_prep"),
+             FakeStage(inputs=["rootfs.tar.gz", "repo"], outputs=["repo"],
+                       scratch=["rootfs"])),
+            (phase("parted"), FakeStage(outputs=["disk.img"])),
+            (phase("ostree_deploy"),
+             FakeStage(inputs=["repo", "disk.img"], outputs=["disk.img"],
+                       scratch=["rootfs"])),
+        ]
+
+    def test_dependencies(self):
+        deps = Scheduler(self.stages).dependencies
+        self.assertEqual([set(), set(), {0, 1}, set(), {1, 2, 3}], deps)
+
+    def test_undeclared_phase_keeps_order(self):
+        self.stages.insert(2, (phase("noop"), FakeStage()))
+        deps = Scheduler(self.stages).dependencies
+        self.assertEqual({0, 1}, deps[2])
+        self.assertIn(2, deps[4])
+
+    def test_run_parallel(self):
+        lock = threading.Lock()
+        done = []
+
+        def func(index):
+            with lock:
+                done.append(index)
+
+        scheduler = Scheduler(self.stages, jobs=4)
+        scheduler.run(func)
+        self.assertEqual(set(range(5)), set(done))
+        for index, deps in enumerate(scheduler.dependencies):
+            for d in deps:
+                self.assertLess(done.index(d), done.index(index))
+
+    def test_run_failure(self):
+        done = []
+
+        def func(index):
+            if index == 0:
+                raise RuntimeError("bootstrap failed")
+            done.append(index)
+
+        self.assertRaises(RuntimeError,
+                          Scheduler(self.stages, jobs=2).run, func)
+        self.assertNotIn(2, done)
+        self.assertNotIn(4, done)
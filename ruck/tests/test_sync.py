@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+
+import fixtures
+
+from ruck.sync import sync_tree
+from ruck.tests import base
+
+
+class TestSyncTree(base.TestCase):
+
+    def setUp(self):
+        super(TestSyncTree, self).setUp()
+        path = self.useFixture(fixtures.TempDir()).path
+        self.source = os.path.join(path, "config")
+        self.target = os.path.join(path, "workspace")
+        self.manifest = os.path.join(self.target, ".ruck", "sync.json")
+
+        os.makedirs(os.path.join(self.source, "overlay/etc"))
+        self._write("image.yaml", "name: test\n")
+        self._write("overlay/etc/hostname", "ruck\n")
+        os.symlink("hostname", os.path.join(self.source, "overlay/etc/link"))
+
+    def _write(self, path, content):
+        with open(os.path.join(self.source, path), "w") as f:
+            f.write(content)
+
+    def _sync(self, **kwargs):
+        return sync_tree(self.source, self.target, self.manifest, **kwargs)
+
+    def test_sync(self):
+        self.assertEqual(3, self._sync()[0])
+        with open(os.path.join(self.target, "overlay/etc/hostname")) as f:
+            self.assertEqual("ruck\n", f.read())
+        self.assertEqual(
+            "hostname",
+            os.readlink(os.path.join(self.target, "overlay/etc/link")))
+
+    def test_incremental(self):
+        self._sync()
+        config = os.path.join(self.target, "image.yaml")
+        mtime = os.stat(config).st_mtime_ns
+        self.assertEqual((0, 0), self._sync())
+        self.assertEqual(mtime, os.stat(config).st_mtime_ns)
+
+        self._write("image.yaml", "name: changed\n")
+        self.assertEqual((1, 14), self._sync())
+
+    def test_removed_files(self):
+        self._sync()
+        artifact = os.path.join(self.target, "rootfs.tar.gz")
+        open(artifact, "w").close()
+        os.unlink(os.path.join(self.source, "overlay/etc/hostname"))
+        self._sync()
+        self.assertFalse(
+            os.path.exists(os.path.join(self.target, "overlay/etc/hostname")))
+        # Files created in the workspace are not part of the sync.
+        self.assertTrue(os.path.exists(artifact))
+
+    def test_removed_directories(self):
+        os.makedirs(os.path.join(self.source, "overlay/srv/www"))
+        self._write("overlay/srv/www/index.html", "ruck\n")
+        self._sync()
+        shutil.rmtree(os.path.join(self.source, "overlay/srv"))
+        os.makedirs(os.path.join(self.source, "overlay/kept"))
+        self._sync()
+        self.assertFalse(
+            os.path.exists(os.path.join(self.target, "overlay/srv")))
+        self.assertTrue(
+            os.path.isdir(os.path.join(self.target, "overlay/kept")))
+
+        # Directories holding files created in the workspace are kept.
+        open(os.path.join(self.target, "overlay/kept/artifact"), "w").close()
+        os.rmdir(os.path.join(self.source, "overlay/kept"))
+        self._sync()
+        self.assertTrue(os.path.exists(
+            os.path.join(self.target, "overlay/kept/artifact")))
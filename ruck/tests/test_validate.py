@@ -13,7 +13,10 @@
 # under the License.
 
 
+from ruck.schema import errors
+from ruck.schema import phase_schema
 from ruck.schema import validate
+from ruck.schema import validator
 from ruck.tests import base
 
 
@@ -24,3 +27,18 @@ class TestSchemaValidate(base.TestCase):
         step = {"description": "test"}
         status = validate(step, SCHEMA)
         self.assertEqual(status, 1)
+
+    def test_errors(self):
+        SCHEMA = phase_schema({"suite": {"type": "string", "required": True}})
+        step = {"name": "bootstrap", "stage": "bootstrap",
+                "options": {"suit": "bookworm"}}
+        self.assertEqual(
+            ["options.suit: unknown field",
+             "options.suite: required field"],
+            sorted(errors(step, SCHEMA)))
+
+    def test_validator_is_cached(self):
+        SCHEMA = {"description": {"type": "string"}}
+        self.assertIs(validator(SCHEMA, key="test")[0],
+                      validator(dict(SCHEMA), key="test")[0])
+        self.assertIsNot(validator(SCHEMA)[0], validator(SCHEMA)[0])
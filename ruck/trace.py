@@ -0,0 +1,80 @@
+"""
+Copyright (c) 2024 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+_lock = threading.Lock()
+_events = None
+
+
+def enable():
+    """Start recording trace events."""
+    global _events
+    _events = []
+
+
+def enabled():
+    return _events is not None
+
+
+def _now():
+    return time.monotonic_ns() // 1000
+
+
+@contextlib.contextmanager
+def span(name, cat="ruck", **args):
+    """Record a complete event around a block of code.
+
+    The yielded dictionary can be updated to attach more arguments
+    to the event, such as the exit status of a command.
+    """
+    if _events is None:
+        yield args
+        return
+
+    start = _now()
+    try:
+        yield args
+    finally:
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": start,
+            "dur": _now() - start,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with _lock:
+            _events.append(event)
+
+
+def thread_name(name):
+    """Name the track of the current thread in the timeline."""
+    if _events is None:
+        return
+    with _lock:
+        _events.append({
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": {"name": name},
+        })
+
+
+def save(path):
+    """Write the recorded events in the Chrome trace event format."""
+    with _lock:
+        events = list(_events or [])
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f,
+                  default=str)
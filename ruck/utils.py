@@ -4,27 +4,89 @@ Copyright (c) 2024 Wind River Systems, Inc.
 SPDX-License-Identifier: Apache-2.0
 
 """
+import fcntl
+import logging
+import os
+import shutil
 import subprocess
+import time
+
+from ruck import accounting
+from ruck import checksum
+from ruck import exceptions
+from ruck.log import current_phase
+from ruck.log import current_prefix
+from ruck import trace
+
+LOG = logging.getLogger(__name__)
+
+# ioctl sharing the extents of a file, see ioctl_ficlone(2).
+FICLONE = 0x40049409
+
+
+class Popen(subprocess.Popen):
+    """Popen keeping the resource usage of the child process."""
+
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, sts)
 
 
 def run_command(args, data=None, env=None, capture=False, shell=False,
-                **kwargs):
+                check=True, **kwargs):
     """Run a command in a shell."""
-    try:
-        if not capture:
-            stdout = None
-            stderr = None
-        else:
-            stdout = subprocess.PIPE
-            stderr = subprocess.PIPE
-        stdin = subprocess.PIPE
-        sp = subprocess.Popen(args, stdout=stdout,
-                              stderr=stderr, stdin=stdin,
-                              env=env, shell=shell, universal_newlines=True,
-                              **kwargs)
-        (out, err) = sp.communicate(data)
-    except OSError:
-        raise Exception(f"failed to run cmd: {args}")
+    if isinstance(args, (list, tuple)):
+        argv = [str(a) for a in args]
+    else:
+        argv = [str(args)]
+    name = os.path.basename(argv[0].split()[0])
+    with trace.span(name, cat="command", argv=argv) as event:
+        try:
+            # Phases running concurrently log the output of their
+            # commands line by line so that it carries the prefix of
+            # the phase.
+            stream = not capture and current_prefix() is not None
+            if stream:
+                stdout = subprocess.PIPE
+                stderr = subprocess.STDOUT
+            elif not capture:
+                stdout = None
+                stderr = None
+            else:
+                stdout = subprocess.PIPE
+                stderr = subprocess.PIPE
+            stdin = subprocess.PIPE
+            start = time.monotonic()
+            sp = Popen(args, stdout=stdout,
+                       stderr=stderr, stdin=stdin,
+                       env=env, shell=shell,
+                       universal_newlines=True,
+                       **kwargs)
+            if stream:
+                if data:
+                    sp.stdin.write(data)
+                sp.stdin.close()
+                for line in sp.stdout:
+                    LOG.info(line.rstrip())
+                sp.wait()
+                (out, err) = (None, None)
+            else:
+                (out, err) = sp.communicate(data)
+        except OSError:
+            raise Exception(f"failed to run cmd: {args}")
+        event["returncode"] = sp.returncode
+    accounting.record(current_phase(), argv, sp.returncode,
+                      time.monotonic() - start, sp.rusage)
+    if check and sp.returncode != 0:
+        raise exceptions.CommandError(
+            f"{' '.join(argv)} failed with exit status {sp.returncode}.")
     # Just ensure blank instead of none
     if not out and capture:
         out = out
@@ -33,15 +95,90 @@ def run_command(args, data=None, env=None, capture=False, shell=False,
     return (out, err)
 
 
+def run_pipeline(commands, env=None):
+    """Run commands with the output of each piped into the next one."""
+    argvs = [[str(a) for a in args] for args in commands]
+    name = " | ".join(os.path.basename(argv[0]) for argv in argvs)
+    with trace.span(name, cat="command", argv=argvs) as event:
+        processes = []
+        stdin = subprocess.DEVNULL
+        start = time.monotonic()
+        try:
+            for index, argv in enumerate(argvs):
+                last = index == len(argvs) - 1
+                sp = Popen(argv, stdin=stdin,
+                           stdout=None if last else subprocess.PIPE,
+                           env=env)
+                if stdin is not subprocess.DEVNULL:
+                    # Only the next command holds the pipe open.
+                    stdin.close()
+                stdin = sp.stdout
+                processes.append(sp)
+        except OSError:
+            for sp in processes:
+                sp.kill()
+                sp.wait()
+            raise exceptions.CommandError(f"failed to run cmd: {name}")
+        for sp in processes:
+            sp.wait()
+        event["returncode"] = [sp.returncode for sp in processes]
+    for argv, sp in zip(argvs, processes):
+        accounting.record(current_phase(), argv, sp.returncode,
+                          time.monotonic() - start, sp.rusage)
+    for argv, sp in zip(argvs, processes):
+        if sp.returncode != 0:
+            raise exceptions.CommandError(
+                f"{' '.join(argv)} failed with exit status {sp.returncode}.")
+
+
+def run_feed(args, feed, env=None):
+    """Run a command, calling feed with the file object of its stdin."""
+    argv = [str(a) for a in args]
+    name = os.path.basename(argv[0])
+    with trace.span(name, cat="command", argv=argv) as event:
+        start = time.monotonic()
+        try:
+            sp = Popen(argv, stdin=subprocess.PIPE, env=env)
+        except OSError:
+            raise exceptions.CommandError(f"failed to run cmd: {name}")
+        try:
+            feed(sp.stdin)
+            sp.stdin.close()
+        except BrokenPipeError:
+            # The command exited early, its exit status tells why.
+            pass
+        except BaseException:
+            sp.kill()
+            sp.wait()
+            raise
+        finally:
+            try:
+                sp.stdin.close()
+            except BrokenPipeError:
+                pass
+        sp.wait()
+        event["returncode"] = sp.returncode
+    accounting.record(current_phase(), argv, sp.returncode,
+                      time.monotonic() - start, sp.rusage)
+    if sp.returncode != 0:
+        raise exceptions.CommandError(
+            f"{' '.join(argv)} failed with exit status {sp.returncode}.")
+
+
 def run_chroot_command(args, rootfs, efi=None, data=None, env=None,
-                       capture=False, shell=False, **kwargs):
+                       capture=False, shell=False, check=True, **kwargs):
     """Run bubblewarap in a seperate namespace."""
     try:
         cmd = [
             "bwrap",
             "--bind", rootfs, "/",
-            "--bind", f"{efi}/efi", "/efi",
-            "--bind", f"{efi}/efi", "/boot/efi",
+        ]
+        if efi is not None:
+            cmd += [
+                "--bind", f"{efi}/efi", "/efi",
+                "--bind", f"{efi}/efi", "/boot/efi",
+            ]
+        cmd += [
             "--ro-bind", "/etc/resolv.conf", "/etc/resolv.conf",
             "--proc", "/proc",
             "--dev-bind", "/dev", "/dev",
@@ -58,6 +195,7 @@ def run_chroot_command(args, rootfs, efi=None, data=None, env=None,
                                  env=env,
                                  capture=capture,
                                  shell=shell,
+                                 check=check,
                                  **kwargs)
     except OSError:
         raise Exception(f"Failed to run chroot command: {args}")
@@ -66,3 +204,64 @@ def run_chroot_command(args, rootfs, efi=None, data=None, env=None,
     if not err and capture:
         err = err
     return (out, err)
+
+
+def clone_file(src, dst):
+    """Copy a file, sharing or skipping its unused blocks."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            size = os.fstat(fsrc.fileno()).st_size
+            for offset, length in checksum.data_extents(fsrc.fileno(), size):
+                _copy_range(fsrc.fileno(), fdst.fileno(), offset, length)
+            fdst.truncate(size)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def link_file(src, dst):
+    """Share the data of a file by reflink, or else by hardlink.
+
+    A hardlinked file must be replaced rather than modified in place.
+    """
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+    except OSError:
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        os.link(src, dst)
+    return dst
+
+
+def splice_file(src, dst, offset):
+    """Copy the data of a sparse file into another file at offset,
+    leaving the holes of the file as they are in the destination.
+    """
+    with open(src, "rb") as fsrc, open(dst, "r+b") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        for start, length in checksum.data_extents(fsrc.fileno(), size):
+            _copy_range(fsrc.fileno(), fdst.fileno(), start, length,
+                        offset + start)
+    return dst
+
+
+def _copy_range(fd_in, fd_out, offset, length, dest=None):
+    """Copy a region of a file to the same offset of another file, or
+    to dest.
+    """
+    dest = offset if dest is None else dest
+    while length > 0:
+        try:
+            copied = os.copy_file_range(fd_in, fd_out, length,
+                                        offset, dest)
+        except (AttributeError, OSError):
+            chunk = os.pread(fd_in, min(length, checksum.CHUNK_SIZE), offset)
+            copied = os.pwrite(fd_out, chunk, dest)
+        if copied == 0:
+            break
+        offset += copied
+        dest += copied
+        length -= copied
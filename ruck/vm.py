@@ -7,17 +7,23 @@ SPDX-License-Identifier: Apache-2.0
 import logging
 import sys
 
-try:
-    import libvirt
-except ImportError:
-    print("Libvirt python bindings are not found. 'ruck vm' will not work.")
-
 from rich import console
 from rich.table import Table
 
+from ruck import exceptions
 from ruck.utils import run_command
 
 
+def _libvirt():
+    """Import the libvirt bindings, only needed to query the daemon."""
+    try:
+        import libvirt
+    except ImportError:
+        raise exceptions.RuckError(
+            "Libvirt python bindings are not found. 'ruck vm' will not work.")
+    return libvirt
+
+
 class VM(object):
     def __init__(self, state):
         self.state = state
@@ -52,6 +58,11 @@ class VM(object):
         """Create libvirt vm but dont start it."""
         self.logging.info(f"Staring {self.state.name}")
 
+        disk = f"path={self.state.disk}"
+        if str(self.state.disk).endswith(".qcow2"):
+            # Images made by the export stage.
+            disk += ",format=qcow2"
+
         run_command(
             ["virt-install",
              "--connect", "qemu:///system",
@@ -61,7 +72,7 @@ class VM(object):
              "--ram", "8096",
              "--vcpus", "4",
              "--os-variant", "debiantesting",
-             "--disk", f"path={self.state.disk}",
+             "--disk", disk,
              "--noautoconsole",
              "--check", "path_in_use=off",
              "--import"])
@@ -70,13 +81,14 @@ class VM(object):
         """Remove virtual machine from disk."""
         self.logging.info(f"Destroying {self.state.name}")
         run_command(
-            ["virsh", "destroy", self.state.name])
+            ["virsh", "destroy", self.state.name], check=False)
         self.logging.info(f"Removing {self.state.name}.")
         run_command(
             ["virsh", "undefine", self.state.name])
 
     def _connect(self):
         """Connect to the libvirt daemon."""
+        libvirt = _libvirt()
         try:
             return libvirt.openReadOnly(None)
         except libvirt.libvirtError as e:
@@ -86,6 +98,7 @@ class VM(object):
 
     def _get_state(self, state):
         """Lookup libvirt states."""
+        libvirt = _libvirt()
         libvirt_states = {
             libvirt.VIR_DOMAIN_RUNNING: "Running",
             libvirt.VIR_DOMAIN_SHUTOFF: "Shutoff",